@@ -12,6 +12,9 @@ import plotly.express as px
 import plotly.graph_objects as go
 import dash_core_components as dcc
 from math import radians, cos, sin, asin, sqrt
+from metrics import timed
+from transactions import TransactionStore, PsfCube
+from location import PlanningAreaNeighbours
 
 def haversine(lon1, lat1, lon2, lat2): # find distance between 2 lisitng
     lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
@@ -66,10 +69,11 @@ class Sample:
             property_type.append('Apartment')
         return property_type
 
+    @timed('sample_filter')
     def get_filtered_df(self, data, listing_long, listing_lat):
         '''
         Parameters
-        - data: Dataframe with all historical listing; Preliminary dataset
+        - data: Dataframe with all historical listing; Preliminary dataset, or a TransactionStore built over it once
         - listing_long: Longitude of listing
         - listing_lat: Latitude of listing
         '''
@@ -84,12 +88,13 @@ class Sample:
         #start_date = (datetime.datetime.now() - datetime.timedelta(days=time*365)).strftime('%m/%d/%Y')
         start_date = (datetime.datetime.now() - datetime.timedelta(days=time*365)).strftime('%Y-%m-%d')
         end_date = datetime.datetime.now().strftime('%Y-%m-%d')
-        interm_df = data[(data['Sale Date']>= start_date) & (data['Sale Date']< end_date) & (data['Property Type'].isin(property_type))]
         
-        #find past listings within radius
-        interm_df['distance'] = interm_df.apply(lambda x: haversine(listing_long, listing_lat, x['LONGITUDE'], x['LATITUDE']), axis = 1)
+        #find past listings within radius from the spatial index, then filter only those by date and type
+        store = TransactionStore.of(data)
+        positions, distance = store.index.within(listing_long, listing_lat, radius)
+        keep = store.matches(positions, property_type, start_date, end_date)
         
-        filtered_df = interm_df[interm_df['distance'] <= radius]
+        filtered_df = store.data.iloc[positions[keep]].assign(distance = distance[keep])
         self.dataframe = filtered_df
         #return filtered_df
         
@@ -156,6 +161,7 @@ class Sample:
         
         return table
     
+    @timed('map_render')
     def get_map(self, listing_long, listing_lat, listing_price_psm_output, listing_building_name, listing_address, limit = 50):
         '''
         Parameters
@@ -226,27 +232,20 @@ class Sample:
     def get_closest_planning_area(self, area_centroids, listing_PA, num_of_closest = 2):
         '''
         Parameters
-        - area_centroids: Dataframe consisting the coordinates of centroid for each planning area
+        - area_centroids: Dataframe consisting the coordinates of centroid for each planning area, or a PlanningAreaNeighbours built over it once
         - listing_PA: Planning Area of listing 
         - num_of_closest: N number of Planning Area closest to that of listing, default is 2.
         '''
-        # change to upper case
-        listing_PA = listing_PA.upper()
-        # get longitude and latitude of the centroid for listing's planning area
-        centroid_long = area_centroids[area_centroids['Planning Area'] == listing_PA]['Centroid Longitude']
-        centroid_lat = area_centroids[area_centroids['Planning Area'] == listing_PA]['Centroid Latitude']
-        
-        closest_PA = area_centroids[area_centroids['Planning Area'] != listing_PA].copy()
-        closest_PA['distance'] = closest_PA.apply(lambda x: haversine(centroid_long, centroid_lat, x['Centroid Longitude'], x['Centroid Latitude'] ), axis = 1)
-        
-        return closest_PA.sort_values('distance', ascending = True).head(num_of_closest)['Planning Area'].tolist()
+        # planning areas sorted by distance between centroids, from the precomputed neighbour table
+        return PlanningAreaNeighbours.of(area_centroids).closest(listing_PA, num_of_closest)
         
         
+    @timed('plot_psm')
     def plot_psm(self, historical_df, area_centroids, listing_PA, num_of_closest = 2):
         '''
         Parameters
-        - historical_df: Dataframe consisting of all historical transactions; preliminary dataset
-        - area_centroids: Dataframe consisting the coordinates of centroid for each planning area
+        - historical_df: Dataframe consisting of all historical transactions; preliminary dataset, or a PsfCube built over it once
+        - area_centroids: Dataframe consisting the coordinates of centroid for each planning area, or a PlanningAreaNeighbours built over it once
         - listing_PA: Planning Area of listing 
         - num_of_closest: N number of Planning Area closest to that of listing, default is 2.
         '''
@@ -263,16 +262,8 @@ class Sample:
         start_date = (datetime.datetime.now() - datetime.timedelta(days=time*365)).strftime('%Y-%m-%d')
         end_date = datetime.datetime.now().strftime('%Y-%m-%d')
         
-        # Convert Planning Area to Upper Case
-        historical_df['Planning Area'] = historical_df['Planning Area'].apply(lambda x: x.upper())
-        filtered_df = historical_df[(historical_df['Sale Date']>= start_date) & (historical_df['Sale Date']< end_date) & (historical_df['Property Type'].isin(property_type))& (historical_df['Planning Area'].isin(closest_PA))][['Sale Date', 'Planning Area','Unit Price ($ PSF)']]
-        #print(filtered_df['Sale Date'].dtypes)
-        #print(filtered_df['Planning Area'].unique())
-        
-        # Group data to find the mean PSF price
-        filtered_df['Sale Month'] = filtered_df['Sale Date'].apply(lambda x : x.strftime('%Y-%m')) # to plot based on Year and Month
-        filtered_df['Sale Year'] = filtered_df['Sale Date'].apply(lambda x : x.year) # to plot based on Year
-        grp_df = filtered_df.groupby(['Sale Month', 'Planning Area']).mean().reset_index()
+        # Mean PSF price by Year and Month of each planning area, summed from the precomputed cube (planning areas upper cased)
+        grp_df = PsfCube.of(historical_df).monthly(closest_PA, property_type, start_date, end_date)
         #print(grp_df['Planning Area'].unique())
         
         # plot timeseries 
@@ -6,13 +6,32 @@ To get info (train station name(s), nearest train station distance, train line(s
 import pandas as pd
 import numpy as np
 import datetime as datetime
+from dataclasses import dataclass
 from sklearn.neighbors import BallTree
+from scipy.spatial import cKDTree
+from pyproj import Transformer
 import geopandas as gp
 from shapely import wkt
 import os
+import logging
 import warnings
 warnings.filterwarnings("ignore")
 
+logger = logging.getLogger('valuation.amenities')
+EARTH_RADIUS = 6371000  # meters
+EARTH_RADIUS_KM = EARTH_RADIUS / 1000  # as in Sample.haversine
+SEARCH_MODES = ('haversine', 'svy21')
+# Amenity sets of up to BRUTE_FORCE_MAX[mode] rows queried with up to BRUTE_FORCE_POINTS points at a time are searched
+# by brute force instead of the tree; larger batches amortize the tree better. The cKDTree of the svy21 mode is
+# cheaper to query than the BallTree, so brute force stops paying off sooner. See benchmarks/brute_force_crossover.py
+BRUTE_FORCE_MAX = {'haversine': 64, 'svy21': 16}
+BRUTE_FORCE_POINTS = 1000
+BRUTE_FORCE_CHUNK = 4096
+
+# WGS84 longitude/latitude -> SVY21 easting/northing in metres
+_SVY21 = Transformer.from_crs('EPSG:4326', 'EPSG:3414', always_xy=True)
+
+
 def count_amenity(src_points, candidates, rad):
     """Find amenity being searched within the stated radius
     amenity: school, train station, police centre
@@ -23,7 +42,7 @@ def count_amenity(src_points, candidates, rad):
     # Get distance and index of nearest amenity
     dist, nearest_ind = tree.query(src_points, k=1)
 
-    dist = dist * 6371000
+    dist = dist * EARTH_RADIUS
     # Count number of amenity within radius
     count = tree.query_radius(src_points, r=rad, count_only=True)
     # Get indexes of all the amenity within radius
@@ -34,87 +53,436 @@ def count_amenity(src_points, candidates, rad):
     # Return the number of schools within the distance for each apartment wrt sale date
 
 
-def nearest_sch(property_geom, sch_gdf, dist=2000): # default distance is 2km
-    property_copy = pd.DataFrame(data = {'geometry':property_geom})
+class AmenityIndex:
+    """Search index over one amenity type (school, train station, police centre)
+    Geometry is parsed and the tree is built once, so each lookup only pays for the query itself.
+    Two search modes are available:
+    - 'haversine': BallTree on latitude/longitude radians, great-circle distances on a sphere of radius
+      EARTH_RADIUS, as the training features were computed; the default, and the one valuations use
+    - 'svy21': cKDTree on SVY21 (EPSG:3414) projected metres, Euclidean distances; faster for large batches,
+      but distances differ from haversine ones by up to ~0.56% (~80m at 10km, ~15m on average), so nearest
+      amenities and counts can differ near ties and the radius. See benchmarks/amenity_search_modes.py
+    Small candidate sets (police centres, planning area centroids) queried for a handful of properties skip the tree
+    and use a vectorized distance matrix, which gives nearest, count and in-radius positions at once; BRUTE_FORCE_MAX
+    sets what counts as small in each mode.
+    """
+    def __init__(self, amenity_df, name_col, leaf_size=15, mode='haversine', brute_force_max=None):
+        '''
+        :param amenity_df: dataframe of amenities with a WKT or shapely Point 'geometry' column
+        :param name_col: column holding the amenity name
+        :param leaf_size: leaf size of the tree
+        :param mode: 'haversine' or 'svy21'
+        :param brute_force_max: largest number of amenities searched by brute force, defaults to BRUTE_FORCE_MAX[mode]
+        '''
+        if mode not in SEARCH_MODES:
+            raise ValueError('mode must be one of {}'.format(SEARCH_MODES))
+        self.data = amenity_df.reset_index(drop=True)
+        self.name_col = name_col
+        self.leaf_size = leaf_size
+        self.mode = mode
+        self.brute_force_max = BRUTE_FORCE_MAX[mode] if brute_force_max is None else brute_force_max
+        geometry = self.data['geometry'].apply(lambda geom: wkt.loads(geom) if isinstance(geom, str) else geom)
+        self.lon = np.array([geom.x for geom in geometry], dtype=float)
+        self.lat = np.array([geom.y for geom in geometry], dtype=float)
+        self.names = self.data[name_col].astype(str).str.replace(u'\xa0', u' ').str.strip().values
+        self.candidates = self._points(self.lon, self.lat)
+        self._cos_lat = np.cos(self.lat * np.pi / 180)
+        self.tree = None
+        if len(self.data):
+            if mode == 'haversine':
+                self.tree = BallTree(self.candidates, leaf_size=leaf_size, metric='haversine')
+            else:
+                self.tree = cKDTree(self.candidates, leafsize=leaf_size)
+        self._subsets = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def _points(self, lon, lat):
+        if self.mode == 'haversine':
+            return to_radians(lon, lat)
+        return _to_svy21(lon, lat)
+
+    def _use_brute_force(self, lon):
+        return len(self.data) <= self.brute_force_max and len(np.atleast_1d(lon)) <= BRUTE_FORCE_POINTS
+
+    def _radius(self, dist):
+        # search radius in the units of the tree
+        if self.mode == 'haversine':
+            return dist / EARTH_RADIUS
+        return dist
+
+    def subset(self, mask):
+        '''
+        :param mask: boolean array over the amenity rows
+        :return: index over the selected rows only, built once per distinct mask
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        key = mask.tobytes()
+        if key not in self._subsets:
+            self._subsets[key] = AmenityIndex(self.data[mask], self.name_col, self.leaf_size, self.mode, self.brute_force_max)
+        return self._subsets[key]
+
+    def nearest(self, lon, lat):
+        '''
+        :return: distance in metres to and position of the nearest amenity for each point, NaN and -1 if the index is empty
+        '''
+        if len(self.data) == 0:
+            n = len(np.atleast_1d(lon))
+            return np.full(n, np.nan), np.full(n, -1)
+        if self._use_brute_force(lon):
+            count, nearest_dist, nearest_ind, all_ind = self._brute_force_query(lon, lat)
+            return nearest_dist, nearest_ind
+        dist, ind = self.tree.query(self._points(lon, lat), k=1)
+        if self.mode == 'haversine':
+            return dist.ravel() * EARTH_RADIUS, ind.ravel()
+        return dist, ind
+
+    def within(self, lon, lat, dist):
+        '''
+        :return: positions of all amenities within dist metres of each point
+        '''
+        if len(self.data) == 0:
+            return _object_array([np.array([], dtype=int) for _ in np.atleast_1d(lon)])
+        if self._use_brute_force(lon):
+            return self._brute_force_query(lon, lat, dist)[3]
+        if self.mode == 'haversine':
+            return self.tree.query_radius(self._points(lon, lat), r=self._radius(dist))
+        return _object_array([np.array(ind, dtype=int) for ind in self.tree.query_ball_point(self._points(lon, lat), r=dist)])
+
+    def count(self, lon, lat, dist):
+        '''
+        :return: number of amenities within dist metres of each point
+        '''
+        if len(self.data) == 0:
+            return np.zeros(len(np.atleast_1d(lon)), dtype=int)
+        if self._use_brute_force(lon):
+            return self._brute_force_query(lon, lat, dist)[0]
+        if self.mode == 'haversine':
+            return self.tree.query_radius(self._points(lon, lat), r=self._radius(dist), count_only=True)
+        return np.asarray(self.tree.query_ball_point(self._points(lon, lat), r=dist, return_length=True))
+
+    def query(self, lon, lat, dist):
+        '''
+        Same outputs as count_amenity, against the prebuilt tree
+        :return: count within radius, nearest distance (metres), nearest position, positions within radius
+        '''
+        if len(self.data) and self._use_brute_force(lon):
+            return self._brute_force_query(lon, lat, dist)
+        nearest_dist, nearest_ind = self.nearest(lon, lat)
+        all_ind = self.within(lon, lat, dist)
+        count = np.array([len(ind) for ind in all_ind])
+        return count, nearest_dist, nearest_ind, all_ind
+
+    def _distances(self, points):
+        # distance matrix in metres between query points and all amenities
+        if self.mode == 'haversine':
+            dlat = points[:, None, 0] - self.candidates[None, :, 0]
+            dlon = points[:, None, 1] - self.candidates[None, :, 1]
+            a = np.sin(dlat / 2) ** 2 + np.cos(points[:, 0])[:, None] * self._cos_lat * np.sin(dlon / 2) ** 2
+            return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS
+        return np.hypot(points[:, None, 0] - self.candidates[None, :, 0], points[:, None, 1] - self.candidates[None, :, 1])
+
+    def _brute_force_query(self, lon, lat, dist=None):
+        # nearest, count and in-radius positions all derived from one distance matrix, in chunks to bound memory
+        points = self._points(lon, lat)
+        n = len(points)
+        count = np.zeros(n, dtype=int)
+        nearest_dist = np.empty(n)
+        nearest_ind = np.empty(n, dtype=int)
+        all_ind = np.empty(n, dtype=object)
+        for start in range(0, n, BRUTE_FORCE_CHUNK):
+            rows = slice(start, start + BRUTE_FORCE_CHUNK)
+            distances = self._distances(points[rows])
+            nearest_ind[rows] = distances.argmin(axis=1)
+            nearest_dist[rows] = distances[np.arange(len(distances)), nearest_ind[rows]]
+            if dist is not None:
+                inside = distances <= dist
+                count[rows] = inside.sum(axis=1)
+                all_ind[rows] = _object_array(np.split(np.nonzero(inside)[1], np.cumsum(count[rows])[:-1]))
+        return count, nearest_dist, nearest_ind, all_ind
+
+    def features(self, lon, lat, dist, sets=None):
+        '''
+        Batch lookup for many properties at once
+        :param lon: array of property longitudes
+        :param lat: array of property latitudes
+        :param dist: search radius in metres
+        :param sets: dict of output column -> amenity column, collected as a set over all amenities within radius
+        :return: dataframe with one row per property: distance, nearest, count and one column per entry in sets
+        '''
+        count, nearest_dist, nearest_ind, all_ind = self.query(lon, lat, dist)
+        found = nearest_ind >= 0
+        nearest = np.full(len(nearest_ind), None, dtype=object)
+        nearest[found] = self.names[nearest_ind[found]]
+        result = pd.DataFrame({'distance': nearest_dist, 'nearest': nearest, 'count': count})
+        for out_col, col in (sets or {}).items():
+            values = self.data[col].values
+            result[out_col] = [set(values[ind]) for ind in all_ind]
+        return result
+
+
+class TemporalAmenityIndex:
+    """Amenity index answering queries as of a date
+    The open/close dates split time into epochs during which the set of open amenities does not change.
+    One AmenityIndex is built per distinct epoch up front, so any historical date maps to a prebuilt tree.
+    A date in an epoch with nothing open that follows one with amenities open, e.g. past every closing date when
+    the close dates of a dataset are its snapshot date, is answered from the latest such epoch (logged once when
+    the index is built). Before the first amenity opens there is nothing to fall back to, and distances are NaN.
+    """
+    def __init__(self, amenity_df, name_col, open_col, close_col, offset=None, leaf_size=15, mode='haversine', brute_force_max=None):
+        '''
+        :param amenity_df: dataframe of amenities with a 'geometry' column and open/close date columns
+        :param name_col: column holding the amenity name
+        :param open_col: column holding the date the amenity opens
+        :param close_col: column holding the date the amenity closes
+        :param offset: optional pd.DateOffset subtracted from both dates, e.g. to look forward in time
+        :param leaf_size: leaf size of the tree
+        :param mode: 'haversine' or 'svy21', see AmenityIndex
+        :param brute_force_max: largest number of amenities searched by brute force, see AmenityIndex
+        '''
+        self.base = AmenityIndex(amenity_df, name_col, leaf_size, mode, brute_force_max)
+        self.mode = mode
+        self.data = self.base.data
+        self.names = self.base.names
+        open_date = pd.to_datetime(self.data[open_col])
+        close_date = pd.to_datetime(self.data[close_col])
+        if offset is not None:
+            open_date = open_date - offset
+            close_date = close_date - offset
+        self.open_date = _to_datetime64(open_date)
+        self.close_date = _to_datetime64(close_date)
+
+        # An amenity is open on [open date, close date], so the set changes at each open date and the day after each close date
+        self.boundaries = np.unique(np.concatenate([self.open_date, self.close_date + np.timedelta64(1, 'D')]))
+        starts = np.concatenate([[self.boundaries[0] - np.timedelta64(1, 'D')], self.boundaries])
+        self.epochs = [self.base.subset(self.open_mask(start)) for start in starts]
+        # epoch answering each epoch's dates: itself, or the latest earlier one with amenities open if it has none
+        self.answered_by = np.arange(len(self.epochs))
+        latest = None
+        for e, epoch in enumerate(self.epochs):
+            if len(epoch) > 0:
+                latest = e
+            elif latest is not None:
+                self.answered_by[e] = latest
+        if len(self.epochs[-1]) == 0 and latest is not None:
+            logger.warning('No %s open from %s on, later dates use the %d open until then', name_col, self.boundaries[-1].astype('datetime64[D]'),
+                           len(self.epochs[latest]))
+
+    def __len__(self):
+        return len(self.data)
+
+    def open_mask(self, date):
+        date = _to_datetime64(date)[0]
+        return (self.open_date <= date) & (self.close_date >= date)
+
+    def epoch_of(self, dates):
+        '''
+        :return: position in self.epochs of the index that answers each date
+        '''
+        return self.answered_by[np.searchsorted(self.boundaries, _to_datetime64(dates), side='right')]
+
+    def as_of(self, date):
+        '''
+        :return: AmenityIndex over the amenities open on the date
+        '''
+        return self.epochs[self.epoch_of(date)[0]]
+
+    def features(self, lon, lat, dist, sets=None, as_of=None):
+        '''
+        Same as AmenityIndex.features, only counting amenities open as of each property's date
+        :param as_of: date or array of dates, one per property; defaults to now
+        :raises ValueError: if any date is missing, as no set of open amenities applies to it
+        '''
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        if len(lon) == 0:
+            columns = {'distance': np.array([], dtype=float), 'nearest': np.array([], dtype=object), 'count': np.array([], dtype=int)}
+            return pd.DataFrame(dict(columns, **{out_col: np.array([], dtype=object) for out_col in (sets or {})}))
+        if as_of is None:
+            as_of = pd.Timestamp.now()
+        dates = _to_datetime64(np.broadcast_to(as_of, lon.shape))
+        if np.isnat(dates).any():
+            raise ValueError('{} of {} dates are missing'.format(int(np.isnat(dates).sum()), len(dates)))
+        epoch = self.answered_by[np.searchsorted(self.boundaries, dates, side='right')]
+
+        # one part per epoch, put back in input order once all are done
+        parts = []
+        for e in np.unique(epoch):
+            rows = np.flatnonzero(epoch == e)
+            part = self.epochs[e].features(lon[rows], lat[rows], dist, sets)
+            part.index = rows
+            parts.append(part)
+        return pd.concat(parts).sort_index()
+
 
-    sch_copy = sch_gdf.copy().reset_index(drop=True)
-    sch_copy['geometry'] = sch_copy['geometry'].apply(wkt.loads)
-    sch_copy = gp.GeoDataFrame(sch_copy, geometry='geometry')
-    earth_radius = 6371000  # meters
-    radius = dist / earth_radius
+def _object_array(items):
+    # 1d object array of arrays, without numpy stacking equal-length items into 2d
+    result = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        result[i] = item
+    return result
 
-    property_geom_col = property_copy.geometry.name
-    sch_geom_col = sch_copy.geometry.name
 
-    property_copy['radians'] = property_copy[property_geom_col].apply(
-        lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
-    sch_copy['radians'] = sch_copy[sch_geom_col].apply(lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
+def _to_datetime64(dates):
+    return pd.to_datetime(pd.Series(np.atleast_1d(dates))).values.astype('datetime64[ns]')
 
+
+def to_radians(lon, lat):
+    '''
+    :return: (n, 2) array of latitude, longitude in radians, as BallTree's haversine metric expects
+    '''
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    return np.column_stack([lat * np.pi / 180, lon * np.pi / 180])
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    '''
+    Vectorized Sample.haversine
+    :return: distance in km between (lon1, lat1) and each of (lon2, lat2)
+    '''
+    lon1, lat1, lon2, lat2 = np.radians(lon1), np.radians(lat1), np.radians(lon2), np.radians(lat2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_KM
+
+
+def _to_svy21(lon, lat):
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    x, y = _SVY21.transform(lon, lat)
+    return np.column_stack([x, y])
+
+
+def _geom_coords(property_geom):
+    lon = [geom.x for geom in property_geom]
+    lat = [geom.y for geom in property_geom]
+    return lon, lat
+
+
+def _as_index(amenity, name_col):
+    # Accept either a prebuilt index or the raw amenity dataframe
+    if isinstance(amenity, (AmenityIndex, TemporalAmenityIndex)):
+        return amenity
+    return AmenityIndex(amenity, name_col)
+
+
+def _features(index, lon, lat, dist, sale_dates=None, sets=None):
+    # Only time-aware indexes take the sale dates into account
+    if isinstance(index, TemporalAmenityIndex):
+        return index.features(lon, lat, dist, sets, as_of=sale_dates)
+    return index.features(lon, lat, dist, sets)
+
+
+def school_index(sch_gdf, mode='haversine'):
     # Take school's opening date & closed date to be one year in advanced - forward looking
-    sch_copy['adv_open_date'] = pd.to_datetime(sch_copy['opening_date']).dt.date - pd.DateOffset(years=1)
-    sch_copy['adv_close_date'] = pd.to_datetime(sch_copy['closed_date']).dt.date - pd.DateOffset(years=1)
-    property_copy['Sale Date'] = pd.datetime.now()
+    return TemporalAmenityIndex(sch_gdf, 'Name', 'opening_date', 'closed_date', offset=pd.DateOffset(years=1), mode=mode)
 
-    results = property_copy.apply(lambda x: count_amenity([x['radians']], np.stack(
-        sch_copy[(sch_copy['adv_open_date'] <= x['Sale Date']) & (sch_copy['adv_close_date'] >= x['Sale Date'])][
-            'radians']), radius), axis=1)
 
-    count, nearest_dist, nearest_index, all_index = zip(*results)
+def police_centre_index(police_centre, mode='haversine'):
+    return AmenityIndex(police_centre, 'Police Centre', mode=mode)
 
-    index = nearest_index[0][0]
-    # get distance to the nearest school
-    nearest_dist = nearest_dist[0][0]
-    # only if need to get nearest school's name
-    nearest_pri_sch =  str(sch_copy.loc[index].Name.values[0])
-    return nearest_pri_sch, nearest_dist
 
-def nearest_police_centre(property_geom, police_centre, dist = 10000):
-    property_copy = pd.DataFrame(data = {'geometry':property_geom})
-    police_copy = police_centre.copy().reset_index(drop=True)
-    police_copy['geometry'] = police_copy['geometry'].apply(wkt.loads)
-    police_copy = gp.GeoDataFrame(police_copy, geometry='geometry')
-    earth_radius = 6371000  # meters
-    radius = dist / earth_radius
+def train_index(train_gdf, mode='haversine'):
+    return TemporalAmenityIndex(train_gdf, 'STN_NAME', 'OPEN_DATE', 'CLOSE_DATE', mode=mode)
 
-    property_geom_col = property_copy.geometry.name
-    police_copy_geom_col = police_copy.geometry.name
 
-    property_copy['radians'] = property_copy[property_geom_col].apply(
-        lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
-    police_copy['radians'] = police_copy[police_copy_geom_col].apply(lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
-    results = property_copy.apply(lambda x: count_amenity([x['radians']], np.stack(police_copy['radians']), radius), axis=1)
+def batch_nearest_sch(lon, lat, sch_gdf, sale_dates=None, dist=2000):
+    '''
+    :param lon: array of property longitudes
+    :param lat: array of property latitudes
+    :param sch_gdf: school dataframe or prebuilt school index
+    :param sale_dates: optional date or array of sale dates, only schools open as of each date are considered; defaults to now
+    :return: dataframe of nearest school distance, nearest school name and number of schools within radius
+    '''
+    if not isinstance(sch_gdf, (AmenityIndex, TemporalAmenityIndex)):
+        sch_gdf = school_index(sch_gdf)
+    return _features(sch_gdf, lon, lat, dist, sale_dates)
 
-    count, nearest_dist, nearest_index, all_index = zip(*results)
-    index = nearest_index[0][0]
-    nearest_centre = str(police_copy.iloc[index]['Police Centre'].values[0]).replace(u'\xa0', u' ').strip()
 
-    return nearest_dist, nearest_centre
+def batch_nearest_police_centre(lon, lat, police_centre, dist=10000):
+    '''
+    :param police_centre: police centre dataframe or prebuilt police centre AmenityIndex
+    :return: dataframe of nearest police centre distance, nearest police centre name and number of centres within radius
+    '''
+    return _as_index(police_centre, 'Police Centre').features(lon, lat, dist)
+
+
+def batch_nearest_train(lon, lat, train_gdf, sale_dates=None, dist=1000):
+    '''
+    :param train_gdf: train station dataframe or prebuilt train index
+    :param sale_dates: optional date or array of sale dates, only stations open as of each date are considered; defaults to now
+    :return: dataframe of nearest station distance, nearest station name, number of stations within radius,
+             and the sets of stations and lines within radius
+    '''
+    if not isinstance(train_gdf, (AmenityIndex, TemporalAmenityIndex)):
+        train_gdf = train_index(train_gdf)
+    return _features(train_gdf, lon, lat, dist, sale_dates, sets={'stations': 'STN_NAME', 'lines': 'COLOR'})
+
+
+@dataclass(frozen=True)
+class LocationFeatures:
+    """All amenity-derived features of one property"""
+    sch_name: str
+    sch_dist: float
+    police_centre: str
+    police_centre_dist: float
+    avg_cases: int
+    train_dist: float
+    train_stations: set
+    train_lines: set
+
+
+def location_features(lon, lat, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, sale_dates=None):
+    '''
+    Resolve every amenity-derived feature for many properties in a single pass
+    :param lon: array of property longitudes
+    :param lat: array of property latitudes
+    :param sch_gdf: school dataframe or prebuilt school index
+    :param train_gdf: train station dataframe or prebuilt train index
+    :param police_centre: police centre dataframe or prebuilt police centre index
+    :param avg_cases_by_npc: dataframe of average cases per year by police centre
+    :param sale_dates: optional date or array of sale dates for schools and stations; defaults to now
+    :return: dataframe with one row per property and one column per LocationFeatures field
+    '''
+    sch = batch_nearest_sch(lon, lat, sch_gdf, sale_dates)
+    train = batch_nearest_train(lon, lat, train_gdf, sale_dates)
+    police = batch_nearest_police_centre(lon, lat, police_centre)
+    cases = dict(zip(avg_cases_by_npc['Police Centre'].astype(str).str.strip(), avg_cases_by_npc['Average Cases Per Year']))
+    return pd.DataFrame({'sch_name': sch['nearest'].values,
+                         'sch_dist': sch['distance'].values,
+                         'police_centre': police['nearest'].values,
+                         'police_centre_dist': police['distance'].values,
+                         'avg_cases': police['nearest'].map(cases).values,
+                         'train_dist': train['distance'].values,
+                         'train_stations': train['stations'].values,
+                         'train_lines': train['lines'].values})
+
+
+def resolve_location_features(lon, lat, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, sale_date=None):
+    '''
+    :return: LocationFeatures of the property at (lon, lat)
+    '''
+    features = location_features([lon], [lat], sch_gdf, train_gdf, police_centre, avg_cases_by_npc, sale_date).iloc[0].to_dict()
+    if not pd.isnull(features['avg_cases']):
+        features['avg_cases'] = int(features['avg_cases'])
+    return LocationFeatures(**features)
+
+
+def nearest_sch(property_geom, sch_gdf, dist=2000): # default distance is 2km
+    lon, lat = _geom_coords(property_geom)
+    result = batch_nearest_sch(lon, lat, sch_gdf, dist=dist).iloc[0]
+    return result['nearest'], result['distance']
+
+def nearest_police_centre(property_geom, police_centre, dist = 10000):
+    lon, lat = _geom_coords(property_geom)
+    result = batch_nearest_police_centre(lon, lat, police_centre, dist).iloc[0]
+    return result['distance'], result['nearest']
 
 def nearest_train(property_geom, train_gdf, dist = 1000):
-    property_copy = pd.DataFrame(data={'geometry': property_geom})
-    train_gdf_copy = train_gdf.copy().reset_index(drop=True)
-    train_gdf_copy['geometry'] = train_gdf_copy['geometry'].apply(wkt.loads)
-    earth_radius = 6371000  # meters
-    radius = dist / earth_radius
-
-    property_geom_col = property_copy.geometry.name
-    train_gdf_copy_geom_col = train_gdf_copy.geometry.name
-
-    property_copy['radians'] = property_copy[property_geom_col].apply(
-        lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
-    train_gdf_copy['radians'] = train_gdf_copy[train_gdf_copy_geom_col].apply(lambda geom: [geom.y * np.pi / 180, geom.x * np.pi / 180])
-    results = property_copy.apply(lambda x: count_amenity([x['radians']], np.stack(train_gdf_copy['radians']), radius), axis=1)
-    count, nearest_dist, nearest_index, all_index = zip(*results)
-
-    index = nearest_index[0][0]
-    all_index = np.hstack(all_index).squeeze().tolist()
-    # all lines within radius
-    lines = set(train_gdf_copy.iloc[all_index]['COLOR'].values)
-    # all stations within radius
-    stations = set(train_gdf_copy.iloc[all_index]['STN_NAME'].values)
-    nearest_dist = nearest_dist[0][0]
-
-    return nearest_dist, lines, stations
+    lon, lat = _geom_coords(property_geom)
+    result = batch_nearest_train(lon, lat, train_gdf, dist=dist).iloc[0]
+    return result['distance'], result['lines'], result['stations']
 
 '''
 #Testing
@@ -0,0 +1,69 @@
+'''
+Benchmark and accuracy report of the 'svy21' (projected KD-tree) amenity search mode against the 'haversine' (BallTree) mode
+Most of the distance difference comes from the haversine path treating the earth as a sphere of radius 6371km,
+(up to ~0.6% of the distance near the equator), so mismatches are limited to near-ties and amenities close to the radius.
+Run from the repository root:
+    python -m benchmarks.amenity_search_modes
+'''
+import time
+import numpy as np
+import pandas as pd
+from amenities import AmenityIndex, _to_svy21
+
+path = 'datasets/'
+# Rough extent of Singapore
+LON_RANGE = (103.60, 104.05)
+LAT_RANGE = (1.22, 1.47)
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(*LON_RANGE, n), rng.uniform(*LAT_RANGE, n)
+
+
+def best_of(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare(amenity_df, name_col, dist, sizes=(1, 100, 10000, 100000)):
+    haversine = AmenityIndex(amenity_df, name_col, mode='haversine')
+    svy21 = AmenityIndex(amenity_df, name_col, mode='svy21')
+    rows = []
+    for n in sizes:
+        lon, lat = random_points(n)
+        h_dist, h_ind = haversine.nearest(lon, lat)
+        s_dist, s_ind = svy21.nearest(lon, lat)
+        h_count = haversine.count(lon, lat, dist)
+        s_count = svy21.count(lon, lat, dist)
+        rows.append({'points': n,
+                     'haversine (s)': best_of(lambda: haversine.query(lon, lat, dist)),
+                     'svy21 (s)': best_of(lambda: svy21.query(lon, lat, dist)),
+                     'max dist error (m)': np.abs(h_dist - s_dist).max(),
+                     'mean dist error (m)': np.abs(h_dist - s_dist).mean(),
+                     'max rel error (%)': 100 * (np.abs(h_dist - s_dist) / h_dist).max(),
+                     'nearest mismatches': int((h_ind != s_ind).sum()),
+                     'count mismatches': int((h_count != s_count).sum())})
+    report = pd.DataFrame(rows)
+    report['speedup'] = report['haversine (s)'] / report['svy21 (s)']
+    return report
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    train = pd.read_csv(path + 'train_gdf.csv')
+    amenities = {'train stations (1km)': (train, 'STN_NAME', 1000),
+                 'schools (2km)': (pd.read_csv(path + 'primary_sch_gdf.csv'), 'Name', 2000),
+                 'police centres (10km)': (pd.read_csv(path + 'police_centre_gdf.csv'), 'Police Centre', 10000)}
+    for label, (df, name_col, dist) in amenities.items():
+        print('\n' + label)
+        print(compare(df, name_col, dist).to_string(index=False))
+
+    # The train dataset ships its own SVY21 coordinates, a check on the projection itself
+    xy = _to_svy21(train['Longitude'], train['Latitude'])
+    offset = np.hypot(xy[:, 0] - train['X'], xy[:, 1] - train['Y'])
+    print('\nprojection vs train_gdf X/Y: max {:.2f} m, median {:.2f} m'.format(offset.max(), np.median(offset)))
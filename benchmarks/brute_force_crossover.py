@@ -0,0 +1,52 @@
+'''
+Microbenchmark of the brute-force distance-matrix search against the tree search in AmenityIndex,
+to pick BRUTE_FORCE_MAX and BRUTE_FORCE_POINTS. Candidate sets are sampled within Singapore at the sizes of our datasets
+(31 police centres, 55 planning area centroids, ~180 schools and stations) and beyond.
+Run from the repository root:
+    python -m benchmarks.brute_force_crossover
+'''
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+import amenities
+from amenities import AmenityIndex
+from benchmarks.amenity_search_modes import random_points, best_of
+
+CANDIDATE_SIZES = (8, 16, 31, 55, 64, 128, 181, 256, 512, 1024)
+QUERY_SIZES = (1, 100, 10000)
+
+
+def candidates(n, seed=1):
+    lon, lat = random_points(n, seed)
+    return pd.DataFrame({'name': np.arange(n).astype(str), 'geometry': [Point(x, y) for x, y in zip(lon, lat)]})
+
+
+def crossover(mode='haversine', dist=1000):
+    # force the brute-force path for every batch size so both paths are timed
+    amenities.BRUTE_FORCE_POINTS = max(QUERY_SIZES)
+    rows = []
+    for n in CANDIDATE_SIZES:
+        df = candidates(n)
+        tree = AmenityIndex(df, 'name', mode=mode, brute_force_max=0)
+        brute = AmenityIndex(df, 'name', mode=mode, brute_force_max=n)
+        for m in QUERY_SIZES:
+            lon, lat = random_points(m, seed=2)
+            rows.append({'candidates': n,
+                         'points': m,
+                         'tree (ms)': 1000 * best_of(lambda: tree.query(lon, lat, dist), repeat=5),
+                         'brute force (ms)': 1000 * best_of(lambda: brute.query(lon, lat, dist), repeat=5)})
+    report = pd.DataFrame(rows)
+    report['brute force faster'] = report['brute force (ms)'] < report['tree (ms)']
+    return report
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    for mode in ('haversine', 'svy21'):
+        print('\n' + mode)
+        print(crossover(mode).to_string(index=False))
+
+# Results on the development machine (ms, haversine): brute force wins for every candidate set size with a single
+# point (~0.08 vs ~0.4), up to ~128 candidates with 100 points, and loses to the tree for all sizes at 10,000 points.
+# In svy21 mode the cKDTree is cheap enough that brute force only wins for single points and sets of up to ~16 at 100 points.
+# Hence BRUTE_FORCE_MAX of 64 for haversine (our datasets: police centres and planning area centroids) and 16 for svy21.
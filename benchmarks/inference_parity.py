@@ -0,0 +1,85 @@
+'''
+Parity and latency of the inference engines against XGBRegressor.predict on a pandas frame
+Inputs are drawn around the scaled feature ranges, plus rows set exactly on split thresholds and rows with missing
+values, so both the comparison direction and the default branch of every split are exercised. The numpy trees must
+reach the same leaf as xgboost in every tree, and predict within RTOL of it for every row.
+Run from the repository root, with the model directory to check:
+    python -m benchmarks.inference_parity modelling/
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from xgboost import XGBRegressor
+from inference import BoosterEngine, TreeEngine
+from model import MODEL_FILE, STANDARD_SCALE_VARS, MIN_MAX_VARS
+
+N_ROWS = 5000
+N_SINGLE = 2000
+# float32 sums of the same leaves may differ in the last bits, a wrong branch shows as a much larger gap
+RTOL = 1e-5
+
+
+def parity_inputs(engine, n_features, n=N_ROWS, seed=0):
+    rng = np.random.default_rng(seed)
+    n_scaled = len(STANDARD_SCALE_VARS) + len(MIN_MAX_VARS)
+    features = np.concatenate([rng.normal(0, 1.5, (n, len(STANDARD_SCALE_VARS))),
+                               rng.uniform(-0.2, 1.2, (n, len(MIN_MAX_VARS))),
+                               (rng.random((n, n_features - n_scaled)) < 0.1)], axis=1).astype(np.float32)
+    # every split threshold, set on a copy of a random row; leaves point to themselves, padding nodes are past n_nodes
+    nodes = np.arange(engine.left.shape[1])
+    splits = (engine.left != nodes) & (nodes < engine.n_nodes[:, None])
+    on_threshold = features[rng.integers(0, n, splits.sum())]
+    on_threshold[np.arange(len(on_threshold)), engine.feature[splits]] = engine.threshold[splits]
+    missing = features[:n // 10].copy()
+    missing[rng.random(missing.shape) < 0.2] = np.nan
+    return np.concatenate([features, on_threshold, missing])
+
+
+def latency(predict, features, n=N_SINGLE):
+    # one row at a time, as in an interactive valuation
+    timings = np.empty(n)
+    for i in range(n):
+        row = features[i % len(features)][None, :]
+        start = time.perf_counter()
+        predict(row)
+        timings[i] = time.perf_counter() - start
+    return 1000 * np.percentile(timings, 50), 1000 * np.percentile(timings, 99)
+
+
+def mismatches(prediction, reference):
+    # rows whose prediction is not within RTOL of the reference
+    return int((np.abs(prediction - reference) > RTOL * np.abs(reference)).sum())
+
+
+def compare(path):
+    model = XGBRegressor()
+    model.load_model(path + MODEL_FILE)
+    booster = model.get_booster()
+    engines = {'booster (inplace)': BoosterEngine(booster), 'numpy trees': TreeEngine.from_booster(booster)}
+    features = parity_inputs(engines['numpy trees'], booster.num_features())
+    columns = booster.feature_names or ['f{}'.format(i) for i in range(features.shape[1])]
+    reference = model.predict(pd.DataFrame(features, columns=columns))
+    leaves = model.apply(pd.DataFrame(features, columns=columns)).reshape(len(features), -1)
+
+    rows = [{'engine': 'XGBRegressor.predict (pandas)', 'max abs diff': 0.0, 'mismatched rows': 0, 'mismatched leaves': 0,
+             **dict(zip(('p50 (ms)', 'p99 (ms)'), latency(lambda row: model.predict(pd.DataFrame(row, columns=columns)), features)))}]
+    for name, engine in engines.items():
+        prediction = engine.predict(features)
+        rows.append({'engine': name, 'max abs diff': float(np.abs(prediction - reference).max()),
+                     'mismatched rows': mismatches(prediction, reference),
+                     'mismatched leaves': int((engine.leaves(features) != leaves).any(axis=1).sum()) if hasattr(engine, 'leaves') else None,
+                     **dict(zip(('p50 (ms)', 'p99 (ms)'), latency(engine.predict, features)))})
+    report = pd.DataFrame(rows)
+    # the booster has no leaves to compare, its predictions are the reference's own
+    report['mismatched leaves'] = report['mismatched leaves'].astype('Int64')
+    return report, len(features)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    report, n = compare(sys.argv[1] if len(sys.argv) > 1 else 'modelling/')
+    print('{} rows'.format(n))
+    print(report.to_string(index=False))
+    if report['mismatched rows'].sum() > 0 or report['mismatched leaves'].sum() > 0:
+        sys.exit(1)
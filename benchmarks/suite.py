@@ -0,0 +1,371 @@
+'''
+Latency and throughput benchmarks of the valuation app on synthetic data (see benchmarks/synthetic.py)
+Covers amenity lookups, Listing.pred_price, value_listings, and Sample.get_filtered_df, get_map and plot_psm over
+transactions scaled to any size. OneMap is replaced by a local StubOneMapServer, and the model by a synthetic one of
+about the production size unless modelling/ has the real one (model_xgboost.bin and datasets/modelling_dataset.csv).
+Results are saved as benchmarks/results/<commit>.json, to compare runs across commits.
+Run from the repository root:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --rows 100000 -k pred_price -k amenity
+    python -m benchmarks.suite --compare benchmarks/results/<before>.json benchmarks/results/<after>.json
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import cached_property
+import numpy as np
+import pandas as pd
+from amenities import location_features, school_index, train_index, police_centre_index
+from benchmarks.amenity_search_modes import random_points
+from benchmarks.synthetic import SyntheticData
+from features import FeatureTable
+from geocoding import GeocodingClient
+from listing import Listing
+from location import PlanningAreaNeighbours, PostalCodeIndex
+from model import ModelRegistry, MODEL_FILE
+from onemap_stub import StubOneMapServer
+from Sample import Sample
+from transactions import TransactionIndex, TransactionStore, PsfCube
+from valuation import value_listings
+
+path = 'datasets/'
+RESULTS_PATH = 'benchmarks/results/'
+# widest filters of the app: 2km radius, past 10 years, every property type
+SAMPLE_PARAMS = {'radius': [1, 1], 'time': [1, 1], 'property': [1, 1, 1]}
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    '''
+    Register a benchmark, a function of an Environment returning (run, items): run(i) does the i-th call and
+    items is the number of listings, points or transactions each call handles
+    '''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+class Environment:
+    """Data, indexes, model and OneMap stub shared by the benchmarks, each built on first use"""
+    def __init__(self, rows, points, model_path=None, seed=0):
+        '''
+        :param rows: number of synthetic transactions
+        :param points: number of points of batch amenity lookups
+        :param model_path: model directory, the real model in modelling/ if there is one, else a synthetic one if None
+        '''
+        self.rows = rows
+        self.points = points
+        self.model_path = model_path
+        self.data = SyntheticData(path, seed)
+        self.tmp = tempfile.mkdtemp(prefix='benchmarks-')
+        self._stub = None
+
+    @cached_property
+    def sch(self):
+        return school_index(pd.read_csv(path + 'primary_sch_gdf.csv'))
+
+    @cached_property
+    def train(self):
+        return train_index(pd.read_csv(path + 'train_gdf.csv'))
+
+    @cached_property
+    def police_centre(self):
+        return police_centre_index(pd.read_csv(path + 'police_centre_gdf.csv'))
+
+    @cached_property
+    def avg_cases(self):
+        return pd.read_csv(path + 'average_cases_by_npc.csv')
+
+    @cached_property
+    def postal_index(self):
+        return PostalCodeIndex(self.data.historical_postal_code_area)
+
+    @cached_property
+    def feature_table(self):
+        return FeatureTable.build(self.data.historical_postal_code_area, self.sch, self.train, self.police_centre, self.avg_cases)
+
+    @cached_property
+    def buildings(self):
+        return self.data.buildings(max(1, self.rows // 200))
+
+    @cached_property
+    def transactions(self):
+        return self.data.transactions(self.rows, self.buildings)
+
+    @cached_property
+    def transaction_store(self):
+        return TransactionStore(self.transactions, TransactionIndex(self.transactions))
+
+    @cached_property
+    def psf_cube(self):
+        return PsfCube(self.transactions)
+
+    @cached_property
+    def listings(self):
+        return self.data.listings(2000, self.buildings)
+
+    @cached_property
+    def model(self):
+        '''
+        :return: model directory and main_df_col
+        '''
+        if self.model_path is None and os.path.exists('modelling/' + MODEL_FILE) and os.path.exists(path + 'modelling_dataset.csv'):
+            self.model_path = 'modelling/'
+        if self.model_path is not None:
+            return self.model_path, list(pd.read_csv(path + 'modelling_dataset.csv', nrows=0).columns)
+        model_path = os.path.join(self.tmp, 'model/')
+        return model_path, self.data.model(model_path)
+
+    @cached_property
+    def registry(self):
+        return ModelRegistry(self.model[0])
+
+    @property
+    def geocoder_url(self):
+        # OneMap stand-in answering for the synthetic buildings, whose postal codes are not in our dataset
+        if self._stub is None:
+            self._stub = StubOneMapServer(self.buildings)
+            self._stub.start()
+        return self._stub.url
+
+    @cached_property
+    def client(self):
+        # without a geocode cache, so every lookup goes to the stub
+        return GeocodingClient(base_url=self.geocoder_url)
+
+    def close(self):
+        if 'client' in self.__dict__:
+            self.client.close()
+        if self._stub is not None:
+            self._stub.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+@benchmark
+def amenity_features_single(env):
+    lon, lat = random_points(1000, seed=1)
+    return (lambda i: location_features(lon[i % 1000:i % 1000 + 1], lat[i % 1000:i % 1000 + 1],
+                                        env.sch, env.train, env.police_centre, env.avg_cases)), 1
+
+
+@benchmark
+def amenity_features_batch(env):
+    lon, lat = random_points(env.points, seed=2)
+    return (lambda i: location_features(lon, lat, env.sch, env.train, env.police_centre, env.avg_cases)), env.points
+
+
+def _pred_price(env, codes, feature_table=None, client=None):
+    model_path, main_df_col = env.model
+    listings = env.listings.assign(**{'Postal Code': codes}).to_dict('records')
+
+    def run(i):
+        row = listings[i % len(listings)]
+        unit = Listing(row['Postal Code'], row['Property Type'], row['Floor Number'], row['Floor Area'], row['Remaining Lease'],
+                       client=client)
+        return unit.pred_price(model_path, main_df_col, env.postal_index, env.data.area_index, env.sch, env.train,
+                               env.police_centre, env.avg_cases, feature_table, env.registry)
+    return run, 1
+
+
+@benchmark
+def pred_price_known(env):
+    # postal codes in our dataset, amenity features searched for each listing
+    return _pred_price(env, env.data.listings(len(env.listings), known=1)['Postal Code'].values)
+
+
+@benchmark
+def pred_price_feature_table(env):
+    # postal codes in our dataset, amenity features read from the precomputed table
+    return _pred_price(env, env.data.listings(len(env.listings), known=1)['Postal Code'].values, env.feature_table)
+
+
+@benchmark
+def pred_price_onemap(env):
+    # postal codes only OneMap knows of, located through the stub
+    return _pred_price(env, env.data.listings(len(env.listings), env.buildings, known=0)['Postal Code'].values,
+                       client=env.client)
+
+
+@benchmark
+def value_listings_batch(env):
+    # half the postal codes in our dataset, half located through the stub
+    model_path, main_df_col = env.model
+    return (lambda i: value_listings(env.listings, main_df_col, env.postal_index, env.data.area_index, env.sch, env.train,
+                                     env.police_centre, env.avg_cases, registry=env.registry, client=env.client)), len(env.listings)
+
+
+def _listing_point(env):
+    # where the synthetic transactions are, so the filters and map have something to show
+    first = env.transactions.iloc[0]
+    return first['LONGITUDE'], first['LATITUDE'], first['Planning Area']
+
+
+@benchmark
+def sample_filter(env):
+    lon, lat, area = _listing_point(env)
+    return (lambda i: Sample(SAMPLE_PARAMS, env.transactions).get_filtered_df(env.transaction_store, lon, lat)), env.rows
+
+
+@benchmark
+def sample_map(env):
+    lon, lat, area = _listing_point(env)
+    sample = Sample(SAMPLE_PARAMS, env.transactions)
+    sample.get_filtered_df(env.transaction_store, lon, lat)
+
+    def run(i):
+        # get_map writes sample_map.html to the working directory
+        cwd = os.getcwd()
+        os.chdir(env.tmp)
+        try:
+            sample.get_map(lon, lat, 1000, 'LISTING', 'ADDRESS', 100)
+        finally:
+            os.chdir(cwd)
+    return run, 1
+
+
+@benchmark
+def plot_psm(env):
+    lon, lat, area = _listing_point(env)
+    area_centroids = PlanningAreaNeighbours(env.data.area_centroids)
+    return (lambda i: Sample(SAMPLE_PARAMS, env.transactions).plot_psm(env.psf_cube, area_centroids, area, 2)), env.rows
+
+
+def measure(run, items, min_time=2.0, min_calls=5, max_calls=1000):
+    '''
+    Call run(i) once to warm up, then until both min_time seconds and min_calls calls have passed
+    :return: dict of latency statistics in ms, and throughput in items per second at the median latency
+    '''
+    run(0)
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_calls and (len(timings) < min_calls or time.perf_counter() - start < min_time):
+        call_start = time.perf_counter()
+        run(len(timings) + 1)
+        timings.append(time.perf_counter() - call_start)
+    timings = np.array(timings)
+    return {'calls': len(timings),
+            'items': items,
+            'mean_ms': 1000 * float(timings.mean()),
+            'min_ms': 1000 * float(timings.min()),
+            'p50_ms': 1000 * float(np.percentile(timings, 50)),
+            'p99_ms': 1000 * float(np.percentile(timings, 99)),
+            'throughput': items / float(np.median(timings))}
+
+
+def run_suite(env, names, min_time=2.0, min_calls=5):
+    results = {}
+    for name in names:
+        try:
+            run, items = BENCHMARKS[name](env)
+            results[name] = measure(run, items, min_time, min_calls)
+        except Exception as e:
+            # recorded, so one broken benchmark does not lose the others
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print('{:<26} failed, {}'.format(name, results[name]['error']), flush=True)
+            continue
+        print('{:<26} p50 {:>10.3f} ms   p99 {:>10.3f} ms   {:>12.1f} items/s'.format(
+            name, results[name]['p50_ms'], results[name]['p99_ms'], results[name]['throughput']), flush=True)
+    return results
+
+
+def environment_info():
+    '''
+    :return: commit, whether the tree had uncommitted changes, and the versions the results depend on
+    '''
+    def git(*args):
+        try:
+            return subprocess.run(('git',) + args, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    import sklearn
+    import xgboost
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', '--short', 'HEAD'),
+            'dirty': bool(status),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+            'xgboost': xgboost.__version__}
+
+
+def save(report, results_path=RESULTS_PATH):
+    '''
+    :return: path of the results file, named after the commit (and -dirty if the tree had uncommitted changes)
+    '''
+    os.makedirs(results_path, exist_ok=True)
+    info = report['environment']
+    file = os.path.join(results_path, '{}{}.json'.format(info['commit'] or 'unknown', '-dirty' if info['dirty'] else ''))
+    with open(file, 'w') as f:
+        json.dump(report, f, indent=2)
+    return file
+
+
+def compare(before, after):
+    '''
+    :param before, after: paths of two results files
+    :return: dataframe of the p50 latency and throughput of each benchmark in both runs
+    '''
+    runs = []
+    for file in (before, after):
+        with open(file) as f:
+            runs.append(json.load(f))
+    for key in ('rows', 'points'):
+        if runs[0]['config'][key] != runs[1]['config'][key]:
+            print('warning: {} differ ({} vs {})'.format(key, runs[0]['config'][key], runs[1]['config'][key]))
+    rows = []
+    for name in runs[0]['results']:
+        if 'p50_ms' not in runs[0]['results'][name] or 'p50_ms' not in runs[1]['results'].get(name, {}):
+            continue
+        a, b = runs[0]['results'][name], runs[1]['results'][name]
+        rows.append({'benchmark': name,
+                     'p50 before (ms)': a['p50_ms'],
+                     'p50 after (ms)': b['p50_ms'],
+                     'p99 before (ms)': a['p99_ms'],
+                     'p99 after (ms)': b['p99_ms'],
+                     'speedup': a['p50_ms'] / b['p50_ms']})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Valuation app benchmarks on synthetic data')
+    parser.add_argument('--rows', type=int, default=1000000, help='synthetic transactions')
+    parser.add_argument('--points', type=int, default=100000, help='points of the batch amenity lookup')
+    parser.add_argument('--model', default=None, help='model directory, the real or else a synthetic model by default')
+    parser.add_argument('-k', dest='select', action='append', default=None, help='only benchmarks whose name contains this')
+    parser.add_argument('--min-time', type=float, default=2.0, help='seconds to run each benchmark for, at least')
+    parser.add_argument('--min-calls', type=int, default=5, help='calls of each benchmark, at least')
+    parser.add_argument('--results', default=RESULTS_PATH)
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results files and exit')
+    args = parser.parse_args()
+    pd.set_option('display.width', 200)
+
+    if args.compare:
+        print(compare(*args.compare).to_string(index=False))
+        sys.exit(0)
+
+    names = [name for name in BENCHMARKS if args.select is None or any(select in name for select in args.select)]
+    env = Environment(args.rows, args.points, args.model)
+    try:
+        results = run_suite(env, names, args.min_time, args.min_calls)
+        report = {'environment': environment_info(),
+                  'config': {'rows': args.rows, 'points': args.points, 'model': env.model_path or 'synthetic',
+                             'model_version': env.registry.version if 'registry' in env.__dict__ else None,
+                             'min_time': args.min_time, 'min_calls': args.min_calls},
+                  'results': results}
+    finally:
+        env.close()
+    if not args.no_save:
+        print('Saved {}'.format(save(report, args.results)))
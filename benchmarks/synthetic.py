@@ -0,0 +1,172 @@
+'''
+Synthetic transactions, listings and model at any scale, for benchmarks without the full datasets or network access
+Buildings are scattered around the known postal codes of historical_postal_code_area.csv, so every point lies within
+Singapore and falls in a real planning area; their postal codes are new ones in the same postal sector, answered by
+a StubOneMapServer rather than our own dataset.
+Write a dataset to disk with:
+    python -m benchmarks.synthetic 1000000 synthetic/
+'''
+import os
+import sys
+import datetime
+import numpy as np
+import pandas as pd
+from benchmarks.amenity_search_modes import LON_RANGE, LAT_RANGE
+from geocoding import normalize_postal_code
+from location import PlanningAreaIndex
+from model import STANDARD_SCALE_VARS, MIN_MAX_VARS, STANDARD_SCALER_FILE, MM_SCALER_FILE, MODEL_FILE, PPI, SQFT_PER_SQM
+
+path = 'datasets/'
+PROPERTY_TYPES = ['Apartment', 'Condominium', 'Executive Condominium']
+# transactions per building on average, about what the preliminary dataset has
+TRANSACTIONS_PER_BUILDING = 200
+YEARS = 12
+# ~300m around the known postal code a building is placed next to
+JITTER = 0.003
+
+
+class SyntheticData:
+    """Reference datasets read once, and the generators drawing from them"""
+    def __init__(self, path=path, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.historical_postal_code_area = pd.read_csv(path + 'historical_postal_code_area.csv')
+        self.historical_postal_code_area['Postal Code'] = self.historical_postal_code_area['Postal Code'].apply(normalize_postal_code)
+        self.area_centroids = pd.read_csv(path + 'area_centroid.csv')
+        self.area_index = PlanningAreaIndex(self.area_centroids)
+        self.train_lines = sorted(pd.read_csv(path + 'train_gdf.csv')['COLOR'].unique())
+
+    def buildings(self, n):
+        '''
+        :return: dataframe of n buildings, with the columns of historical_postal_code_area.csv plus BUILDING and address_trunc
+        '''
+        known = self.historical_postal_code_area
+        base = known.iloc[self.rng.integers(0, len(known), n)]
+        lon = np.clip(base['LONGITUDE'].values + self.rng.normal(0, JITTER, n), *LON_RANGE)
+        lat = np.clip(base['LATITUDE'].values + self.rng.normal(0, JITTER, n), *LAT_RANGE)
+        areas, regions = self.area_index.lookup(lon, lat)
+        codes = self._postal_codes(base['Postal Code'].str[:2].values, set(known['Postal Code']))
+        streets = self.rng.integers(1, 400, n)
+        return pd.DataFrame({'Postal Code': codes,
+                             'Planning Region': regions,
+                             'Planning Area': areas,
+                             'LONGITUDE': lon,
+                             'LATITUDE': lat,
+                             'BUILDING': ['SYNTHETIC RESIDENCES {}'.format(code) for code in codes],
+                             'address_trunc': ['{} SYNTHETIC STREET {}'.format(block, street) for block, street in
+                                               zip(self.rng.integers(1, 200, n), streets)]})
+
+    def _postal_codes(self, sectors, taken):
+        # unique codes in each building's postal sector, none of them in our dataset
+        codes = []
+        taken = set(taken)
+        for sector in sectors:
+            while True:
+                code = '{}{:04d}'.format(sector, self.rng.integers(0, 10000))
+                if code not in taken:
+                    taken.add(code)
+                    codes.append(code)
+                    break
+        return codes
+
+    def transactions(self, n, buildings=None):
+        '''
+        :param buildings: dataframe from buildings(), n / TRANSACTIONS_PER_BUILDING new ones if None
+        :return: dataframe of n resale transactions with the columns of preliminary_dataset.csv that the app uses,
+                 'Sale Date' parsed and spread over the past YEARS years
+        '''
+        if buildings is None:
+            buildings = self.buildings(max(1, n // TRANSACTIONS_PER_BUILDING))
+        rows = buildings.iloc[self.rng.integers(0, len(buildings), n)].reset_index(drop=True)
+        today = pd.Timestamp(datetime.date.today())
+        days = self.rng.integers(0, YEARS * 365, n)
+        area_sqft = np.round(self.rng.lognormal(np.log(1000), 0.35, n)).astype(int)
+        psf = np.round(self.rng.normal(1300, 350, n).clip(300)).astype(int)
+        return pd.DataFrame({'Sale Date': today - pd.to_timedelta(days, unit='D'),
+                             'Postal Code': rows['Postal Code'].values,
+                             'Property Type': np.array(PROPERTY_TYPES, dtype=object)[self.rng.integers(0, len(PROPERTY_TYPES), n)],
+                             'Planning Area': rows['Planning Area'].values,
+                             'LONGITUDE': rows['LONGITUDE'].values,
+                             'LATITUDE': rows['LATITUDE'].values,
+                             'BUILDING': rows['BUILDING'].values,
+                             'address_trunc': rows['address_trunc'].values,
+                             'Address': rows['address_trunc'].values,
+                             'Floor Number': self.rng.integers(1, 40, n),
+                             'Area (SQFT)': area_sqft,
+                             'Remaining Lease': self.rng.integers(40, 99, n),
+                             'Unit Price ($ PSF)': psf,
+                             'PPI': np.round(PPI + self.rng.normal(0, 10, n), 1)})
+
+    def listings(self, n, buildings=None, known=0.5):
+        '''
+        :param buildings: dataframe from buildings() whose postal codes are only known to the OneMap stub
+        :param known: share of listings with a postal code in historical_postal_code_area.csv
+        :return: dataframe of n listings with the columns of valuation.LISTING_COLUMNS
+        '''
+        in_dataset = self.rng.random(n) < known if buildings is not None else np.ones(n, dtype=bool)
+        codes = self.historical_postal_code_area['Postal Code'].values[self.rng.integers(0, len(self.historical_postal_code_area), n)]
+        if buildings is not None:
+            codes = np.where(in_dataset, codes, buildings['Postal Code'].values[self.rng.integers(0, len(buildings), n)])
+        return pd.DataFrame({'Postal Code': codes,
+                             'Property Type': np.array(PROPERTY_TYPES, dtype=object)[self.rng.integers(0, len(PROPERTY_TYPES), n)],
+                             'Floor Number': self.rng.integers(1, 40, n),
+                             'Floor Area': np.round(self.rng.lognormal(np.log(1000), 0.35, n)).astype(int),
+                             'Remaining Lease': self.rng.integers(40, 99, n)})
+
+    def modelling_columns(self):
+        '''
+        :return: columns of a modelling dataset in training order, the dropped base dummy being 'ANG MO KIO'
+        '''
+        areas = sorted(area for area in self.area_centroids['Planning Area'].unique() if area != 'ANG MO KIO')
+        return STANDARD_SCALE_VARS + MIN_MAX_VARS + ['Ang Mo Kio'] + areas + self.train_lines + PROPERTY_TYPES + ['Unit Price ($ PSM)']
+
+    def modelling_dataset(self, n):
+        columns = self.modelling_columns()
+        df = pd.DataFrame(0.0, index=range(n), columns=columns)
+        df['Area (SQM)'] = self.rng.lognormal(np.log(1000), 0.35, n) / SQFT_PER_SQM
+        df['Floor Number'] = self.rng.integers(1, 40, n)
+        df['PPI'] = PPI
+        df['Average Cases Per Year'] = self.rng.uniform(100, 900, n)
+        df['Nearest Primary School'] = self.rng.uniform(0, 2000, n)
+        df['nearest_station_distance'] = self.rng.uniform(0, 1000, n)
+        df['Remaining Lease'] = self.rng.integers(40, 99, n)
+        for col in columns[columns.index('Ang Mo Kio'):-1]:
+            df[col] = (self.rng.random(n) < 0.1).astype(float)
+        df['Unit Price ($ PSM)'] = (14000 + 40 * df['Floor Number'] - 2 * df['nearest_station_distance'] + 30 * df['Remaining Lease']
+                                    + self.rng.normal(0, 500, n))
+        return df
+
+    def model(self, model_path, scaler_path='modelling/', n=20000, n_estimators=300, max_depth=8):
+        '''
+        Train a model on modelling_dataset(n) with the scalers in scaler_path, and save it with them in model_path
+        Its size is about that of the production model, its predictions are meaningless.
+        :return: main_df_col of the model
+        '''
+        import joblib
+        import shutil
+        from xgboost import XGBRegressor
+        os.makedirs(model_path, exist_ok=True)
+        for name in (STANDARD_SCALER_FILE, MM_SCALER_FILE):
+            if os.path.abspath(os.path.join(scaler_path, name)) != os.path.abspath(os.path.join(model_path, name)):
+                shutil.copy(os.path.join(scaler_path, name), model_path)
+        s_scaler = joblib.load(os.path.join(model_path, STANDARD_SCALER_FILE))
+        mm_scaler = joblib.load(os.path.join(model_path, MM_SCALER_FILE))
+        df = self.modelling_dataset(n)
+        features = pd.concat([pd.DataFrame(s_scaler.transform(df[STANDARD_SCALE_VARS]), columns=STANDARD_SCALE_VARS),
+                              pd.DataFrame(mm_scaler.transform(df[MIN_MAX_VARS]), columns=MIN_MAX_VARS),
+                              df.iloc[:, len(STANDARD_SCALE_VARS) + len(MIN_MAX_VARS):-1]], axis=1)
+        model = XGBRegressor(n_estimators=n_estimators, max_depth=max_depth)
+        model.fit(features, df['Unit Price ($ PSM)'])
+        model.save_model(os.path.join(model_path, MODEL_FILE))
+        return list(df.columns)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    out = sys.argv[2] if len(sys.argv) > 2 else 'synthetic/'
+    os.makedirs(out, exist_ok=True)
+    data = SyntheticData()
+    buildings = data.buildings(max(1, n // TRANSACTIONS_PER_BUILDING))
+    buildings.to_csv(os.path.join(out, 'synthetic_postal_code_area.csv'), index=False)
+    data.transactions(n, buildings).to_csv(os.path.join(out, 'preliminary_dataset.csv'), index=False)
+    data.listings(10000, buildings).to_csv(os.path.join(out, 'listings.csv'), index=False)
+    print('{} transactions in {} buildings written to {}'.format(n, len(buildings), out))
@@ -0,0 +1,110 @@
+'''
+Small in-process caches shared by the geocoding and prediction layers
+'''
+import threading
+import time
+from collections import OrderedDict
+from metrics import PREDICTION_CACHE
+
+
+class TTLCache:
+    """Thread-safe bounded LRU cache whose entries also expire after a time-to-live
+    Keeps hit/miss counters so callers can report cache effectiveness.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        '''
+        :param maxsize: maximum number of entries, least recently used entries are evicted first
+        :param ttl: default seconds an entry stays valid, never expires if None
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live(key)
+
+    def _live(self, key):
+        if key not in self._data:
+            return False
+        expires, value = self._data[key]
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return False
+        return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            if not self._live(key):
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][1]
+
+    def set(self, key, value, ttl=None):
+        '''
+        :param ttl: seconds this entry stays valid, defaults to the cache ttl
+        '''
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (None if ttl is None else time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class PredictionCache:
+    """Predicted price per sqm of recently valued listings
+    Keyed on the normalized listing inputs together with the model version and the data snapshot the features were
+    computed from, so a model swap or a school/station opening never serves a stale valuation.
+    """
+    def __init__(self, maxsize=10000, ttl=6 * 60 * 60):
+        '''
+        :param maxsize: maximum number of valuations kept
+        :param ttl: seconds a valuation is kept
+        '''
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self):
+        return len(self.cache)
+
+    @staticmethod
+    def key(postal_code, property_type, floor_num, floor_area, remaining_lease, model_version, data_version):
+        # same normalization as Listing, which zero-pads the postal code and truncates the numbers to int
+        return (str(postal_code).strip().zfill(6), str(property_type).strip(), int(floor_num), int(float(floor_area)),
+                int(remaining_lease), model_version, data_version)
+
+    def get(self, key):
+        '''
+        :return: cached predicted price per sqm, None if not cached
+        '''
+        predicted_psm = self.cache.get(key)
+        PREDICTION_CACHE.inc(result='miss' if predicted_psm is None else 'hit')
+        return predicted_psm
+
+    def set(self, key, predicted_psm):
+        self.cache.set(key, predicted_psm)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,314 @@
+'''
+Precomputed location features for every postal code we know of, so that valuations for known codes skip all spatial work
+Build the table with:
+    python features.py
+'''
+import hashlib
+import os
+import threading
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from dataclasses import dataclass
+from amenities import LocationFeatures, TemporalAmenityIndex, location_features
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (Windows): processes appending to the same table may drop each other's rows
+    fcntl = None
+
+FEATURE_TABLE_PATH = 'datasets/postal_code_features.npz'
+# Bumped whenever the same inputs give different features, so tables computed the old way are rebuilt
+# 2: dates past every school/station closing date use the latest ones open instead of none
+FEATURES_VERSION = 2
+
+
+@dataclass(frozen=True)
+class PostalCodeFeatures:
+    """Location and amenity-derived features of one postal code"""
+    postal_code: str
+    lon: float
+    lat: float
+    planning_area: str
+    planning_region: str
+    location: LocationFeatures
+
+
+class FeatureTable:
+    """Per-postal-code feature table, stored column-wise in a compressed .npz keyed by postal code
+    Features are computed as of the build date; codes not in the table are computed on first use and appended.
+    Writes to the file are serialized across processes, and keep the rows other processes have appended to it.
+    A hash of the content of the data they were computed from is kept with them, so edited inputs are noticed.
+    """
+    def __init__(self, columns, lines, as_of, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, path=None, inputs=None):
+        '''
+        :param columns: dict of column name -> numpy array, one row per postal code
+        :param lines: train line names, in the bit order of the 'train_lines' bitmask column
+        :param as_of: date the features were computed for
+        :param sch_gdf, train_gdf, police_centre, avg_cases_by_npc: amenity data used for codes not in the table
+        :param path: where appended rows are saved, not saved if None
+        :param inputs: input_hash of the data the features were computed from, None if unknown
+        '''
+        self.columns = columns
+        self.lines = list(lines)
+        self.as_of = pd.Timestamp(as_of)
+        self.sch_gdf = sch_gdf
+        self.train_gdf = train_gdf
+        self.police_centre = police_centre
+        self.avg_cases_by_npc = avg_cases_by_npc
+        self.path = path
+        self.inputs = inputs
+        self._rows = {code: i for i, code in enumerate(columns['postal_code'])}
+        # reentrant, as add saves while holding it
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, postal_code):
+        return _normalize(postal_code) in self._rows
+
+    @classmethod
+    def build(cls, historical_postal_code_area, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, as_of=None, path=None):
+        '''
+        :param historical_postal_code_area: dataframe of known postal codes with their coordinates, planning area and region
+        :param as_of: date to compute features for, defaults to today
+        '''
+        as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of)
+        df = historical_postal_code_area.drop_duplicates('Postal Code')
+        lines = sorted(set(_data(train_gdf)['COLOR']))
+        columns = _to_columns(df['Postal Code'].apply(_normalize).values, df['LONGITUDE'].values, df['LATITUDE'].values,
+                              df['Planning Area'].values, df['Planning Region'].values,
+                              location_features(df['LONGITUDE'].values, df['LATITUDE'].values, sch_gdf, train_gdf,
+                                                police_centre, avg_cases_by_npc, as_of), lines)
+        table = cls(columns, lines, as_of, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, path,
+                    input_hash(historical_postal_code_area, sch_gdf, train_gdf, police_centre, avg_cases_by_npc))
+        if path is not None:
+            table.save()
+        return table
+
+    @classmethod
+    def load(cls, path, sch_gdf, train_gdf, police_centre, avg_cases_by_npc):
+        with np.load(path) as npz:
+            columns = {key: npz[key] for key in npz.files if key not in ('line_names', 'as_of', 'inputs')}
+            lines = npz['line_names'].tolist()
+            as_of = str(npz['as_of'])
+            # tables saved before the hash was kept are never taken as current
+            inputs = str(npz['inputs']) if 'inputs' in npz.files else None
+        return cls(columns, lines, as_of, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, path, inputs)
+
+    @classmethod
+    def load_or_build(cls, path, historical_postal_code_area, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, as_of=None):
+        '''
+        Load the table at path, rebuilding it if missing, if any of the data it was computed from has changed,
+        or if schools or stations have opened/closed since it was built
+        '''
+        as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of)
+        # only one process builds, the others wait for it and load its table
+        with _file_lock(path):
+            if os.path.exists(path):
+                table = cls.load(path, sch_gdf, train_gdf, police_centre, avg_cases_by_npc)
+                if table.is_current(as_of, historical_postal_code_area):
+                    return table
+            table = cls.build(historical_postal_code_area, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, as_of)
+            table.path = path
+            table._write(path)
+        return table
+
+    def is_current(self, as_of, historical_postal_code_area):
+        '''
+        :param historical_postal_code_area: the known postal codes the table would be built from now
+        :return: whether features computed as of self.as_of from the table's inputs still hold as of the given date
+                 for the current amenity data and postal codes
+        '''
+        if self.inputs is None or self.inputs != input_hash(historical_postal_code_area, self.sch_gdf, self.train_gdf,
+                                                             self.police_centre, self.avg_cases_by_npc):
+            return False
+        for index in (self.sch_gdf, self.train_gdf):
+            # without a time-aware index we cannot tell, so only the same date is trusted
+            if not isinstance(index, TemporalAmenityIndex):
+                return self.as_of == pd.Timestamp(as_of)
+            if index.epoch_of(self.as_of)[0] != index.epoch_of(as_of)[0]:
+                return False
+        return True
+
+    def save(self, path=None):
+        '''
+        Write the table to path, first taking in the rows other processes have appended to the file since it was read
+        '''
+        path = path or self.path
+        with self._lock, _file_lock(path):
+            self._merge(path)
+            self._write(path)
+
+    def _merge(self, path):
+        if not os.path.exists(path):
+            return
+        with np.load(path) as npz:
+            # a table rebuilt from other data or for another date is replaced rather than merged
+            if (str(npz['as_of']) != str(self.as_of.date()) or npz['line_names'].tolist() != self.lines
+                    or 'inputs' not in npz.files or str(npz['inputs']) != (self.inputs or '')):
+                return
+            codes = npz['postal_code']
+            new = np.array([code not in self._rows for code in codes.tolist()], dtype=bool)
+            if new.any():
+                self.columns = {key: np.concatenate([self.columns[key], npz[key][new]]) for key in self.columns}
+                for code in codes[new].tolist():
+                    self._rows[code] = len(self._rows)
+
+    def _write(self, path):
+        # per process, so several processes appending to the same table never write the same temporary file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        # write then rename so readers never see a partial file
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, line_names=np.array(self.lines), as_of=np.array(str(self.as_of.date())),
+                                inputs=np.array(self.inputs or ''), **self.columns)
+        os.replace(tmp_path, path)
+
+    def lookup(self, postal_code):
+        '''
+        :return: PostalCodeFeatures of the postal code, None if not in the table
+        '''
+        row = self._rows.get(_normalize(postal_code))
+        if row is None:
+            return None
+        col = self.columns
+        lines = int(col['train_lines'][row])
+        stations = str(col['train_stations'][row])
+        location = LocationFeatures(sch_name=str(col['sch_name'][row]) or None,
+                                    sch_dist=float(col['sch_dist'][row]),
+                                    police_centre=str(col['police_centre'][row]),
+                                    police_centre_dist=float(col['police_centre_dist'][row]),
+                                    avg_cases=int(col['avg_cases'][row]) if col['avg_cases'][row] >= 0 else None,
+                                    train_dist=float(col['train_dist'][row]),
+                                    train_stations=set(stations.split('|')) if stations else set(),
+                                    train_lines={line for bit, line in enumerate(self.lines) if lines >> bit & 1})
+        return PostalCodeFeatures(str(col['postal_code'][row]), float(col['lon'][row]), float(col['lat'][row]),
+                                  str(col['planning_area'][row]), str(col['planning_region'][row]), location)
+
+    def lookup_many(self, postal_codes):
+        '''
+        :return: dataframe indexed by postal code of the given codes that are in the table, with lon, lat,
+                 planning_area, planning_region and one column per LocationFeatures field
+        '''
+        codes = pd.unique(pd.Series(postal_codes).apply(_normalize))
+        rows = np.array([self._rows[code] for code in codes if code in self._rows], dtype=np.int64)
+        col = {key: values[rows] for key, values in self.columns.items()}
+        bits = [(1 << bit, line) for bit, line in enumerate(self.lines)]
+        return pd.DataFrame({'lon': col['lon'],
+                             'lat': col['lat'],
+                             'planning_area': col['planning_area'].astype(object),
+                             'planning_region': col['planning_region'].astype(object),
+                             'sch_name': [name or None for name in col['sch_name'].tolist()],
+                             'sch_dist': col['sch_dist'].astype(float),
+                             'police_centre': col['police_centre'].astype(object),
+                             'police_centre_dist': col['police_centre_dist'].astype(float),
+                             # whole cases, as lookup gives them
+                             'avg_cases': np.where(col['avg_cases'] >= 0, np.trunc(col['avg_cases']), np.nan),
+                             'train_dist': col['train_dist'].astype(float),
+                             'train_stations': [set(stations.split('|')) if stations else set() for stations in col['train_stations'].tolist()],
+                             'train_lines': [{line for bit, line in bits if lines & bit} for lines in col['train_lines'].tolist()]},
+                            index=pd.Index(col['postal_code'].astype(object), name='postal_code'))
+
+    def add(self, postal_code, lon, lat, planning_area, planning_region):
+        '''
+        Compute the features of a postal code not yet in the table and append it
+        :return: PostalCodeFeatures of the postal code
+        '''
+        postal_code = _normalize(postal_code)
+        # one append at a time, the columns are replaced as a whole
+        with self._lock:
+            if postal_code not in self._rows:
+                features = location_features([float(lon)], [float(lat)], self.sch_gdf, self.train_gdf, self.police_centre,
+                                             self.avg_cases_by_npc, self.as_of)
+                row = _to_columns([postal_code], [float(lon)], [float(lat)], [planning_area], [planning_region], features, self.lines)
+                self.columns = {key: np.concatenate([self.columns[key], row[key]]) for key in self.columns}
+                self._rows[postal_code] = len(self._rows)
+                if self.path is not None:
+                    self.save()
+        return self.lookup(postal_code)
+
+
+def data_version(sch_gdf, train_gdf, feature_table=None, as_of=None):
+    '''
+    Identifies the data behind location features, e.g. to key cached valuations
+    :param sch_gdf, train_gdf: school and train station dataframes or prebuilt indexes
+    :param feature_table: optional FeatureTable, whose build date fixes the features of the codes it has
+    :param as_of: date features are computed for, defaults to today
+    :return: string that changes whenever the feature table is rebuilt or its inputs change, or schools or stations open or close
+    '''
+    as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of)
+    parts = [] if feature_table is None else ['table:{}:{}'.format(feature_table.as_of.date(), feature_table.inputs)]
+    for name, index in (('sch', sch_gdf), ('train', train_gdf)):
+        # without a time-aware index only the same date is known to give the same features
+        parts.append('{}:{}'.format(name, index.epoch_of(as_of)[0] if isinstance(index, TemporalAmenityIndex) else as_of.date()))
+    return '/'.join(parts)
+
+
+def input_hash(historical_postal_code_area, sch_gdf, train_gdf, police_centre, avg_cases_by_npc):
+    '''
+    :param sch_gdf, train_gdf, police_centre: amenity dataframes or prebuilt indexes
+    :return: hash of the content of every dataframe location features are computed from, and of FEATURES_VERSION
+    '''
+    sha = hashlib.sha1(str(FEATURES_VERSION).encode())
+    for df in (historical_postal_code_area, _data(sch_gdf), _data(train_gdf), _data(police_centre), avg_cases_by_npc):
+        sha.update('|'.join(map(str, df.columns)).encode())
+        sha.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return sha.hexdigest()[:12]
+
+
+@contextmanager
+def _file_lock(path):
+    # exclusive lock on a file next to the table, held across processes
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _normalize(postal_code):
+    return str(postal_code).strip().zfill(6)
+
+
+def _data(amenity):
+    # raw dataframe behind either a prebuilt index or the dataframe itself
+    return amenity.data if hasattr(amenity, 'data') else amenity
+
+
+def _strings(values):
+    # fixed-width unicode array, so the .npz loads without pickle
+    return np.array([str(value) for value in values], dtype=str)
+
+
+def _to_columns(postal_code, lon, lat, planning_area, planning_region, features, lines):
+    bits = {line: 1 << bit for bit, line in enumerate(lines)}
+    return {'postal_code': _strings(postal_code),
+            'lon': np.asarray(lon, dtype=np.float64),
+            'lat': np.asarray(lat, dtype=np.float64),
+            'planning_area': _strings(planning_area),
+            'planning_region': _strings(planning_region),
+            'sch_name': _strings(features['sch_name'].fillna('')),
+            'sch_dist': features['sch_dist'].values.astype(np.float32),
+            'police_centre': _strings(features['police_centre']),
+            'police_centre_dist': features['police_centre_dist'].values.astype(np.float32),
+            'avg_cases': features['avg_cases'].fillna(-1).values.astype(np.float32),
+            'train_dist': features['train_dist'].values.astype(np.float32),
+            'train_stations': _strings('|'.join(sorted(stations)) for stations in features['train_stations']),
+            'train_lines': np.array([sum(bits[line] for line in row_lines) for row_lines in features['train_lines']], dtype=np.uint16)}
+
+
+if __name__ == '__main__':
+    from amenities import school_index, train_index, police_centre_index
+    path = 'datasets/'
+    table = FeatureTable.build(pd.read_csv(path + 'historical_postal_code_area.csv'),
+                               school_index(pd.read_csv(path + 'primary_sch_gdf.csv')),
+                               train_index(pd.read_csv(path + 'train_gdf.csv')),
+                               police_centre_index(pd.read_csv(path + 'police_centre_gdf.csv')),
+                               pd.read_csv(path + 'average_cases_by_npc.csv'),
+                               path=FEATURE_TABLE_PATH)
+    print('{} postal codes as of {} saved to {}'.format(len(table), table.as_of.date(), FEATURE_TABLE_PATH))
@@ -0,0 +1,363 @@
+'''
+Geocoding of postal codes through the OneMap search API
+- GeocodeCache: persistent cache of results keyed by postal code. A SQLite file keeps results across restarts, with an
+  in-process LRU in front of it. Postal codes OneMap has no result for are cached too (for a shorter time), so
+  repeated bad input does not hit the API.
+- GeocodingClient: pooled HTTP client with timeouts, retries with exponential backoff, bounded concurrency and
+  coalescing of identical in-flight lookups, for both single and bulk geocoding.
+- OfflineGeocoder: coordinates of every postal code held in our own datasets, with an approximate same-sector
+  fallback, so valuations keep working (degraded) when OneMap is slow or unreachable.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from requests.adapters import HTTPAdapter
+from cache import TTLCache
+from metrics import timed, GEOCODE_CACHE, GEOCODE_REQUESTS
+
+ONEMAP_SEARCH_URL = 'https://developers.onemap.sg/commonapi/search'
+GEOCODE_CACHE_PATH = 'datasets/geocode_cache.sqlite'
+GEOCODE_TTL = 30 * 24 * 3600  # seconds, addresses rarely change
+NEGATIVE_TTL = 24 * 3600  # seconds, new postal codes do show up in OneMap over time
+
+
+class UnexpectedResponse(requests.RequestException):
+    """OneMap answered with a body that is not a list of search results, e.g. an error message
+    A RequestException, so callers treat it like any other failed lookup rather than a postal code with no result.
+    """
+
+
+class PostalCodeNotFound(IndexError):
+    """OneMap returned no result for the postal code
+    Subclasses IndexError, which is what indexing the empty OneMap result list used to raise.
+    """
+
+
+def normalize_postal_code(postal_code):
+    postal_code = str(postal_code).strip()
+    return postal_code.zfill(6) if postal_code.isdigit() else postal_code
+
+
+class GeocodeCache:
+    """Geocoding results by postal code: in-process LRU front, SQLite store behind it"""
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_TTL, negative_ttl=NEGATIVE_TTL, maxsize=4096):
+        '''
+        :param path: SQLite file, ':memory:' for a cache that does not persist
+        :param ttl: seconds a found result stays valid
+        :param negative_ttl: seconds a not-found result stays valid
+        :param maxsize: number of entries kept in memory
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(maxsize=maxsize)
+        self.fetches = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                               'postal_code TEXT PRIMARY KEY, result TEXT, fetched_at REAL NOT NULL)')
+
+    def get(self, postal_code):
+        '''
+        :return: (found, result) where result is the OneMap result dict, or None for a cached not-found;
+                 found is False if the postal code is not cached or its entry expired
+        '''
+        key = normalize_postal_code(postal_code)
+        entry = self.memory.get(key)
+        if entry is not None:
+            GEOCODE_CACHE.inc(result='memory')
+            return True, entry[0]
+        with self._lock:
+            row = self._conn.execute('SELECT result, fetched_at FROM geocode WHERE postal_code = ?', (key,)).fetchone()
+        if row is None:
+            GEOCODE_CACHE.inc(result='miss')
+            return False, None
+        result = json.loads(row[0]) if row[0] is not None else None
+        remaining = (self.ttl if result is not None else self.negative_ttl) - (time.time() - row[1])
+        if remaining <= 0:
+            GEOCODE_CACHE.inc(result='miss')
+            return False, None
+        self.memory.set(key, (result,), ttl=remaining)
+        GEOCODE_CACHE.inc(result='disk')
+        return True, result
+
+    def put(self, postal_code, result):
+        '''
+        :param result: OneMap result dict, None to record that the postal code was not found
+        '''
+        key = normalize_postal_code(postal_code)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)',
+                               (key, json.dumps(result) if result is not None else None, time.time()))
+        self.memory.set(key, (result,), ttl=self.ttl if result is not None else self.negative_ttl)
+
+    def get_or_fetch(self, postal_code, fetch):
+        '''
+        :param fetch: function of the postal code returning the list of OneMap results, called only on a cache miss
+        :return: first OneMap result for the postal code
+        :raises PostalCodeNotFound: if OneMap has no result for it
+        '''
+        found, result = self.get(postal_code)
+        if not found:
+            self.fetches += 1
+            results = fetch(normalize_postal_code(postal_code))
+            result = results[0] if results else None
+            self.put(postal_code, result)
+        if result is None:
+            raise PostalCodeNotFound('No OneMap result for postal code {}'.format(postal_code))
+        return result
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM geocode')
+
+
+class GeocodingClient:
+    """OneMap search client
+    Requests share one pooled session, time out, and are retried with exponential backoff on connection errors,
+    timeouts, 429 and 5xx responses. Lookups run on a bounded thread pool, and concurrent lookups of the same
+    postal code share a single request.
+    """
+    def __init__(self, base_url=ONEMAP_SEARCH_URL, cache=None, max_workers=8, timeout=5, retries=3, backoff=0.5):
+        '''
+        :param base_url: OneMap search endpoint, or a local stub server's (see onemap_stub.py)
+        :param cache: optional GeocodeCache consulted before and filled after each postal code lookup
+        :param max_workers: maximum number of concurrent requests
+        :param timeout: seconds to wait for each request
+        :param retries: number of retries after the first attempt
+        :param backoff: seconds to wait before the first retry, doubled for every retry after it
+        '''
+        self.base_url = base_url
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.requests = 0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='geocode')
+        self._in_flight = {}
+        self._lock = threading.RLock()
+
+    def search(self, search_val, return_geom=True, get_addr=True, page_num=1):
+        '''
+        :return: list of OneMap results for the search value
+        :raises requests.RequestException: if OneMap cannot be reached or does not answer with search results
+        '''
+        params = {'searchVal': search_val,
+                  'returnGeom': 'Y' if return_geom else 'N',
+                  'getAddrDetails': 'Y' if get_addr else 'N',
+                  'pageNum': page_num}
+        for attempt in range(self.retries + 1):
+            try:
+                self.requests += 1
+                with timed('onemap_request'):
+                    response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                    response.raise_for_status()
+                results = _results(response)
+                GEOCODE_REQUESTS.inc(outcome='ok' if results else 'not_found')
+                return results
+            except UnexpectedResponse:
+                GEOCODE_REQUESTS.inc(outcome='error')
+                raise
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                GEOCODE_REQUESTS.inc(outcome='error')
+                if attempt == self.retries or not _retryable(e):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _geocode(self, postal_code):
+        if self.cache is not None:
+            return self.cache.get_or_fetch(postal_code, self.search)
+        results = self.search(postal_code)
+        if not results:
+            raise PostalCodeNotFound('No OneMap result for postal code {}'.format(postal_code))
+        return results[0]
+
+    def submit(self, postal_code):
+        '''
+        :return: Future of the first OneMap result for the postal code, shared with any identical lookup in flight
+        '''
+        key = normalize_postal_code(postal_code)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(self._geocode, key)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def geocode(self, postal_code, timeout=None):
+        '''
+        :param timeout: seconds to wait for the result, including retries; the lookup carries on in the background
+                        (and fills the cache) when they run out
+        :return: first OneMap result for the postal code
+        :raises PostalCodeNotFound: if OneMap has no result for it
+        :raises requests.Timeout: if there is no answer within timeout seconds
+        '''
+        try:
+            return self.submit(postal_code).result(timeout)
+        except FutureTimeout:
+            raise requests.Timeout('No OneMap answer for postal code {} within {}s'.format(postal_code, timeout))
+
+    def geocode_many(self, postal_codes):
+        '''
+        :param postal_codes: iterable of postal codes, duplicates are looked up once
+        :return: dict of postal code -> first OneMap result, None if OneMap has no result for it;
+                 postal codes whose lookup failed after all retries are left out
+        '''
+        futures = {normalize_postal_code(code): None for code in postal_codes}
+        for code in futures:
+            futures[code] = self.submit(code)
+        results = {}
+        for code, future in futures.items():
+            try:
+                results[code] = future.result()
+            except PostalCodeNotFound:
+                results[code] = None
+            except requests.RequestException:
+                pass
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+
+# confidence is 'exact' for a known postal code, 'sector' for a nearby code in the same postal sector
+GeocodeResult = namedtuple('GeocodeResult', ['lon', 'lat', 'confidence'])
+
+
+class OfflineGeocoder:
+    """Postal code -> coordinates from local data only
+    Codes are kept as a sorted integer array, so exact hits and same-sector neighbours are both binary searches.
+    The first two digits of a Singapore postal code are its postal sector; when a code is unknown, the numerically
+    closest known code in the same sector is usually a nearby block on the same estate or road.
+    """
+    def __init__(self, sources):
+        '''
+        :param sources: list of (dataframe, postal code column, longitude column, latitude column);
+                        where a code appears in several sources the earlier source wins
+        '''
+        frames = []
+        for df, postal_col, lon_col, lat_col in sources:
+            frame = pd.DataFrame({'code': pd.to_numeric(df[postal_col], errors='coerce'),
+                                  'lon': pd.to_numeric(df[lon_col], errors='coerce'),
+                                  'lat': pd.to_numeric(df[lat_col], errors='coerce')}).dropna()
+            frames.append(frame)
+        codes = pd.concat(frames, ignore_index=True).drop_duplicates('code', keep='first').sort_values('code')
+        self.codes = codes['code'].values.astype(np.int64)
+        self.lon = codes['lon'].values.astype(float)
+        self.lat = codes['lat'].values.astype(float)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_datasets(cls, path='datasets/'):
+        '''
+        Index every postal code with coordinates in the datasets folder: known properties, transactions if present, amenities
+        '''
+        sources = [(pd.read_csv(path + 'historical_postal_code_area.csv'), 'Postal Code', 'LONGITUDE', 'LATITUDE')]
+        if os.path.exists(path + 'preliminary_dataset.csv'):
+            transactions = pd.read_csv(path + 'preliminary_dataset.csv')
+            if 'Postal Code' in transactions.columns:
+                sources.append((transactions, 'Postal Code', 'LONGITUDE', 'LATITUDE'))
+        sources.append((pd.read_csv(path + 'primary_sch_gdf.csv'), 'Postal Code', 'Longitude', 'Latitude'))
+        sources.append((pd.read_csv(path + 'police_centre_gdf.csv', encoding='utf-8-sig'), 'Postal Code', 'Longitude', 'Latitude'))
+        return cls(sources)
+
+    def locate_many(self, postal_codes, approximate=True):
+        '''
+        :param approximate: fall back to the closest known code in the same postal sector for unknown codes
+        :return: arrays of longitude, latitude (NaN where not found) and confidence ('exact', 'sector' or None)
+        '''
+        codes = pd.to_numeric(pd.Series(np.atleast_1d(postal_codes)).astype(str).str.strip(), errors='coerce').fillna(-1).values.astype(np.int64)
+        lon = np.full(len(codes), np.nan)
+        lat = np.full(len(codes), np.nan)
+        confidence = np.full(len(codes), None, dtype=object)
+        if len(self.codes) == 0:
+            return lon, lat, confidence
+
+        pos = np.searchsorted(self.codes, codes)
+        right = np.minimum(pos, len(self.codes) - 1)
+        exact = self.codes[right] == codes
+        match = np.where(exact, right, -1)
+        if approximate:
+            left = np.maximum(pos - 1, 0)
+            # closest of the two neighbouring known codes, if it is in the same sector
+            closer = np.where(np.abs(self.codes[left] - codes) <= np.abs(self.codes[right] - codes), left, right)
+            same_sector = (self.codes[closer] // 10000 == codes // 10000) & (codes >= 0)
+            match = np.where(exact, right, np.where(same_sector, closer, -1))
+        found = match >= 0
+        lon[found] = self.lon[match[found]]
+        lat[found] = self.lat[match[found]]
+        confidence[found] = np.where(exact[found], 'exact', 'sector')
+        return lon, lat, confidence
+
+    def locate(self, postal_code, approximate=True):
+        '''
+        :return: GeocodeResult of the postal code, None if not found
+        '''
+        lon, lat, confidence = self.locate_many([postal_code], approximate)
+        if confidence[0] is None:
+            return None
+        return GeocodeResult(lon[0], lat[0], confidence[0])
+
+
+def _results(response):
+    # the OneMap error body ({'error': ...}) and non-JSON bodies both come with a 200
+    try:
+        body = response.json()
+    except ValueError:
+        raise UnexpectedResponse('OneMap response is not JSON', response=response)
+    if not isinstance(body, dict) or not isinstance(body.get('results'), list):
+        raise UnexpectedResponse('OneMap response has no results: {}'.format(str(body)[:200]), response=response)
+    return body['results']
+
+
+def _retryable(error):
+    # connection errors and timeouts, or OneMap rate limiting / server errors
+    if not isinstance(error, requests.HTTPError):
+        return True
+    return error.response.status_code == 429 or error.response.status_code >= 500
+
+
+_default_cache = None
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    # Opened on first use so importing this module does not touch the disk
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = GeocodeCache()
+    return _default_cache
+
+
+def default_client():
+    # Shared client backed by the default on-disk cache
+    global _default_client
+    cache = default_cache()
+    with _default_lock:
+        if _default_client is None:
+            _default_client = GeocodingClient(cache=cache)
+    return _default_client
@@ -0,0 +1,168 @@
+'''
+Inference engines for the valuation model, called with the float32 features built by FeatureLayout
+    BoosterEngine: the xgboost booster, predicting in place on the numpy array without DMatrix or pandas overhead
+    TreeEngine: the trees of the model's JSON export evaluated with numpy only, for environments without xgboost
+Export a model for TreeEngine with:
+    python inference.py modelling/
+'''
+import inspect
+import json
+import os
+import tempfile
+import numpy as np
+
+JSON_MODEL_FILE = 'model_xgboost.json'
+# objectives whose prediction is the raw sum of the trees, or its exponential
+IDENTITY_OBJECTIVES = ('reg:squarederror', 'reg:linear', 'reg:squaredlogerror', 'reg:pseudohubererror', 'reg:absoluteerror', 'reg:quantileerror')
+EXP_OBJECTIVES = ('reg:gamma', 'reg:tweedie', 'count:poisson')
+
+
+class BoosterEngine:
+    """Predicts with the xgboost booster directly on a numpy array"""
+    def __init__(self, booster):
+        '''
+        :param booster: xgboost Booster, or a fitted XGBRegressor
+        '''
+        self.booster = booster.get_booster() if hasattr(booster, 'get_booster') else booster
+        best_iteration = self.booster.attr('best_iteration')
+        # same trees as XGBRegressor.predict, which stops at the best iteration of early stopping
+        self.kwargs = {'iteration_range': (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)}
+        # columns are positional, so there are no feature names to validate (the option exists from xgboost 1.4)
+        if 'validate_features' in inspect.signature(self.booster.inplace_predict).parameters:
+            self.kwargs['validate_features'] = False
+
+    def predict(self, features):
+        '''
+        :param features: 2d float32 array, columns in the order the model was trained on
+        :return: prediction of each row
+        '''
+        return self.booster.inplace_predict(features, **self.kwargs)
+
+
+class TreeEngine:
+    """Pure numpy evaluation of a gradient boosted tree model from its xgboost JSON export
+    The trees are packed into (tree, node) arrays and every row walks all trees at once, one level per step,
+    with float32 comparisons as in xgboost.
+    """
+    def __init__(self, model):
+        '''
+        :param model: parsed JSON export of an xgboost model, as written by Booster.save_model('*.json')
+        '''
+        learner = model['learner']
+        objective = learner['objective']['name']
+        if objective not in IDENTITY_OBJECTIVES + EXP_OBJECTIVES:
+            raise ValueError('Unsupported objective {}'.format(objective))
+        booster = learner['gradient_booster']
+        if 'model' not in booster:
+            raise ValueError('Unsupported booster {}'.format(booster.get('name')))
+        trees = booster['model']['trees']
+        best_iteration = learner.get('attributes', {}).get('best_iteration')
+        if best_iteration is not None:
+            per_iteration = int(booster['model']['gbtree_model_param'].get('num_parallel_tree', 1))
+            trees = trees[:(int(best_iteration) + 1) * per_iteration]
+
+        self.feature_names = learner.get('feature_names') or None
+        self.exp = objective in EXP_OBJECTIVES
+        base_score = float(str(learner['learner_model_param']['base_score']).strip('[]'))
+        # base_score is kept on the output scale, the trees add to its log for exponential objectives
+        self.base_margin = np.log(base_score) if self.exp else base_score
+
+        n_nodes = max(len(tree['left_children']) for tree in trees) if trees else 1
+        shape = (len(trees), n_nodes)
+        self.left = np.zeros(shape, dtype=np.int32)
+        self.right = np.zeros(shape, dtype=np.int32)
+        self.feature = np.zeros(shape, dtype=np.int32)
+        self.threshold = np.zeros(shape, dtype=np.float32)
+        self.default_left = np.zeros(shape, dtype=bool)
+        self.value = np.zeros(shape, dtype=np.float32)
+        # trees are padded to the largest, nodes from n_nodes on are padding
+        self.n_nodes = np.array([len(tree['left_children']) for tree in trees], dtype=np.int32)
+        depth = 0
+        for t, tree in enumerate(trees):
+            left = np.asarray(tree['left_children'], dtype=np.int32)
+            right = np.asarray(tree['right_children'], dtype=np.int32)
+            leaf = left < 0
+            nodes = np.arange(len(left), dtype=np.int32)
+            # leaves point to themselves, so rows that reach one early stay there
+            self.left[t, :len(left)] = np.where(leaf, nodes, left)
+            self.right[t, :len(left)] = np.where(leaf, nodes, right)
+            self.feature[t, :len(left)] = np.where(leaf, 0, tree['split_indices'])
+            self.threshold[t, :len(left)] = tree['split_conditions']
+            self.default_left[t, :len(left)] = np.asarray(tree['default_left'], dtype=bool)
+            # a leaf's value is stored in its split condition
+            self.value[t, :len(left)] = np.where(leaf, tree['split_conditions'], 0)
+            depth = max(depth, _depth(left, right))
+        self.depth = depth
+        self._trees = np.arange(len(trees))
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_booster(cls, booster):
+        '''
+        :param booster: xgboost Booster, or a fitted XGBRegressor
+        '''
+        booster = booster.get_booster() if hasattr(booster, 'get_booster') else booster
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            booster.save_model(path)
+            return cls.from_json(path)
+        finally:
+            os.remove(path)
+
+    def leaves(self, features):
+        '''
+        :param features: 2d float32 array, columns in the order the model was trained on
+        :return: (row, tree) array of the leaf each row reaches in each tree, as Booster.predict(pred_leaf=True)
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        rows = np.arange(len(features))[:, None]
+        node = np.zeros((len(features), len(self._trees)), dtype=np.int32)
+        for _ in range(self.depth):
+            x = features[rows, self.feature[self._trees, node]]
+            go_left = np.where(np.isnan(x), self.default_left[self._trees, node], x < self.threshold[self._trees, node])
+            node = np.where(go_left, self.left[self._trees, node], self.right[self._trees, node])
+        return node
+
+    def predict(self, features):
+        '''
+        :param features: 2d float32 array, columns in the order the model was trained on
+        :return: prediction of each row
+        '''
+        node = self.leaves(features)
+        # summed in float32 like xgboost
+        margin = self.value[self._trees, node].sum(axis=1, dtype=np.float32) + np.float32(self.base_margin)
+        return np.exp(margin) if self.exp else margin
+
+
+def export_json(path):
+    '''
+    Write the model in path as JSON next to it, for TreeEngine
+    :param path: model directory
+    :return: path of the JSON model
+    '''
+    from xgboost import Booster
+    from model import MODEL_FILE
+    booster = Booster()
+    booster.load_model(os.path.join(path, MODEL_FILE))
+    json_path = os.path.join(path, JSON_MODEL_FILE)
+    booster.save_model(json_path)
+    return json_path
+
+
+def _depth(left, right):
+    # number of splits on the longest path from the root
+    depth = np.zeros(len(left), dtype=np.int32)
+    for node in range(len(left)):
+        if left[node] >= 0:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return int(depth.max())
+
+
+if __name__ == '__main__':
+    import sys
+    print('Saved {}'.format(export_json(sys.argv[1] if len(sys.argv) > 1 else 'modelling/')))
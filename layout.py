@@ -16,6 +16,14 @@ from dash.exceptions import PreventUpdate
 # Importing backend classes
 from Sample import Sample
 from listing import Listing
+from amenities import school_index, train_index, police_centre_index
+from location import PlanningAreaIndex, PlanningAreaNeighbours, PostalCodeIndex
+from features import FeatureTable, FEATURE_TABLE_PATH
+from cache import PredictionCache
+from transactions import TransactionIndex, TransactionStore, PsfCube
+from metrics import timed, render, CONTENT_TYPE
+from geocoding import OfflineGeocoder
+from model import default_registry, MissingFeatures
 
 ### Declaring Stylesheets for Layout ##################################
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', dbc.themes.SANDSTONE]
@@ -23,16 +31,34 @@ app = dash.Dash(__name__, external_stylesheets = external_stylesheets, suppress_
 
 
 ### Parsing Data Required ##############################################
-sch = pd.read_csv('datasets/primary_sch_gdf.csv')
-train = pd.read_csv('datasets/train_gdf.csv')
+# Amenity search indexes are built once here and shared by every valuation
+sch = school_index(pd.read_csv('datasets/primary_sch_gdf.csv'))
+train = train_index(pd.read_csv('datasets/train_gdf.csv'))
 area_df = pd.read_csv('datasets/area_centroid.csv')
+area_index = PlanningAreaIndex(area_df)
+# Closest planning areas of each planning area, for the resale climate chart
+area_neighbours = PlanningAreaNeighbours(area_df)
 modelling = pd.read_csv('datasets/modelling_dataset.csv')
-police_centre = pd.read_csv('datasets/police_centre_gdf.csv')
+police_centre = police_centre_index(pd.read_csv('datasets/police_centre_gdf.csv'))
 avg_cases = pd.read_csv('datasets/average_cases_by_npc.csv')
 prelim_ds = pd.read_csv('datasets/preliminary_dataset.csv')
 postal_code_area = pd.read_csv('datasets/historical_postal_code_area.csv')
+postal_index = PostalCodeIndex(postal_code_area)
 cols = list(modelling.columns)
+# Loaded once here so the first valuation does not pay for reading the model from disk
+model_registry = default_registry('modelling/')
+# Re-submitted valuations of the same unit are served from here
+prediction_cache = PredictionCache()
+# Locates postal codes from local data when possible, and keeps valuations going if OneMap is unreachable
+offline_geocoder = OfflineGeocoder.from_datasets('datasets/')
+# Location features of every known postal code, rebuilt only when the data changes or schools or stations open/close
+feature_table = FeatureTable.load_or_build(FEATURE_TABLE_PATH, postal_code_area, sch, train, police_centre, avg_cases)
 prelim_ds['Sale Date'] = pd.to_datetime(prelim_ds['Sale Date'], format = '%Y-%m-%d')
+# Transactions within the search radius of a listing are found from here instead of scanning them all,
+# then filtered by property type and time window
+prelim_store = TransactionStore(prelim_ds, TransactionIndex(prelim_ds))
+# Monthly PSF of any planning areas, property types and time window, for the resale climate chart
+prelim_cube = PsfCube(prelim_ds)
 
 ### Global Objects #####################################################
 global curr_listing
@@ -284,6 +310,12 @@ nav_bar = html.Div([
 
 ### Overview Component ###################################################################
 
+# Features missing for a listing, e.g. no school open anywhere yet, are shown as unavailable instead of failing the page
+UNAVAILABLE = "Unavailable"
+
+def shown(value, fmt):
+    return UNAVAILABLE if value is None or pd.isnull(value) else fmt.format(value)
+
 def derived_feature(logo, title, description): 
     if ('NPC' not in str(title)):
         title = str(title).title()
@@ -301,6 +333,10 @@ def derived_feature(logo, title, description):
     
 def overview_section(listing, predicted_price,  predicted_price_psm):
     
+    # Resolved while predicting the price, from the feature table when it has the postal code; a price from the
+    # prediction cache resolves none, so they are searched for here
+    features = listing.get_location_features(sch, train, police_centre, avg_cases, postal_index)
+    
     #predicted_price,  predicted_price_psm
     
     listing_feature = dbc.Row([
@@ -310,7 +346,7 @@ def overview_section(listing, predicted_price,  predicted_price_psm):
             dbc.Card([
                 
                 dbc.Row([
-                    dbc.Col("${:,.2f}".format(predicted_price), 
+                    dbc.Col(shown(predicted_price, "${:,.2f}"), 
                             style = {'font-size': 'xx-large', 'text-align': 'center', 'margin': 'auto', 'color': '#93C54B', 'padding-left': 0}, 
                             width = 7
                     ),
@@ -325,7 +361,7 @@ def overview_section(listing, predicted_price,  predicted_price_psm):
                 html.Hr(style = {'padding': 0}),
                 
                 dbc.Row([
-                    dbc.Col("${:,.2f}".format(predicted_price_psm), 
+                    dbc.Col(shown(predicted_price_psm, "${:,.2f}"), 
                             style = {'font-size': 'xx-large', 'text-align': 'center', 'margin': 'auto', 'color': '#93C54B', 'padding-left': 0}, 
                             width = 7
                     ),
@@ -348,18 +384,18 @@ def overview_section(listing, predicted_price,  predicted_price_psm):
                 
                 # Train Stations Derived Features
                 dbc.Row([
-                    derived_feature('train.png', " . ".join(list(listing.train_stations(train, postal_code_area))), "Train stations within 1km"),
+                    derived_feature('train.png', " . ".join(list(features.train_stations)), "Train stations within 1km"),
                     dbc.Col([
-                        html.Div(str(int(listing.train_dist(train, postal_code_area))) + " metres", style = {'font-size': 'large'}),
+                        html.Div(shown(features.train_dist, "{:.0f} metres"), style = {'font-size': 'large'}),
                         html.Div("Distance to Nearest Train Station", style = {'font-size': 'small', 'color': 'grey'})
                     ], style = {'padding-top': 10})
                 ], style = {'align-items': 'center'}), 
                 
                 # Schools Derived Features
                 dbc.Row([
-                    derived_feature('school.png', listing.sch_name(sch, postal_code_area), "Nearest School"),
+                    derived_feature('school.png', features.sch_name or "No open school", "Nearest School"),
                     dbc.Col([
-                        html.Div(str(int(listing.sch_dist(sch, postal_code_area))) + " metres", style = {'font-size': 'large'}),
+                        html.Div(shown(features.sch_dist, "{:.0f} metres"), style = {'font-size': 'large'}),
                         html.Div("Distance to Nearest School", style = {'font-size': 'small', 'color': 'grey'})
                     ], style = {'padding-top': 10})
                     #derived_feature('', str(int(listing.sch_dist(sch))) + " metres", "Distance to Nearest School")
@@ -367,9 +403,9 @@ def overview_section(listing, predicted_price,  predicted_price_psm):
                 
                 # Schools Derived Features
                 dbc.Row([
-                    derived_feature('police-station.png', listing.get_police_centre(police_centre, postal_code_area), "Nearest Police Station"),
+                    derived_feature('police-station.png', features.police_centre, "Nearest Police Station"),
                     dbc.Col([
-                        html.Div(listing.get_centre_avg_cases(police_centre, avg_cases, postal_code_area), style = {'font-size': 'large'}),
+                        html.Div(shown(features.avg_cases, "{}"), style = {'font-size': 'large'}),
                         html.Div("Average Yearly Crime Rate", style = {'font-size': 'small', 'color': 'grey'})
                     ], style = {'padding-top': 10})
                     #derived_feature('', listing.get_centre_avg_cases(police_centre, avg_cases), "Average Yearly Crime Rate")
@@ -506,6 +542,11 @@ resale_climate = html.Div(
 
 ### Runnning App ###################################################################
 
+# Per-stage latency histograms and counters, in Prometheus text format
+@app.server.route('/metrics')
+def metrics_endpoint():
+    return render(), 200, {'Content-Type': CONTENT_TYPE}
+
 app.layout = html.Div([
     input_section,
     nav_bar,
@@ -601,17 +642,21 @@ def time_input_dropdown(n1, n_clear):
      dash.dependencies.State("floor-area-input", "value"),
      dash.dependencies.State("lease-input", "value")]
 )
-
+@timed('display_predicted_price')
 def display_predicted_price(n_clicks, apt, ec, condo, time, radius, postal_input, property_type, floor_num, floor_area, lease):
     
     if n_clicks:
 
         ##### Current Global Listing Object #####
         global curr_listing
-        curr_listing = Listing(postal_input, property_type, int(floor_num), float(floor_area), int(lease))
+        curr_listing = Listing(postal_input, property_type, int(floor_num), float(floor_area), int(lease), offline_geocoder)
         
         global price_output, price_psm_output
-        price_output, price_psm_output = curr_listing.pred_price("modelling/", cols, postal_code_area, area_df, sch, train, police_centre, avg_cases)
+        try:
+            price_output, price_psm_output = curr_listing.pred_price("modelling/", cols, postal_index, area_index, sch, train, police_centre, avg_cases, feature_table, model_registry, prediction_cache)
+        except MissingFeatures:
+            # the location features are still shown, with the missing ones as unavailable
+            price_output, price_psm_output = None, None
 
         # For testing
         #curr_listing = Listing('597592', 'Condominium', 6, 99, 70)
@@ -657,8 +702,8 @@ def display_predicted_price(n_clicks, apt, ec, condo, time, radius, postal_input
                    'time' : time_param
         }
         curr_sample = Sample(params, prelim_ds)
-        curr_sample.get_filtered_df(prelim_ds, curr_listing.get_lon(postal_code_area), curr_listing.get_lat(postal_code_area))
-        curr_sample.get_map(curr_listing.get_lon(postal_code_area), curr_listing.get_lat(postal_code_area), price_psm_output, curr_listing.get_building(), curr_listing.get_road_name(), 100)
+        curr_sample.get_filtered_df(prelim_store, curr_listing.get_lon(postal_index), curr_listing.get_lat(postal_index))
+        curr_sample.get_map(curr_listing.get_lon(postal_index), curr_listing.get_lat(postal_index), price_psm_output, curr_listing.get_building(), curr_listing.get_road_name(), 100)
         map_component = html.Iframe(srcDoc = open('sample_map.html', 'r').read(), height = '600')
     
         
@@ -666,16 +711,16 @@ def display_predicted_price(n_clicks, apt, ec, condo, time, radius, postal_input
         
         psm_timeseries_plot = html.Div([
             html.Div(['Aggregated resale market conditions for ', 
-                      html.B(curr_listing.get_planning_area(postal_code_area, area_df).title()),
+                      html.B(curr_listing.get_planning_area(postal_index, area_index).title()),
                       " planning area together with its 2 closest neighbours in the past "  + str(curr_sample.get_time()) + ' years'
             ], style = {'font-size': 'medium'}),
             html.Div('Only resale transactions of ' + ", ".join([property + "s" for property in curr_sample.get_property()]) + "  within each planning area are included within the computation", style = {'font-size': 'medium'}),
-            curr_sample.plot_psm(prelim_ds, area_df, curr_listing.get_planning_area(postal_code_area, area_df), 2), 
+            curr_sample.plot_psm(prelim_cube, area_neighbours, curr_listing.get_planning_area(postal_index, area_index), 2), 
         ])
         
         
         return [overview_section(curr_listing, price_output, price_psm_output), 
-                curr_listing.get_planning_area(postal_code_area, area_df).title(), 
+                curr_listing.get_planning_area(postal_index, area_index).title(), 
                 transaction_features(curr_sample), 
                 map_component, 
                 transaction_table, 
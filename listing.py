@@ -1,26 +1,40 @@
 import pandas as pd
 import numpy as np
 import geopandas as gp
-from amenities import nearest_sch, nearest_police_centre, nearest_train
-from location import postal_search, area_region
-import joblib
-import xgboost
-from xgboost import XGBRegressor
+import requests
+from amenities import nearest_sch, nearest_police_centre, nearest_train, resolve_location_features
+from location import postal_search, planning_area_of, locate_postal_code, PostalCodeIndex, FALLBACK_DEADLINE
+from model import default_registry, PPI, SQFT_PER_SQM, STANDARD_SCALE_VARS, MIN_MAX_VARS
+from features import data_version, PostalCodeFeatures
+from geocoding import normalize_postal_code
+from metrics import timed
 
 class Listing:
-    def __init__(self, postal, property_type, floor_num, floor_area, remaining_lease):
+    def __init__(self, postal, property_type, floor_num, floor_area, remaining_lease, offline_geocoder=None, client=None):
         '''
         :param postal: str, 6 characters
         :param property_type: str, Apartment/Executive Condominium/Condominium
         :param floor_num: float
         :param floor_area: float
         :param remaining_lease: float
+        :param offline_geocoder: optional OfflineGeocoder used before, and when unreachable instead of, OneMap
+        :param client: optional GeocodingClient for OneMap lookups, the shared one if None
         '''
         self.postal = postal
+        self.offline_geocoder = offline_geocoder
+        self.client = client
+        self.location_confidence = None
         self.property_type = property_type
         self.floor_num = int(floor_num)
         self.floor_area = int(floor_area)
         self.remaining_lease = int(remaining_lease)
+        self.location_features = None
+        # Version of the model behind the last prediction
+        self.model_version = None
+        # Location state, resolved lazily on first access and reused by every getter
+        self._location = None
+        self._address = None
+        self._geom = None
         return
 
     # Get postal code of property
@@ -43,56 +57,73 @@ class Listing:
     def get_remaining_lease(self):
         return self.remaining_lease
 
+    # Resolve coordinates (and planning area/region if in our dataset) once, on first access by any getter
+    # historical_df can be the historical_postal_code_area dataframe or, to skip building an index per listing, a PostalCodeIndex
+    def _resolve_location(self, historical_df):
+        if self._location is None:
+            record = PostalCodeIndex.of(historical_df).get(self.postal)
+            # Postal code is in our dataset
+            if record is not None:
+                self._location = list(record)
+            else:
+                result = self.locate()
+                self._location = [result.lon, result.lat, None, None]
+        return self._location
+
+    # Planning area/region of a postal code not in our dataset is derived from its coordinates, once
+    def _resolve_area(self, historical_df, area_centroid):
+        location = self._resolve_location(historical_df)
+        if location[2] is None:
+            location[2], location[3] = planning_area_of(location[0], location[1], area_centroid)
+        return location
+
     # Get longitude of property
     def get_lon(self, historical_df):
-        historical_df['Postal Code'] = historical_df['Postal Code'].apply(lambda x: str(x).zfill(6))
-        if self.postal in historical_df['Postal Code'].tolist():
-            lon = historical_df[historical_df['Postal Code'] == self.postal]['LONGITUDE'].values[0]
-        else:
-            lon = postal_search(self.postal)[0]
-        return lon
+        return self._resolve_location(historical_df)[0]
 
     # Get latitude of property
     def get_lat(self, historical_df):
-        historical_df['Postal Code'] = historical_df['Postal Code'].apply(lambda x: str(x).zfill(6))
-        if self.postal in historical_df['Postal Code'].tolist():
-            lat = historical_df[historical_df['Postal Code'] == self.postal]['LATITUDE'].values[0]
-        else:
-            lat = postal_search(self.postal)[1]
-        return lat
+        return self._resolve_location(historical_df)[1]
+
+    # Locate property not in our dataset; confidence is 'sector' if only approximated from a nearby postal code
+    def locate(self):
+        with timed('geocode'):
+            result = locate_postal_code(self.postal, self.offline_geocoder, self.client)
+        self.location_confidence = result.confidence
+        return result
+
+    # Get (long, lat, building name, road name) from OneMap, fetched once
+    # If OneMap is slow or unreachable the property is named after its postal code, with no road name
+    def _resolve_address(self):
+        if self._address is None:
+            with timed('address_lookup'):
+                try:
+                    self._address = postal_search(self.postal, self.client, FALLBACK_DEADLINE)
+                except requests.RequestException:
+                    self._address = (None, None, 'SINGAPORE ' + normalize_postal_code(self.postal), '')
+        return self._address
 
     # Get building name of property
     def get_building(self):
-        return postal_search(self.postal)[2]
+        return self._resolve_address()[2]
 
     # Get geometry Point of property
     def get_geom(self, historical_df):
-        geometry = gp.points_from_xy([self.get_lon(historical_df)], [self.get_lat(historical_df)])
-        return geometry
+        if self._geom is None:
+            self._geom = gp.points_from_xy([self.get_lon(historical_df)], [self.get_lat(historical_df)])
+        return self._geom
 
     # Get road name property is at 
     def get_road_name(self):
-        return postal_search(self.postal)[3]
+        return self._resolve_address()[3]
 
     # Get planning area property is in
     def get_planning_area(self, historical_df, area_centroid):
-        historical_df['Postal Code'] = historical_df['Postal Code'].apply(lambda x: str(x).zfill(6))
-        # Postal code is in our dataset
-        if self.postal in historical_df['Postal Code'].tolist():
-            planning_area = historical_df[historical_df['Postal Code'] == self.postal]['Planning Area'].values[0]
-        else:
-            planning_area = area_region(self.postal, area_centroid)[0]
-        return planning_area
+        return self._resolve_area(historical_df, area_centroid)[2]
 
     # Get planning region property is in
     def get_planning_region(self, historical_df, area_centroid):
-        historical_df['Postal Code'] = historical_df['Postal Code'].apply(lambda x: str(x).zfill(6))
-        # Postal code is in our dataset
-        if self.postal in historical_df['Postal Code'].tolist():
-            planning_region = historical_df[historical_df['Postal Code'] == self.postal]['Planning Region'].values[0]
-        else:
-            planning_region = area_region(self.postal, area_centroid)[1]
-        return planning_region
+        return self._resolve_area(historical_df, area_centroid)[3]
 
     # Get nearest police centre to property
     def get_police_centre(self, police_centre_gdf, historical_df):
@@ -142,34 +173,88 @@ class Listing:
         name = nearest_sch(geom, sch_gdf)[0]
         return name
 
+    # Get all amenity-derived features of property, resolved once in a single pass
+    def get_location_features(self, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, historical_df):
+        if self.location_features is None:
+            lon, lat = self.get_lon(historical_df), self.get_lat(historical_df)
+            with timed('amenity_search'):
+                self.location_features = resolve_location_features(lon, lat, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc)
+        return self.location_features
+
+    # Get precomputed features of property from the postal code feature table, computing and appending them if the code is new
+    # A location only approximated from a nearby code is used for this valuation but never stored for the code
+    def get_postal_features(self, feature_table, historical_df, area_centroid):
+        record = feature_table.lookup(self.postal)
+        if record is None:
+            lon, lat = self.get_lon(historical_df), self.get_lat(historical_df)
+            area, region = self.get_planning_area(historical_df, area_centroid), self.get_planning_region(historical_df, area_centroid)
+            if self.location_confidence == 'sector':
+                features = self.get_location_features(feature_table.sch_gdf, feature_table.train_gdf, feature_table.police_centre,
+                                                      feature_table.avg_cases_by_npc, historical_df)
+                return PostalCodeFeatures(normalize_postal_code(self.postal), lon, lat, area, region, features)
+            with timed('amenity_search'):
+                record = feature_table.add(self.postal, lon, lat, area, region)
+        self.location_features = record.location
+        return record
+
+    # Get location features and planning area used for prediction, from the feature table if given
+    def get_prediction_inputs(self, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table=None):
+        if feature_table is not None:
+            record = self.get_postal_features(feature_table, historical_postal_code_area, area_centroids)
+            return record.location, record.planning_area
+        features = self.get_location_features(sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, historical_postal_code_area)
+        return features, self.get_planning_area(historical_postal_code_area, area_centroids)
+
     # create dataframe containing property details to be used for prediction
-    def convert_to_df(self, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc): # parse in list of training df col because predict df needs to be in same order
+    def convert_to_df(self, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table=None): # parse in list of training df col because predict df needs to be in same order
+        features, planning_area = self.get_prediction_inputs(historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table)
+
         # Create dataframe for property for prediction
         df = pd.DataFrame(columns=main_df_col, index=range(1))
         df['Area (SQM)'] = self.floor_area / 10.7639 #converting SQFT from input to SQM
         df['Floor Number'] = self.floor_num
         df['PPI'] = 153.3 #2020 Q4 PPI
-        df['Average Cases Per Year'] = self.get_centre_avg_cases(police_centre_gdf, avg_cases_by_npc, historical_postal_code_area)
-        df['Nearest Primary School'] = self.sch_dist(sch_gdf, historical_postal_code_area)
-        df['nearest_station_distance'] = self.train_dist(train_gdf, historical_postal_code_area)
+        df['Average Cases Per Year'] = features.avg_cases
+        df['Nearest Primary School'] = features.sch_dist
+        df['nearest_station_distance'] = features.train_dist
         df['Remaining Lease'] = self.remaining_lease
 
         # if the column(s) is not the base dummy column that got dropped
-        if self.get_planning_area(historical_postal_code_area, area_centroids) in main_df_col:
-            df[self.get_planning_area(historical_postal_code_area, area_centroids)] = 1
+        if planning_area in main_df_col:
+            df[planning_area] = 1
         if self.property_type in main_df_col:
             df[self.property_type] = 1
         # property can have more than 1 line within 1km radius
-        lines = self.train_lines(train_gdf, historical_postal_code_area)
-        for i in lines:
+        for i in features.train_lines:
             if i in main_df_col:
                 df[i] = 1
 
-        # for remaining one-hot encoded columns that are Nan, replace with 0
-        df = df.fillna(0)
+        # for remaining one-hot encoded columns that are Nan, replace with 0; missing amenity features stay NaN and are refused at prediction
+        df = df.fillna({col: 0 for col in df.columns if col not in STANDARD_SCALE_VARS + MIN_MAX_VARS})
         return df
 
-    def pred_psm(self, path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc):
+    # unscaled features of the property written straight into an array laid out for the model, without going through a dataframe
+    def feature_vector(self, layout, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table=None):
+        '''
+        :param layout: FeatureLayout of the model, from ModelRegistry.layout
+        :return: float32 array of 1 row in layout order, the layout's reusable row buffer
+        '''
+        features, planning_area = self.get_prediction_inputs(historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table)
+        with timed('feature_build'):
+            vector = layout.row()
+            layout.set_column(vector, 'Area (SQM)', self.floor_area / SQFT_PER_SQM) #converting SQFT from input to SQM
+            layout.set_column(vector, 'Floor Number', self.floor_num)
+            layout.set_column(vector, 'PPI', PPI)
+            layout.set_column(vector, 'Average Cases Per Year', np.nan if features.avg_cases is None else features.avg_cases)
+            layout.set_column(vector, 'Nearest Primary School', features.sch_dist)
+            layout.set_column(vector, 'nearest_station_distance', features.train_dist)
+            layout.set_column(vector, 'Remaining Lease', self.remaining_lease)
+            # property can have more than 1 line within 1km radius
+            labels = [planning_area, self.property_type] + sorted(features.train_lines)
+            layout.set_one_hot(vector, labels, rows=[0] * len(labels))
+        return vector
+
+    def pred_psm(self, path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table=None, registry=None):
         
         
         '''
@@ -181,42 +266,24 @@ class Listing:
         :param train_gdf: to get nearest stations/lines
         :param police_centre_gdf: to get nearest police centre
         :param avg_cases_by_npc: to get avg crime cases per year for nearest police centre
-        :return: predicted price per sqm
+        :param feature_table: optional FeatureTable of precomputed features by postal code
+        :param registry: optional ModelRegistry to predict with, the shared one for path if None
+        :return: predicted price per sqm, the model version used is kept in model_version
         '''
-        property_df = self.convert_to_df(main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc)
-        s_scaler = joblib.load(path + 'standard_scaler.bin')
-        mm_scaler = joblib.load(path + 'mm_scaler.bin')
-        standardScale_vars = ['Area (SQM)',
-                              'Floor Number',
-                              'PPI',
-                              'Average Cases Per Year',
-                              'Nearest Primary School',
-                              'nearest_station_distance']
-        minMax_vars = ['Remaining Lease']
-        s_scaled = pd.DataFrame(s_scaler.transform(property_df.loc[:, standardScale_vars].copy()),
-                                columns=standardScale_vars)
-        mm_scaled = pd.DataFrame(mm_scaler.transform(property_df.loc[:, minMax_vars].copy()), columns=minMax_vars)
-
-        property_df_scaled = pd.concat([s_scaled,
-                        mm_scaled,
-                        property_df.loc[:, 'Ang Mo Kio':'Executive Condominium'].copy()], axis=1)
-        
-        # Initialize model 
-        model = XGBRegressor()
-
-        # Load model
-        model.load_model(path + 'model_xgboost.bin')
+        # Booster and scalers stay loaded between predictions
+        layout = (registry or default_registry(path)).layout(main_df_col)
+        vector = self.feature_vector(layout, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table)
+        predictions, self.model_version = layout.predict(vector)
+        prediction = predictions[0]
 
-        # Use the loaded model to make predictions
-        prediction = model.predict(property_df_scaled)[0]
-        
         # Covert prediction in SQM to SQFT
-        prediction = prediction / 10.7639
+        prediction = prediction / SQFT_PER_SQM
         
         return prediction
 
 
-    def pred_price(self, path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc):
+    @timed('pred_price')
+    def pred_price(self, path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table=None, registry=None, cache=None):
         '''
         :param path: takes in path where model weights and scalers are stored
         :param main_df_col: list of training dataset column names so that prediction df tallies
@@ -226,9 +293,24 @@ class Listing:
         :param train_gdf: to get nearest stations/lines
         :param police_centre_gdf: to get nearest police centre
         :param avg_cases_by_npc: to get avg crime cases per year for nearest police centre
+        :param feature_table: optional FeatureTable of precomputed features by postal code
+        :param registry: optional ModelRegistry to predict with, the shared one for path if None
+        :param cache: optional PredictionCache, identical listings are only predicted once per model and data version;
+                      predictions from an approximated location are not cached
         :return: predicted price of unit and predicted price per sqm
         '''
-        predicted_psm = self.pred_psm(path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc)
+        if cache is not None:
+            registry = registry or default_registry(path)
+            version = data_version(sch_gdf, train_gdf, feature_table)
+            key = cache.key(self.postal, self.property_type, self.floor_num, self.floor_area, self.remaining_lease, registry.version, version)
+            predicted_psm = cache.get(key)
+            if predicted_psm is not None:
+                self.model_version = registry.version
+                return self.floor_area * predicted_psm, predicted_psm
+        predicted_psm = self.pred_psm(path, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table, registry)
+        if cache is not None and self.location_confidence != 'sector':
+            # under the version that actually predicted, in case the model was swapped in between
+            cache.set(cache.key(self.postal, self.property_type, self.floor_num, self.floor_area, self.remaining_lease, self.model_version, version), predicted_psm)
         unit_price = self.floor_area * predicted_psm
         return unit_price, predicted_psm
 
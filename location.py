@@ -3,59 +3,203 @@ To get longitude, latitude, building name, planning area and planning region of
 '''
 import pandas as pd
 import numpy as np
-import json, math, os, re, requests, time
+import math, os, re, requests, time
 import geopandas as gp
+import shapely
 from shapely import wkt
-from sklearn.neighbors import BallTree
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from amenities import AmenityIndex, haversine
+from geocoding import default_client, GeocodeResult, normalize_postal_code
+from collections import namedtuple
 
-# Using requests to call geographic information from OneMap API
+# Seconds OneMap is waited on when there is a local fallback, well short of the client's own timeouts and retries
+FALLBACK_DEADLINE = 2
+
+# Using requests to call geographic information from OneMap API, through the shared pooled and retrying client
 def get_info(searchVal, returnGeom=True, getAddr=True, pageNum=1):
-    if returnGeom:
-        returnGeom = 'Y'
-    else:
-        returnGeom = 'N'
-
-    if getAddr:
-        getAddr = 'Y'
-    else:
-        getAddr = 'N'
-
-    url = 'https://developers.onemap.sg/commonapi/search?searchVal={}&returnGeom={}&getAddrDetails={}&pageNum={}'
-    url = url.format(searchVal, returnGeom, getAddr, pageNum)
-    #print(url)
-    return json.loads(requests.get(url).content.decode("UTF-8"))['results']
+    return default_client().search(searchVal, returnGeom, getAddr, pageNum)
     
 # Get (long, lat, building name) for unique postal codes only to reduce runtime
-def postal_search(postal_code):
-    response = get_info(searchVal=postal_code)[0]
+# Results are cached on disk so each postal code is only sent to OneMap once
+# timeout bounds the wait in seconds, the lookup still completes in the background and is cached for next time
+def postal_search(postal_code, client=None, timeout=None):
+    response = (client or default_client()).geocode(postal_code, timeout)
     lon = response['LONGITUDE']
     lat = response['LATITUDE']
     building = response['BUILDING']
     road_name = response['BLK_NO'] + " " + response['ROAD_NAME']
     return lon, lat, building, road_name
 
+# Get (long, lat, confidence) of postal code: exact local hit first, then OneMap, then a same-sector local
+# approximation if OneMap does not answer within FALLBACK_DEADLINE seconds
+def locate_postal_code(postal_code, offline_geocoder=None, client=None):
+    deadline = None
+    if offline_geocoder is not None:
+        result = offline_geocoder.locate(postal_code, approximate=False)
+        if result is not None:
+            return result
+        deadline = FALLBACK_DEADLINE
+    try:
+        lon, lat, building, road_name = postal_search(postal_code, client, deadline)
+        return GeocodeResult(float(lon), float(lat), 'exact')
+    except requests.RequestException:
+        result = offline_geocoder.locate(postal_code) if offline_geocoder is not None else None
+        if result is None:
+            raise
+        return result
+
+# Known coordinates, planning area and region of a postal code in our dataset
+PostalRecord = namedtuple('PostalRecord', ['lon', 'lat', 'planning_area', 'planning_region'])
+
+class PostalCodeIndex:
+    """Hash index over historical_postal_code_area.csv
+    Built once with normalized (zero-padded) postal codes as keys, for O(1) lookups that never touch the source frame.
+    """
+    def __init__(self, historical_df):
+        codes = historical_df['Postal Code'].apply(normalize_postal_code)
+        records = zip(historical_df['LONGITUDE'], historical_df['LATITUDE'],
+                      historical_df['Planning Area'], historical_df['Planning Region'])
+        self.records = {}
+        for code, record in zip(codes, records):
+            # first occurrence wins, as with the previous row filters
+            self.records.setdefault(code, PostalRecord(*record))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, postal_code):
+        return normalize_postal_code(postal_code) in self.records
+
+    def get(self, postal_code):
+        '''
+        :return: PostalRecord of the postal code, None if not in our dataset
+        '''
+        return self.records.get(normalize_postal_code(postal_code))
+
+    @classmethod
+    def of(cls, historical):
+        # Accept either a prebuilt index or the raw historical_postal_code_area dataframe
+        return historical if isinstance(historical, cls) else cls(historical)
+
+def area_centroid_index(area_centroids, mode='haversine'):
+    # Planning area centroids indexed once for nearest-centroid lookups
+    return AmenityIndex(area_centroids, 'Planning Area', mode=mode)
+
+class PlanningAreaIndex:
+    """Planning area lookup by point-in-polygon over the planning area boundaries
+    The polygons are prepared and put in an STRtree once; points outside every polygon (e.g. reclaimed land
+    newer than the boundaries) fall back to the nearest planning area centroid.
+    """
+    def __init__(self, area_centroids, polygon_col='Coordinates'):
+        '''
+        :param area_centroids: area centroid dataframe, with planning area boundaries as WKT in polygon_col
+        '''
+        self.data = area_centroids.reset_index(drop=True)
+        self.polygons = [wkt.loads(geom) if isinstance(geom, str) else geom for geom in self.data[polygon_col]]
+        self.prepared = [prep(polygon) for polygon in self.polygons]
+        self.tree = STRtree(self.polygons)
+        # shapely < 2 returns the geometries from tree queries rather than their positions
+        self._positions = {id(polygon): i for i, polygon in enumerate(self.polygons)}
+        self.centroids = area_centroid_index(self.data)
+
+    def locate(self, lon, lat):
+        '''
+        :return: position in self.data of the planning area containing each point
+        '''
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        positions = np.full(len(lon), -1)
+        if hasattr(shapely, 'points'):
+            point_ind, area_ind = self.tree.query(shapely.points(lon, lat), predicate='intersects')
+            # a point on a shared boundary takes the first area it touches
+            first = np.unique(point_ind, return_index=True)[1]
+            positions[point_ind[first]] = area_ind[first]
+        else:
+            for i, point in enumerate(gp.points_from_xy(lon, lat)):
+                for hit in self.tree.query(point):
+                    position = int(hit) if isinstance(hit, (int, np.integer)) else self._positions[id(hit)]
+                    if self.prepared[position].intersects(point):
+                        positions[i] = position
+                        break
+        outside = positions < 0
+        if outside.any():
+            positions[outside] = self.centroids.nearest(lon[outside], lat[outside])[1]
+        return positions
+
+    def lookup(self, lon, lat):
+        '''
+        :return: arrays of planning area and planning region of each point
+        '''
+        rows = self.data.iloc[self.locate(lon, lat)]
+        return rows['Planning Area'].values, rows['Planning_Region'].values
+
+class PlanningAreaNeighbours:
+    """Distances between every pair of planning area centroids, and each planning area's others sorted by distance
+    The centroids never change, so the table is built once and closest planning areas are a dictionary lookup.
+    """
+    def __init__(self, area_centroids):
+        '''
+        :param area_centroids: area centroid dataframe with 'Planning Area', 'Centroid Longitude' and 'Centroid Latitude'
+        '''
+        self.names = area_centroids['Planning Area'].astype(str).str.upper().to_numpy(dtype=object)
+        lon = area_centroids['Centroid Longitude'].to_numpy(dtype=float)
+        lat = area_centroids['Centroid Latitude'].to_numpy(dtype=float)
+        # km, as computed by Sample.haversine
+        self.distances = haversine(lon[:, None], lat[:, None], lon[None, :], lat[None, :])
+        self.neighbours = {}
+        for i, name in enumerate(self.names):
+            if name not in self.neighbours:
+                others = np.flatnonzero(self.names != name)
+                self.neighbours[name] = self.names[others[np.argsort(self.distances[i, others], kind='stable')]].tolist()
+
+    def __len__(self):
+        return len(self.neighbours)
+
+    def __contains__(self, planning_area):
+        return str(planning_area).upper() in self.neighbours
+
+    @classmethod
+    def of(cls, area_centroids):
+        # Accept either a prebuilt table or the raw area centroid dataframe
+        return area_centroids if isinstance(area_centroids, cls) else cls(area_centroids)
+
+    def closest(self, planning_area, num_of_closest=2):
+        '''
+        :return: names of the num_of_closest planning areas closest to planning_area, nearest first
+        '''
+        try:
+            return self.neighbours[str(planning_area).upper()][:num_of_closest]
+        except KeyError:
+            raise KeyError('Unknown planning area {}'.format(planning_area))
+
+def planning_areas_of(lon, lat, area_centroids):
+    '''
+    :param area_centroids: area centroid dataframe, prebuilt PlanningAreaIndex, or prebuilt centroid index from area_centroid_index
+    :return: arrays of planning area and planning region of each point
+    '''
+    if isinstance(area_centroids, AmenityIndex):
+        # nearest centroid only
+        closest = area_centroids.data.iloc[area_centroids.nearest(lon, lat)[1]]
+        return closest['Planning Area'].values, closest['Planning_Region'].values
+    if not isinstance(area_centroids, PlanningAreaIndex):
+        area_centroids = PlanningAreaIndex(area_centroids)
+    return area_centroids.lookup(lon, lat)
+
+def planning_area_of(lon, lat, area_centroids):
+    '''
+    :param area_centroids: area centroid dataframe, prebuilt PlanningAreaIndex, or prebuilt centroid index from area_centroid_index
+    :return: planning area and planning region of the point
+    '''
+    areas, regions = planning_areas_of([float(lon)], [float(lat)], area_centroids)
+    return areas[0], regions[0]
+
 def area_region(postal_code, area_centroids):
+    '''
+    :param area_centroids: area centroid dataframe, prebuilt PlanningAreaIndex, or prebuilt centroid index from area_centroid_index
+    '''
     lon, lat, building, road_name = postal_search(postal_code)
-    geometry = gp.points_from_xy([lon], [lat])
-    property_radians = np.ravel([geometry.y * np.pi / 180, geometry.x * np.pi / 180])
-    area_centroids_copy = area_centroids.copy()
-    right_geom_col = area_centroids.geometry.name
-
-    area_centroids_copy[right_geom_col] = area_centroids[right_geom_col].apply(wkt.loads)
-    area_centroids_copy = gp.GeoDataFrame(area_centroids_copy, geometry=right_geom_col)
-
-    right_radians = np.array(
-        area_centroids_copy[right_geom_col].apply(lambda geom: (geom.y * np.pi / 180, geom.x * np.pi / 180)).to_list())
-
-    tree = BallTree(right_radians, leaf_size=15, metric='haversine')
-
-    # Find closest planning area
-    dist, ind = tree.query([property_radians], k=1)
-    indices = ind.transpose()
-    closest = indices[0]
-    closest_area = area_centroids_copy.iloc[closest]['Planning Area'].values[0]
-    region = area_centroids_copy.iloc[closest]['Planning_Region'].values[0]
-    return closest_area, region
+    return planning_area_of(lon, lat, area_centroids)
 
 '''
 # Testing
@@ -0,0 +1,190 @@
+'''
+Per-stage latency histograms and counters of the valuation pipeline, in Prometheus text format
+    with timed('geocode'):
+        ...
+    @timed('plot_psm')
+    def plot_psm(...):
+        ...
+    render()  # body of a /metrics endpoint
+Metrics are kept per process; with the service's process executor each worker process records its own.
+Set VALUATION_STAGE_LOGS=1 (or call enable_stage_logs) to also log one JSON line per timed stage.
+'''
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a cached lookup to a slow OneMap call or map render
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger('valuation.metrics')
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[label]) for label in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in values]
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, optionally split by labels"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(tuple(str(labels[label]) for label in self.labels))
+        return sum(counts[0]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', dict(labels, le=_format(bound)), cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Named metrics of this process, rendered together"""
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric {} is already registered as a {}'.format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        '''
+        :return: every metric in the Prometheus text exposition format
+        '''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                label_text = ','.join('{}="{}"'.format(key, _escape(val)) for key, val in labels.items())
+                lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram('valuation_stage_seconds', 'Time spent in each stage of the valuation pipeline', ['stage'])
+STAGE_ERRORS = REGISTRY.counter('valuation_stage_errors_total', 'Stages that raised an exception', ['stage'])
+GEOCODE_CACHE = REGISTRY.counter('geocode_cache_lookups_total', 'Geocode cache lookups by result (memory, disk or miss)', ['result'])
+GEOCODE_REQUESTS = REGISTRY.counter('onemap_requests_total', 'HTTP requests made to OneMap by outcome (ok, not_found, error)', ['outcome'])
+PREDICTION_CACHE = REGISTRY.counter('prediction_cache_lookups_total', 'Prediction cache lookups by result (hit or miss)', ['result'])
+
+_stage_logs = os.environ.get('VALUATION_STAGE_LOGS', '').lower() in ('1', 'true', 'yes')
+
+
+def enable_stage_logs(enabled=True):
+    '''
+    Log one JSON line per timed stage to the 'valuation.metrics' logger, at INFO level
+    '''
+    global _stage_logs
+    _stage_logs = enabled
+
+
+class timed:
+    """Context manager and decorator recording the duration of a pipeline stage in STAGE_SECONDS"""
+    def __init__(self, stage, **fields):
+        '''
+        :param stage: stage name, the 'stage' label of the histogram
+        :param fields: extra fields of the structured log line
+        '''
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, stage=self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        if _stage_logs:
+            logger.info(json.dumps(dict(self.fields, event='stage', stage=self.stage, seconds=round(seconds, 6),
+                                        error=exc_type.__name__ if exc_type is not None else None), default=str))
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage, **self.fields):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def render():
+    return REGISTRY.render()
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,270 @@
+'''
+Resident price per sqm model, so that predictions do not reload the booster and scalers from disk
+A model directory holds model_xgboost.bin (or its JSON export model_xgboost.json, see inference.py), standard_scaler.bin,
+mm_scaler.bin and optionally a VERSION file:
+    registry = default_registry('modelling/')
+    psm, version = registry.predict(property_df)
+    registry.swap('modelling/v2/')  # in-flight predictions finish on the model they started with
+Features can also be written straight into a preallocated array laid out for the model:
+    layout = registry.layout(main_df_col)
+    features = layout.empty(n)
+    layout.set_column(features, 'Floor Number', floor_num)
+    psm, version = layout.predict(features)
+'''
+import hashlib
+import os
+import threading
+import joblib
+import numpy as np
+from collections import namedtuple
+from inference import BoosterEngine, TreeEngine, JSON_MODEL_FILE
+from metrics import timed
+try:
+    import xgboost
+except ImportError:
+    # the JSON export of the model can still be evaluated with TreeEngine
+    xgboost = None
+
+MODEL_FILE = 'model_xgboost.bin'
+STANDARD_SCALER_FILE = 'standard_scaler.bin'
+MM_SCALER_FILE = 'mm_scaler.bin'
+VERSION_FILE = 'VERSION'
+
+STANDARD_SCALE_VARS = ['Area (SQM)',
+                       'Floor Number',
+                       'PPI',
+                       'Average Cases Per Year',
+                       'Nearest Primary School',
+                       'nearest_station_distance']
+MIN_MAX_VARS = ['Remaining Lease']
+# One-hot encoded columns follow the scaled ones, in training dataset order
+ONE_HOT_START, ONE_HOT_END = 'Ang Mo Kio', 'Executive Condominium'
+PPI = 153.3 # 2020 Q4 PPI
+SQFT_PER_SQM = 10.7639
+
+# Everything loaded from one model directory, never modified after loading except for the layouts compiled for it
+LoadedModel = namedtuple('LoadedModel', ['version', 'path', 'engine', 's_scaler', 'mm_scaler', 'layouts'])
+
+
+class MissingFeatures(ValueError):
+    """A feature the model needs is missing (NaN) for some rows, e.g. the distance to the nearest school when no
+    school is open as of the valuation date. The model was never trained on such rows, so they are not predicted.
+    """
+
+
+class FeatureLayout:
+    """Column positions of the model input, compiled once from the training dataset columns
+    Both scalers are folded into one affine transform (x * scale + offset) over the scaled columns, applied in place
+    to a float32 array, so building and scaling a batch allocates nothing beyond the array itself.
+    """
+    def __init__(self, main_df_col, s_scaler, mm_scaler, loaded=None):
+        '''
+        :param main_df_col: list of training dataset column names
+        :param s_scaler: fitted StandardScaler over STANDARD_SCALE_VARS
+        :param mm_scaler: fitted MinMaxScaler over MIN_MAX_VARS
+        :param loaded: LoadedModel to predict with, predict() is unavailable if None
+        '''
+        main_df_col = list(main_df_col)
+        one_hot = main_df_col[main_df_col.index(ONE_HOT_START):main_df_col.index(ONE_HOT_END) + 1]
+        self.columns = STANDARD_SCALE_VARS + MIN_MAX_VARS + one_hot
+        self.position = {col: i for i, col in enumerate(self.columns)}
+        self.loaded = loaded
+
+        # StandardScaler: (x - mean_) / scale_
+        mean = s_scaler.mean_ if s_scaler.mean_ is not None else 0.0
+        std = s_scaler.scale_ if s_scaler.scale_ is not None else 1.0
+        s_scale = np.broadcast_to(1.0 / np.asarray(std, dtype=np.float64), len(STANDARD_SCALE_VARS))
+        s_offset = np.broadcast_to(-np.asarray(mean, dtype=np.float64), len(STANDARD_SCALE_VARS)) * s_scale
+        # MinMaxScaler: x * scale_ + min_
+        self.scale = np.concatenate([s_scale, mm_scaler.scale_])
+        self.offset = np.concatenate([s_offset, mm_scaler.min_])
+        self.clip = getattr(mm_scaler, 'clip', False) and mm_scaler.feature_range
+        self.n_scaled = len(self.scale)
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self.columns)
+
+    def empty(self, n=1):
+        '''
+        :return: zeroed float32 array of n rows laid out for the model, unset one-hot columns are already 0
+        '''
+        return np.zeros((n, len(self.columns)), dtype=np.float32)
+
+    def row(self):
+        '''
+        :return: zeroed single-row buffer, reused by every call on the same thread, so only valid until the next call
+        '''
+        buffer = getattr(self._local, 'row', None)
+        if buffer is None:
+            buffer = self._local.row = self.empty(1)
+        else:
+            buffer.fill(0)
+        return buffer
+
+    def set_column(self, features, col, values):
+        features[:, self.position[col]] = values
+
+    def set_one_hot(self, features, labels, rows=None):
+        '''
+        Set the one-hot column of each label to 1, skipping labels without a column (e.g. the dropped base dummy)
+        :param labels: one label per row of features, or one per entry of rows
+        :param rows: row of each label, all rows in order if None
+        '''
+        cols = np.array([self.position.get(label, -1) if isinstance(label, str) else -1 for label in labels], dtype=np.int64)
+        rows = np.arange(len(cols)) if rows is None else np.asarray(rows, dtype=np.int64)
+        hit = cols >= self.n_scaled
+        features[rows[hit], cols[hit]] = 1
+
+    def missing(self, features):
+        '''
+        :return: boolean array, whether each row lacks any of the scaled features (one-hot columns are never missing)
+        '''
+        return np.isnan(features[:, :self.n_scaled]).any(axis=1)
+
+    def transform(self, features):
+        '''
+        Scale features in place
+        :raises MissingFeatures: if any row lacks a scaled feature, see missing()
+        '''
+        missing = np.isnan(features[:, :self.n_scaled])
+        if missing.any():
+            columns = [col for col, gap in zip(self.columns, missing.any(axis=0)) if gap]
+            raise MissingFeatures('{} of {} rows have no {}'.format(int(missing.any(axis=1).sum()), len(features), ', '.join(columns)))
+        # one-hot columns are never scaled, so only the scaled columns are touched, in float64 like the scalers
+        scaled = features[:, :self.n_scaled] * self.scale + self.offset
+        if self.clip:
+            np.clip(scaled[:, len(STANDARD_SCALE_VARS):], self.clip[0], self.clip[1], out=scaled[:, len(STANDARD_SCALE_VARS):])
+        features[:, :self.n_scaled] = scaled
+        return features
+
+    def predict(self, features):
+        '''
+        :param features: unscaled features from empty(), scaled in place
+        :return: predicted price per sqm of each row, and the version of the model that predicted them
+        '''
+        with timed('scaling'):
+            self.transform(features)
+        with timed('model_predict'):
+            predictions = self.loaded.engine.predict(features)
+        return predictions, self.loaded.version
+
+
+class ModelRegistry:
+    """Keeps one model version loaded and swaps it atomically for another"""
+    def __init__(self, path=None, engine=None):
+        '''
+        :param path: model directory to load now, nothing is loaded until swap() if None
+        :param engine: 'booster' or 'numpy' (TreeEngine), the booster if xgboost is installed if None
+        '''
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._loaded = None
+        if path is not None:
+            self.swap(path)
+
+    @property
+    def current(self):
+        '''
+        :return: LoadedModel currently serving predictions
+        '''
+        loaded = self._loaded
+        if loaded is None:
+            raise RuntimeError('No model loaded, call swap() with a model directory first')
+        return loaded
+
+    @property
+    def version(self):
+        return self.current.version
+
+    def swap(self, path):
+        '''
+        Load the model in path and make it the current one
+        The new model is fully loaded before it replaces the old one, so a failed load leaves the old one serving
+        :param path: model directory
+        :return: version of the newly loaded model
+        '''
+        loaded = load_model(path, self.engine)
+        with self._lock:
+            self._loaded = loaded
+        return loaded.version
+
+    def reload(self):
+        '''
+        Reload the current model directory, e.g. after its files were replaced
+        :return: version of the reloaded model
+        '''
+        return self.swap(self.current.path)
+
+    def layout(self, main_df_col):
+        '''
+        :param main_df_col: list of training dataset column names
+        :return: FeatureLayout of the current model, compiled once per model and set of columns
+        '''
+        # the layout keeps its model, so a concurrent swap cannot mix two versions
+        loaded = self.current
+        key = tuple(main_df_col)
+        layout = loaded.layouts.get(key)
+        if layout is None:
+            layout = loaded.layouts.setdefault(key, FeatureLayout(key, loaded.s_scaler, loaded.mm_scaler, loaded))
+        return layout
+
+    def predict(self, property_df):
+        '''
+        :param property_df: unscaled property dataframe with the training dataset columns
+        :return: predicted price per sqm of each row, and the version of the model that predicted them
+        '''
+        layout = self.layout(property_df.columns)
+        return layout.predict(property_df.loc[:, layout.columns].to_numpy(dtype=np.float32))
+
+
+def load_model(path, engine=None):
+    '''
+    :param path: model directory
+    :param engine: 'booster' or 'numpy' (TreeEngine), the booster if xgboost is installed if None
+    :return: LoadedModel of the model and scalers in path
+    '''
+    s_scaler = joblib.load(os.path.join(path, STANDARD_SCALER_FILE))
+    mm_scaler = joblib.load(os.path.join(path, MM_SCALER_FILE))
+    engine = engine or ('booster' if xgboost is not None else 'numpy')
+    if engine not in ('booster', 'numpy'):
+        raise ValueError('Unknown engine {}, expected booster or numpy'.format(engine))
+    json_path = os.path.join(path, JSON_MODEL_FILE)
+    if engine == 'numpy' and os.path.exists(json_path):
+        model = TreeEngine.from_json(json_path)
+    else:
+        if xgboost is None:
+            raise ImportError('xgboost is needed to load {}, or export it to JSON with inference.py'.format(MODEL_FILE))
+        booster = xgboost.Booster()
+        booster.load_model(os.path.join(path, MODEL_FILE))
+        model = BoosterEngine(booster) if engine == 'booster' else TreeEngine.from_booster(booster)
+    return LoadedModel(model_version(path), path, model, s_scaler, mm_scaler, {})
+
+
+def model_version(path):
+    '''
+    :return: contents of the VERSION file in path, else a hash of the model and scaler files present
+    '''
+    version_path = os.path.join(path, VERSION_FILE)
+    if os.path.exists(version_path):
+        with open(version_path) as f:
+            return f.read().strip()
+    digest = hashlib.sha1()
+    for name in (MODEL_FILE, JSON_MODEL_FILE, STANDARD_SCALER_FILE, MM_SCALER_FILE):
+        if os.path.exists(os.path.join(path, name)):
+            with open(os.path.join(path, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def default_registry(path='modelling/'):
+    # Shared registry per model directory, loaded on first use
+    key = os.path.abspath(path)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(path)
+        return _registries[key]
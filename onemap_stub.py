@@ -0,0 +1,95 @@
+'''
+Local stand-in for the OneMap search API, serving postal codes from our own datasets
+Used to exercise the geocoding client, the valuation service and benchmarks without network access:
+    with StubOneMapServer(pd.read_csv('datasets/historical_postal_code_area.csv')) as url:
+        client = GeocodingClient(base_url=url)
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class StubOneMapServer:
+    """OneMap-shaped search endpoint on localhost, answering from a postal code dataframe"""
+    def __init__(self, postal_code_area, host='127.0.0.1', port=0, delay=0, fail_first=0, fail_status=503, error_codes=()):
+        '''
+        :param postal_code_area: dataframe with 'Postal Code', 'LONGITUDE' and 'LATITUDE' columns, optionally 'BUILDING'
+        :param port: port to listen on, any free port if 0
+        :param delay: seconds to wait before each response, to simulate OneMap latency
+        :param fail_first: number of initial requests answered with fail_status, to exercise retries
+        :param fail_status: HTTP status of those failed requests
+        :param error_codes: search values answered with a OneMap error body instead of results
+        '''
+        self.records = {}
+        for row in postal_code_area.to_dict('records'):
+            code = str(row['Postal Code']).zfill(6)
+            self.records[code] = {'SEARCHVAL': code,
+                                  'BLK_NO': '1',
+                                  'ROAD_NAME': 'STUB ROAD',
+                                  'BUILDING': str(row.get('BUILDING', 'STUB BUILDING {}'.format(code))),
+                                  'ADDRESS': '1 STUB ROAD SINGAPORE {}'.format(code),
+                                  'POSTAL': code,
+                                  'LATITUDE': str(row['LATITUDE']),
+                                  'LONGITUDE': str(row['LONGITUDE'])}
+        self.delay = delay
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.error_codes = set(error_codes)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/commonapi/search'.format(host, port)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    fail = stub.requests <= stub.fail_first
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if fail:
+                    self.send_error(stub.fail_status)
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                code = query.get('searchVal', [''])[0]
+                if code in stub.error_codes:
+                    body = json.dumps({'error': 'Invalid search value'}).encode('UTF-8')
+                else:
+                    results = [stub.records[code]] if code in stub.records else []
+                    body = json.dumps({'found': len(results), 'totalNumPages': 1, 'pageNum': 1, 'results': results}).encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
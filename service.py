@@ -0,0 +1,292 @@
+'''
+Standalone JSON valuation service, for machine-to-machine valuations without rendering the Dash UI
+    python service.py --port 8051 --workers 8
+    python service.py --stub-geocoder  # OneMap lookups answered locally from our own datasets, no network needed
+Endpoints:
+    POST /valuation   {"postal_code": "098656", "property_type": "Condominium", "floor_num": 6, "floor_area": 999, "remaining_lease": 70}
+    POST /valuations  {"listings": [{...}, ...]}
+    GET  /health
+Valuations run on a thread or process worker pool; requests beyond max_pending in flight are turned away with 503
+rather than queued, and requests that take longer than the timeout get 504. The app from create_app can be served
+by any WSGI server in place of the Flask development server.
+'''
+import argparse
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+import numpy as np
+import pandas as pd
+import requests
+from flask import Flask, jsonify, request
+import metrics
+from amenities import school_index, train_index, police_centre_index
+from cache import PredictionCache
+from features import FeatureTable, FEATURE_TABLE_PATH
+from geocoding import GeocodingClient, OfflineGeocoder, PostalCodeNotFound
+from listing import Listing
+from location import PlanningAreaIndex, PostalCodeIndex
+from model import ModelRegistry, MissingFeatures
+from valuation import value_listings, LISTING_COLUMNS
+
+PROPERTY_TYPES = ('Apartment', 'Condominium', 'Executive Condominium')
+# JSON field -> (listings dataframe column, type)
+FIELDS = {'postal_code': ('Postal Code', str),
+          'property_type': ('Property Type', str),
+          'floor_num': ('Floor Number', float),
+          'floor_area': ('Floor Area', float),
+          'remaining_lease': ('Remaining Lease', float)}
+MAX_BATCH = 10000
+
+
+class Overloaded(Exception):
+    """Raised when the service already has max_pending valuations in flight"""
+
+
+class ValuationContext:
+    """Datasets, indexes and model used by every valuation, loaded once per worker process"""
+    def __init__(self, path='datasets/', model_path='modelling/', geocoder_url=None, engine=None):
+        '''
+        :param path: datasets folder
+        :param model_path: model directory
+        :param geocoder_url: OneMap search URL, e.g. of a StubOneMapServer; the shared OneMap client if None
+        :param engine: inference engine of the model, see ModelRegistry
+        '''
+        self.model_path = model_path
+        # only the training columns are needed, not the training data
+        self.main_df_col = list(pd.read_csv(path + 'modelling_dataset.csv', nrows=0).columns)
+        self.sch = school_index(pd.read_csv(path + 'primary_sch_gdf.csv'))
+        self.train = train_index(pd.read_csv(path + 'train_gdf.csv'))
+        self.police_centre = police_centre_index(pd.read_csv(path + 'police_centre_gdf.csv'))
+        self.avg_cases = pd.read_csv(path + 'average_cases_by_npc.csv')
+        postal_code_area = pd.read_csv(path + 'historical_postal_code_area.csv')
+        self.postal_index = PostalCodeIndex(postal_code_area)
+        self.area_index = PlanningAreaIndex(pd.read_csv(path + 'area_centroid.csv'))
+        self.feature_table = FeatureTable.load_or_build(os.path.join(path, os.path.basename(FEATURE_TABLE_PATH)), postal_code_area,
+                                                        self.sch, self.train, self.police_centre, self.avg_cases)
+        self.offline_geocoder = OfflineGeocoder.from_datasets(path)
+        self.client = GeocodingClient(base_url=geocoder_url) if geocoder_url else None
+        self.registry = ModelRegistry(model_path, engine)
+        self.cache = PredictionCache()
+
+    def value(self, fields):
+        '''
+        :param fields: dict of FIELDS, as returned by parse_listing
+        :return: dict of the predicted price, price per sqft, model version and location confidence
+        '''
+        listing = Listing(fields['postal_code'], fields['property_type'], fields['floor_num'], fields['floor_area'],
+                          fields['remaining_lease'], self.offline_geocoder, self.client)
+        price, psf = listing.pred_price(self.model_path, self.main_df_col, self.postal_index, self.area_index, self.sch, self.train,
+                                        self.police_centre, self.avg_cases, self.feature_table, self.registry, self.cache)
+        return {'postal_code': str(fields['postal_code']),
+                'price': float(price),
+                'psf': float(psf),
+                'model_version': listing.model_version,
+                'location_confidence': listing.location_confidence or 'exact'}
+
+    def value_many(self, listings):
+        '''
+        :param listings: list of dicts of FIELDS, as returned by parse_listing
+        :return: list of dicts as from value(), with price and psf None where the postal code could not be located
+        '''
+        df = pd.DataFrame({col: [fields[field] for fields in listings] for field, (col, _) in FIELDS.items()}, columns=LISTING_COLUMNS)
+        valued = value_listings(df, self.main_df_col, self.postal_index, self.area_index, self.sch, self.train, self.police_centre,
+                                self.avg_cases, self.feature_table, self.registry, self.model_path, self.offline_geocoder, self.client)
+        return [{'postal_code': postal_code,
+                 'price': None if np.isnan(price) else float(price),
+                 'psf': None if np.isnan(psf) else float(psf),
+                 'model_version': version,
+                 'planning_area': None if pd.isnull(area) else area,
+                 'location_confidence': None if pd.isnull(confidence) else confidence}
+                for postal_code, price, psf, version, area, confidence
+                in zip(df['Postal Code'], valued['Predicted Price'], valued['Predicted PSF'], valued['Model Version'],
+                       valued['Planning Area'], valued['Location Confidence'])]
+
+
+def parse_listing(payload):
+    '''
+    :param payload: JSON object of one listing
+    :return: dict of FIELDS with values of the expected types
+    :raises ValueError: naming the first missing or invalid field
+    '''
+    if not isinstance(payload, dict):
+        raise ValueError('Expected a JSON object with fields {}'.format(', '.join(FIELDS)))
+    fields = {}
+    for field, (_, kind) in FIELDS.items():
+        if payload.get(field) is None:
+            raise ValueError('Missing field {}'.format(field))
+        try:
+            fields[field] = kind(payload[field])
+        except (TypeError, ValueError):
+            raise ValueError('Invalid {}: {!r}'.format(field, payload[field]))
+    postal_code = fields['postal_code'].strip()
+    if not postal_code.isdigit() or len(postal_code) > 6:
+        raise ValueError('Invalid postal_code: {!r}'.format(payload['postal_code']))
+    fields['postal_code'] = postal_code.zfill(6)
+    if fields['property_type'] not in PROPERTY_TYPES:
+        raise ValueError('Invalid property_type: {!r}, expected one of {}'.format(fields['property_type'], ', '.join(PROPERTY_TYPES)))
+    for field in ('floor_num', 'floor_area', 'remaining_lease'):
+        if not np.isfinite(fields[field]) or fields[field] <= 0:
+            raise ValueError('Invalid {}: {!r}'.format(field, payload[field]))
+    return fields
+
+
+# Context of this process, set once by _init_worker
+_context = None
+
+
+def _init_worker(context_kwargs):
+    global _context
+    _context = ValuationContext(**context_kwargs)
+
+
+@metrics.timed('service_valuation')
+def _value(fields):
+    return _context.value(fields)
+
+
+@metrics.timed('service_batch_valuation')
+def _value_many(listings):
+    return _context.value_many(listings)
+
+
+class ValuationService:
+    """Worker pool running valuations, with a cap on valuations in flight and a timeout per request"""
+    def __init__(self, workers=8, executor='thread', timeout=10, max_pending=None, **context_kwargs):
+        '''
+        :param workers: number of worker threads or processes
+        :param executor: 'thread' to share one context between threads, 'process' for one context per process
+        :param timeout: seconds a request waits for its valuation
+        :param max_pending: valuations in flight (running or queued) before new requests are turned away, 4 per worker if None
+        :param context_kwargs: passed to ValuationContext
+        '''
+        if executor == 'thread':
+            _init_worker(context_kwargs)
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        elif executor == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context_kwargs,))
+        else:
+            raise ValueError('Unknown executor {}, expected thread or process'.format(executor))
+        self.executor = executor
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending or 4 * workers
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        '''
+        Run func on the pool and wait for its result
+        :raises Overloaded: if max_pending valuations are already in flight
+        :raises TimeoutError: if the result takes longer than the timeout
+        '''
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise Overloaded('{} valuations in flight'.format(self.pending))
+            self.pending += 1
+        future = self.pool.submit(func, *args)
+        # the slot is freed when the work is done, not when the request gives up on it
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def create_app(service):
+    '''
+    :param service: ValuationService running the valuations
+    :return: Flask app of the JSON endpoints
+    '''
+    app = Flask(__name__)
+
+    @app.route('/valuation', methods=['POST'])
+    def valuation():
+        return _respond(service, _value, lambda payload: [parse_listing(payload)])
+
+    @app.route('/valuations', methods=['POST'])
+    def valuations():
+        def parse(payload):
+            listings = payload.get('listings') if isinstance(payload, dict) else None
+            if not isinstance(listings, list) or not listings:
+                raise ValueError('Expected a JSON object with a non-empty listings array')
+            if len(listings) > MAX_BATCH:
+                raise ValueError('At most {} listings per request'.format(MAX_BATCH))
+            return [[parse_listing(listing) for listing in listings]]
+        return _respond(service, _value_many, parse, lambda results: {'valuations': results})
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        # with the process executor, stages run in the workers are recorded there and not seen here
+        return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'status': 'ok', 'executor': service.executor, 'workers': service.workers,
+                        'pending': service.pending, 'max_pending': service.max_pending})
+
+    return app
+
+
+def _respond(service, func, parse, wrap=None):
+    try:
+        args = parse(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        result = service.run(func, *args)
+    except Overloaded as e:
+        response = jsonify({'error': 'Service overloaded, {}'.format(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    except TimeoutError:
+        return jsonify({'error': 'Valuation took longer than {}s'.format(service.timeout)}), 504
+    except PostalCodeNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except MissingFeatures as e:
+        return jsonify({'error': 'Cannot value this listing, {}'.format(e)}), 500
+    except requests.RequestException as e:
+        return jsonify({'error': 'Geocoding failed: {}'.format(e)}), 502
+    return jsonify(wrap(result) if wrap is not None else result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='JSON valuation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8051)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds per request')
+    parser.add_argument('--max-pending', type=int, default=None, help='valuations in flight before answering 503, 4 per worker by default')
+    parser.add_argument('--datasets', default='datasets/')
+    parser.add_argument('--model', default='modelling/')
+    parser.add_argument('--engine', choices=('booster', 'numpy'), default=None)
+    parser.add_argument('--stage-logs', action='store_true', help='log one JSON line per timed pipeline stage')
+    parser.add_argument('--stub-geocoder', action='store_true', help='answer OneMap lookups from the datasets folder instead of the network')
+    args = parser.parse_args()
+    if args.stage_logs:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        metrics.enable_stage_logs()
+
+    stub = None
+    geocoder_url = None
+    if args.stub_geocoder:
+        from onemap_stub import StubOneMapServer
+        stub = StubOneMapServer(pd.read_csv(args.datasets + 'historical_postal_code_area.csv'))
+        geocoder_url = stub.start()
+    service = ValuationService(args.workers, args.executor, args.timeout, args.max_pending, path=args.datasets,
+                               model_path=args.model, geocoder_url=geocoder_url, engine=args.engine)
+    try:
+        create_app(service).run(host=args.host, port=args.port, threaded=True)
+    finally:
+        service.close()
+        if stub is not None:
+            stub.stop()
@@ -0,0 +1,27 @@
+'''
+Shared fixtures: the datasets folder, and a sample of transactions from preliminary_dataset.csv when it is there,
+synthetic ones around the real postal codes of historical_postal_code_area.csv otherwise
+'''
+import os
+import pandas as pd
+import pytest
+
+DATASETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datasets', '')
+N_TRANSACTIONS = 20000
+
+
+@pytest.fixture(scope='session')
+def datasets():
+    return DATASETS
+
+
+@pytest.fixture(scope='session')
+def transactions():
+    path = DATASETS + 'preliminary_dataset.csv'
+    if os.path.exists(path):
+        data = pd.read_csv(path)
+        data['Sale Date'] = pd.to_datetime(data['Sale Date'], format='%Y-%m-%d')
+        # a sample keeps its row labels, so positions and labels differ as they would after any filtering
+        return data.sample(min(N_TRANSACTIONS, len(data)), random_state=0)
+    from benchmarks.synthetic import SyntheticData
+    return SyntheticData(DATASETS).transactions(N_TRANSACTIONS)
@@ -0,0 +1,38 @@
+'''
+TemporalAmenityIndex on the bundled schools: dates past every closing date and before any opening date
+'''
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+from amenities import school_index
+
+LON = np.array([103.8, 103.85, 103.9, 103.95])
+LAT = np.array([1.3, 1.35, 1.4, 1.33])
+
+
+@pytest.fixture(scope='module')
+def schools(datasets):
+    return pd.read_csv(datasets + 'primary_sch_gdf.csv')
+
+
+def test_past_every_closing_date(schools, caplog):
+    with caplog.at_level(logging.WARNING, logger='valuation.amenities'):
+        index = school_index(schools)
+    assert 'No Name open from' in caplog.text
+    last_open = index.boundaries[-1] - np.timedelta64(1, 'D')
+    assert len(index.as_of(last_open)) > 0
+    assert index.as_of('2100-01-01') is index.as_of(last_open)
+
+    expected = index.features(LON, LAT, 2000, as_of=last_open)
+    result = index.features(LON, LAT, 2000, as_of='2100-01-01')
+    assert np.isfinite(result['distance']).all()
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_before_any_opening_date(schools):
+    index = school_index(schools)
+    result = index.features(LON, LAT, 2000, as_of='1800-01-01')
+    assert np.isnan(result['distance']).all()
+    assert result['nearest'].isnull().all()
+    assert (result['count'] == 0).all()
@@ -0,0 +1,97 @@
+'''
+FeatureTable: single and batch lookups, rebuilds on edited inputs, and concurrent writers appending to one file
+'''
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pytest
+import features
+from amenities import school_index, train_index, police_centre_index
+from features import FeatureTable
+
+N_CODES = 300
+AS_OF = '2020-01-01'
+
+
+@pytest.fixture(scope='module')
+def inputs(datasets):
+    return (pd.read_csv(datasets + 'historical_postal_code_area.csv').iloc[:N_CODES],
+            school_index(pd.read_csv(datasets + 'primary_sch_gdf.csv')),
+            train_index(pd.read_csv(datasets + 'train_gdf.csv')),
+            police_centre_index(pd.read_csv(datasets + 'police_centre_gdf.csv')),
+            pd.read_csv(datasets + 'average_cases_by_npc.csv'))
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'postal_code_features.npz')
+
+
+def load(path, inputs):
+    return FeatureTable.load(path, *inputs[1:])
+
+
+def test_lookup_matches_lookup_many(inputs):
+    table = FeatureTable.build(*inputs, as_of=AS_OF)
+    codes = inputs[0]['Postal Code'].tolist()
+    batch = table.lookup_many(codes)
+    assert len(batch) == len(table)
+    for code, row in batch.iterrows():
+        record = table.lookup(code)
+        assert (record.lon, record.lat, record.planning_area, record.planning_region) == (row['lon'], row['lat'], row['planning_area'], row['planning_region'])
+        location = record.location
+        assert location.avg_cases == row['avg_cases']
+        assert isinstance(location.avg_cases, int) and row['avg_cases'] == int(row['avg_cases'])
+        for field in ('sch_name', 'police_centre', 'train_stations', 'train_lines'):
+            assert getattr(location, field) == row[field]
+        for field in ('sch_dist', 'police_centre_dist', 'train_dist'):
+            np.testing.assert_equal(getattr(location, field), row[field])
+
+
+def test_rebuilds_on_edited_inputs(inputs, path):
+    historical, sch, train, police_centre, avg_cases = inputs
+    table = FeatureTable.load_or_build(path, *inputs, as_of=AS_OF)
+    table.add('999001', 103.85, 1.3, 'DOWNTOWN CORE', 'CENTRAL REGION')
+    # same inputs: the saved table, with its appended code, is current
+    assert '999001' in FeatureTable.load_or_build(path, *inputs, as_of=AS_OF)
+
+    edited = avg_cases.copy()
+    edited['Average Cases Per Year'] += 100
+    rebuilt = FeatureTable.load_or_build(path, historical, sch, train, police_centre, edited, as_of=AS_OF)
+    assert rebuilt.inputs != table.inputs
+    assert '999001' not in rebuilt
+    code = historical['Postal Code'].iloc[0]
+    assert rebuilt.lookup(code).location.avg_cases == table.lookup(code).location.avg_cases + 100
+    # and the rebuilt table replaced the stale one on disk
+    assert load(path, inputs).inputs == rebuilt.inputs
+
+
+def test_writers_keep_each_others_rows(inputs, path):
+    FeatureTable.load_or_build(path, *inputs, as_of=AS_OF)
+    # two tables loaded from the same file, as two processes would
+    first, second = load(path, inputs), load(path, inputs)
+    first.add('999001', 103.85, 1.3, 'DOWNTOWN CORE', 'CENTRAL REGION')
+    second.add('999002', 103.86, 1.31, 'DOWNTOWN CORE', 'CENTRAL REGION')
+    first.add('999003', 103.87, 1.32, 'DOWNTOWN CORE', 'CENTRAL REGION')
+    saved = load(path, inputs)
+    assert {'999001', '999002', '999003'} <= set(saved.columns['postal_code'].tolist())
+    assert len(saved) == N_CODES + 3
+
+
+def append(path, inputs, worker, n):
+    table = load(path, inputs)
+    for i in range(n):
+        table.add('99{}{:03d}'.format(worker, i), 103.85 + 0.001 * i, 1.3, 'DOWNTOWN CORE', 'CENTRAL REGION')
+
+
+@pytest.mark.skipif(features.fcntl is None, reason='no advisory file locks on this platform')
+def test_processes_keep_each_others_rows(inputs, path):
+    FeatureTable.load_or_build(path, *inputs, as_of=AS_OF)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=append, args=(path, inputs, worker, 10)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert len(load(path, inputs)) == N_CODES + 40
@@ -0,0 +1,137 @@
+'''
+GeocodingClient against a local StubOneMapServer: retries, backoff, error responses and coalescing of lookups
+'''
+import threading
+import time
+import pandas as pd
+import pytest
+import requests
+from geocoding import GeocodingClient, GeocodeCache, PostalCodeNotFound, UnexpectedResponse
+from onemap_stub import StubOneMapServer
+
+KNOWN = pd.DataFrame({'Postal Code': ['123456', '654321'],
+                      'LONGITUDE': [103.85, 103.9],
+                      'LATITUDE': [1.3, 1.35],
+                      'BUILDING': ['TEST TOWER', 'OTHER TOWER']})
+
+
+@pytest.fixture
+def client():
+    clients = []
+
+    def make(url, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        clients.append(GeocodingClient(base_url=url, **kwargs))
+        return clients[-1]
+
+    yield make
+    for c in clients:
+        c.close()
+
+
+def test_geocode(client):
+    with StubOneMapServer(KNOWN) as url:
+        result = client(url).geocode('123456')
+    assert result['BUILDING'] == 'TEST TOWER'
+    assert float(result['LONGITUDE']) == 103.85
+
+
+def test_not_found(client):
+    stub = StubOneMapServer(KNOWN)
+    with stub as url:
+        with pytest.raises(PostalCodeNotFound):
+            client(url).geocode('000000')
+    assert stub.requests == 1
+
+
+def test_retries_server_errors(client):
+    stub = StubOneMapServer(KNOWN, fail_first=2)
+    with stub as url:
+        c = client(url, retries=3)
+        assert c.geocode('123456')['BUILDING'] == 'TEST TOWER'
+    assert stub.requests == 3
+    assert c.requests == 3
+
+
+def test_gives_up_after_retries(client):
+    stub = StubOneMapServer(KNOWN, fail_first=10)
+    with stub as url:
+        with pytest.raises(requests.HTTPError):
+            client(url, retries=2).geocode('123456')
+    assert stub.requests == 3
+
+
+def test_backoff_doubles(client):
+    stub = StubOneMapServer(KNOWN, fail_first=3)
+    with stub as url:
+        c = client(url, retries=3, backoff=0.05)
+        start = time.perf_counter()
+        c.geocode('123456')
+        elapsed = time.perf_counter() - start
+    # waits 0.05, 0.1 and 0.2 seconds before the three retries
+    assert elapsed >= 0.35
+
+
+@pytest.mark.parametrize('status', [400, 403, 404])
+def test_no_retry_on_client_errors(client, status):
+    stub = StubOneMapServer(KNOWN, fail_first=10, fail_status=status)
+    with stub as url:
+        with pytest.raises(requests.HTTPError) as e:
+            client(url, retries=3).geocode('123456')
+    assert e.value.response.status_code == status
+    assert stub.requests == 1
+
+
+def test_retries_rate_limiting(client):
+    stub = StubOneMapServer(KNOWN, fail_first=1, fail_status=429)
+    with stub as url:
+        assert client(url, retries=1).geocode('123456')['BUILDING'] == 'TEST TOWER'
+    assert stub.requests == 2
+
+
+def test_error_body_is_a_failed_lookup(client):
+    stub = StubOneMapServer(KNOWN, error_codes=['123456'])
+    with stub as url:
+        c = client(url, cache=GeocodeCache(':memory:'))
+        with pytest.raises(UnexpectedResponse):
+            c.geocode('123456')
+        # left out of the results, unlike a postal code OneMap has no result for
+        assert set(c.geocode_many(['123456', '654321'])) == {'654321'}
+    # failed lookups are not cached as not found
+    assert c.cache.get('123456') == (False, None)
+
+
+def test_coalesces_identical_lookups(client):
+    stub = StubOneMapServer(KNOWN, delay=0.2)
+    with stub as url:
+        c = client(url)
+        results = [None] * 8
+        barrier = threading.Barrier(len(results))
+
+        def lookup(i):
+            barrier.wait()
+            results[i] = c.geocode('123456')
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert stub.requests == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_geocode_many(client):
+    stub = StubOneMapServer(KNOWN)
+    with stub as url:
+        results = client(url).geocode_many(['123456', 123456, '654321', '000000'])
+    assert set(results) == {'123456', '654321', '000000'}
+    assert results['654321']['BUILDING'] == 'OTHER TOWER'
+    assert results['000000'] is None
+    assert stub.requests == 3
+
+
+def test_geocode_many_leaves_out_failed_lookups(client):
+    stub = StubOneMapServer(KNOWN, fail_first=10)
+    with stub as url:
+        assert client(url, retries=0).geocode_many(['123456', '000000']) == {}
@@ -0,0 +1,78 @@
+'''
+TreeEngine against the xgboost booster: same leaf in every tree and the same prediction within RTOL for every row,
+including rows on split thresholds and rows with missing values
+'''
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+xgboost = pytest.importorskip('xgboost')
+
+from benchmarks.inference_parity import mismatches, parity_inputs
+from inference import BoosterEngine, TreeEngine
+from model import MODEL_FILE, STANDARD_SCALE_VARS, MIN_MAX_VARS
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modelling', MODEL_FILE)
+N_FEATURES = len(STANDARD_SCALE_VARS) + len(MIN_MAX_VARS) + 12
+
+
+def training_data(n, seed=0):
+    # scaled features, one-hot columns and some missing values, as the model is trained on
+    rng = np.random.default_rng(seed)
+    features = np.concatenate([rng.normal(0, 1, (n, len(STANDARD_SCALE_VARS))),
+                               rng.uniform(0, 1, (n, len(MIN_MAX_VARS))),
+                               rng.random((n, N_FEATURES - len(STANDARD_SCALE_VARS) - len(MIN_MAX_VARS))) < 0.2], axis=1).astype(np.float32)
+    target = 5000 + 800 * features[:, 0] - 300 * features[:, 1] + 500 * features[:, -1] + rng.normal(0, 100, n)
+    features[rng.random(features.shape) < 0.02] = np.nan
+    return features, target
+
+
+def train(objective='reg:squarederror', **kwargs):
+    model = xgboost.XGBRegressor(n_estimators=40, max_depth=6, objective=objective, **kwargs)
+    model.fit(*training_data(2000))
+    return model
+
+
+def check_parity(model):
+    booster = model.get_booster()
+    engine = TreeEngine.from_booster(booster)
+    features = parity_inputs(engine, booster.num_features(), n=2000)
+    reference = BoosterEngine(booster).predict(features)
+    columns = booster.feature_names or ['f{}'.format(i) for i in range(features.shape[1])]
+    leaves = model.apply(pd.DataFrame(features, columns=columns)).reshape(len(features), -1)
+    assert (engine.leaves(features) == leaves).all()
+    assert mismatches(engine.predict(features), reference) == 0
+
+
+@pytest.mark.parametrize('objective', ['reg:squarederror', 'reg:gamma'])
+def test_trained_model(objective):
+    check_parity(train(objective))
+
+
+def test_best_iteration():
+    features, target = training_data(2000, seed=1)
+    model = xgboost.XGBRegressor(n_estimators=200, max_depth=6, learning_rate=0.5, early_stopping_rounds=2)
+    model.fit(features[:1500], target[:1500], eval_set=[(features[1500:], target[1500:])], verbose=False)
+    assert model.best_iteration < 199
+    assert len(TreeEngine.from_booster(model).n_nodes) == model.best_iteration + 1
+    check_parity(model)
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason='model not in the tree')
+def test_bundled_model():
+    model = xgboost.XGBRegressor()
+    model.load_model(MODEL_PATH)
+    check_parity(model)
+
+
+def test_padding_nodes_are_not_splits():
+    engine = TreeEngine.from_booster(train())
+    nodes = np.arange(engine.left.shape[1])
+    assert (engine.n_nodes < engine.left.shape[1]).any()
+    padding = nodes >= engine.n_nodes[:, None]
+    # padded nodes are zeros, which would look like a split to node 0 in a naive left != node check
+    assert (engine.left[padding] == 0).all()
+    features = parity_inputs(engine, N_FEATURES, n=10)
+    splits = ((engine.left != nodes) & ~padding).sum()
+    assert len(features) == 10 + splits + 1
@@ -0,0 +1,48 @@
+'''
+FeatureLayout: scaling folded into one affine transform, and rows missing a model feature refused
+'''
+import os
+import joblib
+import numpy as np
+import pytest
+from benchmarks.synthetic import SyntheticData
+from model import FeatureLayout, MissingFeatures, STANDARD_SCALER_FILE, MM_SCALER_FILE, STANDARD_SCALE_VARS, MIN_MAX_VARS
+
+MODELLING = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modelling')
+
+
+@pytest.fixture(scope='module')
+def scalers():
+    return joblib.load(os.path.join(MODELLING, STANDARD_SCALER_FILE)), joblib.load(os.path.join(MODELLING, MM_SCALER_FILE))
+
+
+@pytest.fixture(scope='module')
+def data(datasets):
+    return SyntheticData(datasets)
+
+
+@pytest.fixture(scope='module')
+def layout(data, scalers):
+    return FeatureLayout(data.modelling_columns()[:-1], *scalers)
+
+
+def unscaled(data, layout, n=50):
+    df = data.modelling_dataset(n)
+    return df, df[layout.columns].to_numpy(dtype=np.float32)
+
+
+def test_transform_matches_scalers(data, layout, scalers):
+    df, features = unscaled(data, layout)
+    s_scaler, mm_scaler = scalers
+    expected = np.concatenate([s_scaler.transform(df[STANDARD_SCALE_VARS].values), mm_scaler.transform(df[MIN_MAX_VARS].values)], axis=1)
+    scaled = layout.transform(features)
+    np.testing.assert_allclose(scaled[:, :layout.n_scaled], expected, rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(scaled[:, layout.n_scaled:], df[layout.columns[layout.n_scaled:]].to_numpy(dtype=np.float32))
+
+
+def test_missing_feature_is_refused(data, layout):
+    _, features = unscaled(data, layout)
+    features[[3, 7], layout.position['Nearest Primary School']] = np.nan
+    assert np.flatnonzero(layout.missing(features)).tolist() == [3, 7]
+    with pytest.raises(MissingFeatures, match='2 of 50 rows have no Nearest Primary School'):
+        layout.transform(features)
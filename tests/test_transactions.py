@@ -0,0 +1,86 @@
+'''
+Transaction search structures against the pandas filters and groupby they replaced in Sample
+'''
+import numpy as np
+import pandas as pd
+import pytest
+from Sample import haversine
+from transactions import PsfCube, TransactionIndex, TransactionStore
+
+PROPERTY_TYPES = [['Condominium'], ['Apartment', 'Executive Condominium'], ['Executive Condominium', 'Condominium', 'Apartment']]
+WINDOWS = [('2016-01-01', '2021-01-01'), ('2019-06-15', '2019-07-15'), ('2000-01-01', '2100-01-01')]
+RADII = [0.5, 1, 2]
+# Sample.haversine on one listing at a time is slow, the within test only checks a few listings
+N_LISTINGS = 5
+
+
+@pytest.fixture(scope='module')
+def store(transactions):
+    return TransactionStore(transactions, TransactionIndex(transactions))
+
+
+@pytest.mark.parametrize('property_types', PROPERTY_TYPES)
+@pytest.mark.parametrize('start, end', WINDOWS)
+def test_store_matches_date_and_type_filter(transactions, store, property_types, start, end):
+    data = transactions
+    expected = data[(data['Sale Date'] >= start) & (data['Sale Date'] < end) & (data['Property Type'].isin(property_types))]
+    positions = np.arange(len(data))
+    assert data.index[positions[store.matches(positions, property_types, start, end)]].equals(expected.index)
+
+
+@pytest.fixture(scope='module')
+def index(transactions):
+    return TransactionIndex(transactions)
+
+
+def listing_points(transactions):
+    # at a transaction, as listings in a known building are, and between transactions
+    sample = transactions.sample(N_LISTINGS, random_state=1)
+    lon, lat = sample['LONGITUDE'].values, sample['LATITUDE'].values
+    return list(zip(lon, lat)) + [(lon.mean(), lat.mean())]
+
+
+@pytest.mark.parametrize('radius', RADII)
+def test_index_within_matches_haversine_filter(transactions, index, radius):
+    data = transactions
+    for lon, lat in listing_points(data):
+        distance = data.apply(lambda x: haversine(lon, lat, x['LONGITUDE'], x['LATITUDE']), axis=1)
+        expected = distance[distance <= radius]
+        positions, within = index.within(lon, lat, radius)
+        assert data.index[positions].equals(expected.index)
+        np.testing.assert_allclose(within, expected.values, rtol=1e-12)
+
+
+def groupby_monthly(data, planning_areas, property_types, start, end):
+    # as Sample.plot_psm computed it before the cube
+    window_df = data[(data['Sale Date'] >= start) & (data['Sale Date'] < end) & (data['Property Type'].isin(property_types))]
+    window_df = window_df.assign(**{'Planning Area': window_df['Planning Area'].str.upper()})
+    filtered_df = window_df[window_df['Planning Area'].isin(planning_areas)]
+    filtered_df = filtered_df.assign(**{'Sale Month': filtered_df['Sale Date'].apply(lambda x: x.strftime('%Y-%m'))})
+    return filtered_df.groupby(['Sale Month', 'Planning Area'])['Unit Price ($ PSF)'].mean().reset_index()
+
+
+@pytest.mark.parametrize('property_types', PROPERTY_TYPES)
+@pytest.mark.parametrize('start, end', WINDOWS)
+def test_psf_cube_matches_groupby(transactions, property_types, start, end):
+    areas = transactions['Planning Area'].str.upper().value_counts().index[:3].tolist()
+    expected = groupby_monthly(transactions, areas, property_types, start, end)
+    # in any case, as planning areas come from the area centroids
+    result = PsfCube(transactions).monthly([area.title() for area in areas], property_types, start, end)
+    pd.testing.assert_frame_equal(result.astype({'Sale Month': object, 'Planning Area': object}),
+                                  expected.astype({'Sale Month': object, 'Planning Area': object}), check_exact=False, rtol=1e-12)
+
+
+def test_psf_cube_add_matches_groupby(transactions):
+    areas = transactions['Planning Area'].str.upper().value_counts().index[:3].tolist()
+    ordered = transactions.sort_values('Sale Date')
+    half = len(ordered) // 2
+    # later transactions added to a cube built over the earlier ones, and earlier ones to a cube over the later ones
+    for first, second in ((ordered[:half], ordered[half:]), (ordered[half:], ordered[:half])):
+        cube = PsfCube(first)
+        cube.add(second)
+        for property_types in PROPERTY_TYPES:
+            expected = groupby_monthly(transactions, areas, property_types, *WINDOWS[-1])
+            result = cube.monthly(areas, property_types, *WINDOWS[-1])
+            np.testing.assert_allclose(result['Unit Price ($ PSF)'], expected['Unit Price ($ PSF)'], rtol=1e-12)
+            assert result['Sale Month'].tolist() == expected['Sale Month'].tolist()
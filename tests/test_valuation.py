@@ -0,0 +1,71 @@
+'''
+Batch valuation against Listing.pred_price, one listing at a time, on real postal codes
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('xgboost')
+
+from amenities import school_index, train_index, police_centre_index
+from benchmarks.synthetic import SyntheticData
+from listing import Listing
+from location import PlanningAreaIndex, PostalCodeIndex
+from model import ModelRegistry
+from valuation import design_matrix, resolve_features, resolve_locations, value_listings
+
+N_LISTINGS = 100
+
+
+@pytest.fixture(scope='module')
+def data(datasets):
+    return SyntheticData(datasets, seed=1)
+
+
+@pytest.fixture(scope='module')
+def inputs(datasets, data):
+    postal_index = PostalCodeIndex(pd.read_csv(datasets + 'historical_postal_code_area.csv'))
+    area_index = PlanningAreaIndex(pd.read_csv(datasets + 'area_centroid.csv'))
+    return (postal_index, area_index,
+            school_index(pd.read_csv(datasets + 'primary_sch_gdf.csv')),
+            train_index(pd.read_csv(datasets + 'train_gdf.csv')),
+            police_centre_index(pd.read_csv(datasets + 'police_centre_gdf.csv')),
+            pd.read_csv(datasets + 'average_cases_by_npc.csv'))
+
+
+@pytest.fixture(scope='module')
+def model(data, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('model'))
+    cols = data.model(path, n=2000, n_estimators=30, max_depth=6)
+    return path, cols, ModelRegistry(path)
+
+
+@pytest.fixture(scope='module')
+def listings(data):
+    # postal codes of historical_postal_code_area.csv only, located without OneMap
+    return data.listings(N_LISTINGS)
+
+
+def single(row):
+    return Listing(row['Postal Code'], row['Property Type'], row['Floor Number'], row['Floor Area'], row['Remaining Lease'])
+
+
+def test_design_matrix_matches_feature_vector(inputs, model, listings):
+    postal_index, area_index, sch, train, police_centre, avg_cases = inputs
+    _, cols, registry = model
+    layout = registry.layout(cols)
+    locations = resolve_locations(listings['Postal Code'], postal_index, area_index)
+    matrix = design_matrix(listings, resolve_features(locations, sch, train, police_centre, avg_cases), layout)
+    for i, row in listings.iterrows():
+        vector = single(row).feature_vector(layout, postal_index, area_index, sch, train, police_centre, avg_cases)
+        np.testing.assert_array_equal(matrix[i], vector[0])
+
+
+def test_batch_matches_single(inputs, model, listings):
+    path, cols, registry = model
+    valued = value_listings(listings, cols, *inputs, registry=registry)
+    assert valued['Predicted Price'].notnull().all()
+    for i, row in listings.iterrows():
+        price, psf = single(row).pred_price(path, cols, *inputs, registry=registry)
+        assert valued['Predicted Price'][i] == pytest.approx(price, rel=1e-6)
+        assert valued['Predicted PSF'][i] == pytest.approx(psf, rel=1e-6)
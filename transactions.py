@@ -0,0 +1,225 @@
+'''
+Search structures over the historical transactions of the preliminary dataset, built once at load:
+    index = TransactionIndex(prelim_ds)
+    positions, distance = index.within(listing_long, listing_lat, radius)  # radius in km
+    store = TransactionStore(prelim_ds, index)
+    recent_condos_nearby = positions[store.matches(positions, ['Condominium'], '2016-01-01', '2021-01-01')]
+    cube = PsfCube(prelim_ds)
+    monthly_psf = cube.monthly(['BEDOK', 'TAMPINES'], ['Condominium'], '2016-01-01', '2021-01-01')
+'''
+import threading
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+from amenities import EARTH_RADIUS_KM, haversine, to_radians
+
+
+class TransactionIndex:
+    """BallTree over the LATITUDE/LONGITUDE of every transaction
+    Radius queries return the row positions of nearby transactions directly, with their great-circle distance
+    computed as Sample.haversine does, instead of measuring the distance to every transaction.
+    """
+    def __init__(self, data, leaf_size=40):
+        '''
+        :param data: dataframe of transactions with LONGITUDE and LATITUDE columns
+        :param leaf_size: leaf size of the tree
+        '''
+        self.data = data
+        self.lon = data['LONGITUDE'].to_numpy(dtype=float)
+        self.lat = data['LATITUDE'].to_numpy(dtype=float)
+        # transactions without coordinates are never within any radius
+        self.located = np.flatnonzero(~(np.isnan(self.lon) | np.isnan(self.lat)))
+        self.tree = BallTree(to_radians(self.lon[self.located], self.lat[self.located]), leaf_size=leaf_size, metric='haversine')
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def of(cls, transactions):
+        # Accept either a prebuilt index or the raw transactions dataframe
+        return transactions if isinstance(transactions, cls) else cls(transactions)
+
+    def within(self, lon, lat, radius):
+        '''
+        :param lon, lat: coordinates of the listing
+        :param radius: search radius in km
+        :return: positions in data of the transactions within radius km, in row order, and their distance in km
+        '''
+        # slightly wider than the radius, the exact distance decides points on the boundary
+        candidates = self.tree.query_radius(to_radians([float(lon)], [float(lat)]), r=radius / EARTH_RADIUS_KM * (1 + 1e-9))[0]
+        positions = np.sort(self.located[candidates])
+        distance = haversine(float(lon), float(lat), self.lon[positions], self.lat[positions])
+        inside = distance <= radius
+        return positions[inside], distance[inside]
+
+
+class TransactionStore:
+    """Sale dates and property types of the transactions as arrays, with the TransactionIndex over the same rows
+    The transactions found by a radius search are filtered by type and date on those arrays, without touching the
+    dataframe, which is left as it is.
+    The store is not partitioned by property type and sorted by date: every query of the app either starts from a
+    radius search (Sample.get_filtered_df), whose k hits are filtered in O(k), or is answered by the PsfCube
+    (Sample.plot_psm). A date window sliced from sorted partitions would hold every transaction of the period island
+    wide and still have to be intersected with the radius hits, at the cost of a second copy of the rows.
+    """
+    def __init__(self, data, index=None, date_col='Sale Date', type_col='Property Type'):
+        '''
+        :param data: dataframe of transactions, with dates parsed in date_col
+        :param index: optional TransactionIndex over data, built on first radius search if None
+        '''
+        self.data = data
+        self.date_col = date_col
+        self.type_col = type_col
+        # in row order, to filter the positions found by a radius search
+        self.dates = data[date_col].to_numpy(dtype='datetime64[ns]')
+        self.types = data[type_col].to_numpy(dtype=object)
+        self._index = index
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def of(cls, transactions):
+        # Accept a prebuilt store, a TransactionIndex or the raw transactions dataframe
+        if isinstance(transactions, cls):
+            return transactions
+        if isinstance(transactions, TransactionIndex):
+            return cls(transactions.data, transactions)
+        return cls(transactions)
+
+    @property
+    def index(self):
+        # TransactionIndex over the same rows, for radius searches
+        with self._lock:
+            if self._index is None:
+                self._index = TransactionIndex(self.data)
+            return self._index
+
+    def matches(self, positions, property_types, start, end):
+        '''
+        :param positions: positions in data, e.g. from a radius search
+        :param start, end: date strings or timestamps, start included and end excluded
+        :return: boolean array, whether each of those transactions is of the property types and within the window
+        '''
+        dates = self.dates[positions]
+        return ((dates >= np.datetime64(pd.Timestamp(start))) & (dates < np.datetime64(pd.Timestamp(end)))
+                & np.isin(self.types[positions], list(property_types)))
+
+
+class PsfCube:
+    """Sum and count of the unit price PSF of transactions per planning area, property type and day of sale
+    Built once at load and updated with add() as transactions arrive, so the monthly average PSF of any planning areas,
+    property types and date window is summed from the cells without going through the transactions.
+    Cells are kept per day rather than per month so that a window starting mid-month counts exactly the same
+    transactions as comparing sale dates would; for 55 planning areas, 3 property types and 20 years that is ~15MB.
+    """
+    def __init__(self, data=None, area_col='Planning Area', type_col='Property Type', date_col='Sale Date', psf_col='Unit Price ($ PSF)'):
+        '''
+        :param data: optional dataframe of transactions to start with, dates parsed in date_col
+        '''
+        self.area_col = area_col
+        self.type_col = type_col
+        self.date_col = date_col
+        self.psf_col = psf_col
+        # upper-cased planning area / property type -> position on the first / second axis
+        self.areas = {}
+        self.types = {}
+        # day of the first position on the third axis
+        self.first_day = None
+        self.sums = np.zeros((0, 0, 0))
+        self.counts = np.zeros((0, 0, 0), dtype=np.int32)
+        self._lock = threading.Lock()
+        if data is not None:
+            self.add(data)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    @classmethod
+    def of(cls, transactions):
+        # Accept a prebuilt cube, a TransactionStore or TransactionIndex, or the raw transactions dataframe
+        if isinstance(transactions, cls):
+            return transactions
+        return cls(transactions.data if isinstance(transactions, (TransactionStore, TransactionIndex)) else transactions)
+
+    def add(self, transactions):
+        '''
+        Add transactions to the cells, growing the axes for new planning areas, property types and days
+        :param transactions: dataframe with the planning area, property type, sale date and unit price PSF columns
+        '''
+        psf = transactions[self.psf_col]
+        if psf.dtype == object or pd.api.types.is_string_dtype(psf):
+            # prices may be formatted with thousands separators, as get_average_psf handles
+            psf = pd.to_numeric(psf.astype(str).str.replace(',', ''), errors='coerce')
+        psf = psf.to_numpy(dtype=float)
+        days = transactions[self.date_col].to_numpy(dtype='datetime64[D]')
+        valid = (~np.isnan(psf) & ~np.isnat(days) & transactions[self.area_col].notna().to_numpy()
+                 & transactions[self.type_col].notna().to_numpy())
+        if not valid.any():
+            return
+        psf, days = psf[valid], days[valid]
+        areas = transactions[self.area_col][valid].astype(str).str.upper().to_numpy()
+        types = transactions[self.type_col][valid].astype(str).to_numpy()
+        with self._lock:
+            area_pos = _positions(self.areas, areas)
+            type_pos = _positions(self.types, types)
+            first_day, last_day = days.min(), days.max()
+            if self.first_day is not None:
+                first_day, last_day = min(first_day, self.first_day), max(last_day, self.first_day + self.sums.shape[2] - 1)
+            shape = (len(self.areas), len(self.types), int((last_day - first_day).astype(int)) + 1)
+            if shape != self.sums.shape:
+                self._grow(shape, first_day)
+            day_pos = (days - self.first_day).astype(np.int64)
+            cells = np.ravel_multi_index((area_pos, type_pos, day_pos), shape)
+            self.sums += np.bincount(cells, weights=psf, minlength=self.sums.size).reshape(shape)
+            self.counts += np.bincount(cells, minlength=self.counts.size).reshape(shape).astype(np.int32)
+
+    def _grow(self, shape, first_day):
+        # existing cells keep their values at the same area, type and day
+        offset = 0 if self.first_day is None else int((self.first_day - first_day).astype(int))
+        sums = np.zeros(shape)
+        counts = np.zeros(shape, dtype=np.int32)
+        old = self.sums.shape
+        sums[:old[0], :old[1], offset:offset + old[2]] = self.sums
+        counts[:old[0], :old[1], offset:offset + old[2]] = self.counts
+        self.sums, self.counts, self.first_day = sums, counts, first_day
+
+    def monthly(self, planning_areas, property_types, start, end):
+        '''
+        :param planning_areas: list of planning areas, in any case
+        :param property_types: list of property types
+        :param start, end: dates, start included and end excluded
+        :return: dataframe of 'Sale Month' (YYYY-MM), 'Planning Area' and average 'Unit Price ($ PSF)', for every
+                 month and planning area with transactions, ordered as groupby(['Sale Month', 'Planning Area']) would
+        '''
+        columns = ['Sale Month', 'Planning Area', self.psf_col]
+        areas = sorted({area.upper() for area in planning_areas if area.upper() in self.areas})
+        types = [self.types[property_type] for property_type in set(property_types) if property_type in self.types]
+        with self._lock:
+            if not areas or not types or self.first_day is None:
+                return pd.DataFrame(columns=columns)
+            lo = int(np.clip((np.datetime64(pd.Timestamp(start), 'D') - self.first_day).astype(int), 0, self.sums.shape[2]))
+            hi = int(np.clip((np.datetime64(pd.Timestamp(end), 'D') - self.first_day).astype(int), 0, self.sums.shape[2]))
+            rows = [self.areas[area] for area in areas]
+            sums = self.sums[rows][:, types, lo:hi].sum(axis=1)
+            counts = self.counts[rows][:, types, lo:hi].sum(axis=1)
+            first_day = self.first_day
+        if hi <= lo:
+            return pd.DataFrame(columns=columns)
+        # days of the window summed into the months they fall in
+        months = (first_day + np.arange(lo, hi)).astype('datetime64[M]')
+        starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        sums = np.add.reduceat(sums, starts, axis=1)
+        counts = np.add.reduceat(counts, starts, axis=1)
+        month_pos, area_pos = np.nonzero(counts.T)
+        return pd.DataFrame({'Sale Month': months[starts][month_pos].astype(str),
+                             'Planning Area': np.array(areas, dtype=object)[area_pos],
+                             self.psf_col: sums.T[month_pos, area_pos] / counts.T[month_pos, area_pos]})
+
+
+def _positions(positions, keys):
+    # position of each key, new keys appended in order of first appearance
+    codes, uniques = pd.factorize(keys)
+    lookup = np.array([positions.setdefault(key, len(positions)) for key in uniques], dtype=np.int64)
+    return lookup[codes]
@@ -0,0 +1,184 @@
+'''
+Batch valuation of many listings in one pass, for portfolio revaluations
+Locations and amenity features are resolved once per distinct postal code, and every listing is scaled and
+predicted in a single call to the model:
+    listings = pd.DataFrame({'Postal Code': [...], 'Property Type': [...], 'Floor Number': [...],
+                             'Floor Area': [...], 'Remaining Lease': [...]})
+    valued = value_listings(listings, cols, postal_index, area_index, sch, train, police_centre, avg_cases, feature_table)
+'''
+import logging
+import numpy as np
+import pandas as pd
+from amenities import location_features
+from geocoding import normalize_postal_code
+from location import PostalCodeIndex, planning_areas_of
+from model import default_registry, PPI, SQFT_PER_SQM
+from metrics import timed
+
+logger = logging.getLogger('valuation.batch')
+
+# Columns expected in the listings dataframe, with the same units as Listing (floor area in SQFT)
+LISTING_COLUMNS = ['Postal Code', 'Property Type', 'Floor Number', 'Floor Area', 'Remaining Lease']
+
+
+def resolve_locations(postal_codes, historical_postal_code_area, area_centroids, offline_geocoder=None, client=None):
+    '''
+    Locate each distinct postal code: our dataset first, then the offline geocoder, then OneMap, then, only where
+    OneMap could not be reached, the closest known code in the same postal sector
+    :param postal_codes: iterable of postal codes
+    :param historical_postal_code_area: historical_postal_code_area dataframe or PostalCodeIndex
+    :param area_centroids: area centroid dataframe, PlanningAreaIndex or centroid index, for codes not in our dataset
+    :param offline_geocoder: optional OfflineGeocoder
+    :param client: optional GeocodingClient, the shared one if None
+    :return: dataframe indexed by normalized postal code with lon, lat, planning_area, planning_region and
+             confidence ('exact', 'sector' or None where the code could not be located or OneMap has no result for it)
+    '''
+    codes = pd.unique(pd.Series(list(postal_codes), dtype=object).apply(normalize_postal_code))
+    index = PostalCodeIndex.of(historical_postal_code_area)
+    records = [index.get(code) for code in codes]
+    known = np.array([record is not None for record in records], dtype=bool)
+    locations = pd.DataFrame({'lon': np.nan, 'lat': np.nan, 'planning_area': None, 'planning_region': None, 'confidence': None},
+                             index=pd.Index(codes, name='postal_code'))
+    locations = locations.astype({'planning_area': object, 'planning_region': object, 'confidence': object})
+    if known.any():
+        locations.loc[known, ['lon', 'lat', 'planning_area', 'planning_region']] = [list(record) for record in records if record is not None]
+        locations.loc[known, 'confidence'] = 'exact'
+
+    unknown = codes[~known]
+    if len(unknown) > 0:
+        lon = np.full(len(unknown), np.nan)
+        lat = np.full(len(unknown), np.nan)
+        confidence = np.full(len(unknown), None, dtype=object)
+        if offline_geocoder is not None:
+            lon, lat, confidence = offline_geocoder.locate_many(unknown, approximate=False)
+        missing = np.flatnonzero(pd.isnull(confidence))
+        failed = np.zeros(len(unknown), dtype=bool)
+        if len(missing) > 0:
+            if client is None:
+                from geocoding import default_client
+                client = default_client()
+            results = client.geocode_many(unknown[missing])
+            for i in missing:
+                if unknown[i] not in results:
+                    failed[i] = True
+                elif results[unknown[i]] is not None:
+                    result = results[unknown[i]]
+                    lon[i], lat[i], confidence[i] = float(result['LONGITUDE']), float(result['LATITUDE']), 'exact'
+        failed = np.flatnonzero(failed)
+        if len(failed) > 0 and offline_geocoder is not None:
+            # OneMap unreachable; codes it has no result for stay unlocated, as with a single valuation
+            lon[failed], lat[failed], confidence[failed] = offline_geocoder.locate_many(unknown[failed])
+        located = ~pd.isnull(confidence)
+        locations.loc[unknown, 'lon'] = lon
+        locations.loc[unknown, 'lat'] = lat
+        locations.loc[unknown, 'confidence'] = confidence
+        if located.any():
+            areas, regions = planning_areas_of(lon[located], lat[located], area_centroids)
+            locations.loc[unknown[located], 'planning_area'] = areas
+            locations.loc[unknown[located], 'planning_region'] = regions
+    return locations
+
+
+def resolve_features(locations, sch_gdf, train_gdf, police_centre, avg_cases_by_npc, feature_table=None, as_of=None):
+    '''
+    :param locations: dataframe from resolve_locations
+    :param feature_table: optional FeatureTable, whose rows are used as they are for the codes it has
+    :param as_of: date to compute features for codes not in the feature table, defaults to the table's date, else now
+    :return: locations joined with one column per LocationFeatures field, NaN for codes that were not located,
+             avg_cases truncated to whole cases as in LocationFeatures
+    '''
+    features = pd.DataFrame(index=locations.index)
+    todo = locations.index[~pd.isnull(locations['confidence'])]
+    if feature_table is not None:
+        tabled = feature_table.lookup_many(todo)
+        # the table's own location wins, as in Listing.get_postal_features
+        locations = locations.copy()
+        locations.loc[tabled.index, ['lon', 'lat', 'planning_area', 'planning_region']] = tabled[['lon', 'lat', 'planning_area', 'planning_region']].values
+        # the table only holds exactly located codes
+        locations.loc[tabled.index, 'confidence'] = 'exact'
+        features = tabled.drop(columns=['lon', 'lat', 'planning_area', 'planning_region'])
+        todo = todo.difference(tabled.index)
+        if as_of is None:
+            as_of = feature_table.as_of
+    if len(todo) > 0:
+        computed = location_features(locations.loc[todo, 'lon'].values.astype(float), locations.loc[todo, 'lat'].values.astype(float),
+                                     sch_gdf, train_gdf, police_centre, avg_cases_by_npc, as_of)
+        computed.index = todo
+        features = pd.concat([features, computed]) if len(features.columns) > 0 else computed
+    if 'avg_cases' in features:
+        # whole cases, as resolve_location_features gives them to Listing
+        features['avg_cases'] = np.trunc(features['avg_cases'].astype(float))
+    return locations.join(features)
+
+
+def design_matrix(listings, features, layout):
+    '''
+    Unscaled model input of every listing, the batch equivalent of Listing.feature_vector
+    :param listings: dataframe with LISTING_COLUMNS
+    :param features: dataframe from resolve_features
+    :param layout: FeatureLayout of the model, from ModelRegistry.layout
+    :return: float32 array with one row per listing in layout order
+    '''
+    rows = features.index.get_indexer(listings['Postal Code'].apply(normalize_postal_code))
+    matrix = layout.empty(len(listings))
+
+    layout.set_column(matrix, 'Area (SQM)', listings['Floor Area'].values.astype(int) / SQFT_PER_SQM)
+    layout.set_column(matrix, 'Floor Number', listings['Floor Number'].values.astype(int))
+    layout.set_column(matrix, 'PPI', PPI)
+    layout.set_column(matrix, 'Average Cases Per Year', features['avg_cases'].values.astype(float)[rows])
+    layout.set_column(matrix, 'Nearest Primary School', features['sch_dist'].values.astype(float)[rows])
+    layout.set_column(matrix, 'nearest_station_distance', features['train_dist'].values.astype(float)[rows])
+    layout.set_column(matrix, 'Remaining Lease', listings['Remaining Lease'].values.astype(int))
+
+    layout.set_one_hot(matrix, features['planning_area'].values[rows])
+    layout.set_one_hot(matrix, listings['Property Type'].values)
+    # property can have more than 1 line within 1km radius
+    lines = [row_lines if isinstance(row_lines, set) else set() for row_lines in features['train_lines'].values[rows]]
+    layout.set_one_hot(matrix, [line for row_lines in lines for line in row_lines],
+                       rows=np.repeat(np.arange(len(lines)), [len(row_lines) for row_lines in lines]))
+    return matrix
+
+
+def value_listings(listings, main_df_col, historical_postal_code_area, area_centroids, sch_gdf, train_gdf, police_centre_gdf,
+                   avg_cases_by_npc, feature_table=None, registry=None, path='modelling/', offline_geocoder=None, client=None):
+    '''
+    :param listings: dataframe with LISTING_COLUMNS, one row per unit
+    :param main_df_col: list of training dataset column names so that prediction df tallies
+    :param historical_postal_code_area: historical_postal_code_area dataframe or PostalCodeIndex
+    :param area_centroids: area centroid dataframe, PlanningAreaIndex or centroid index
+    :param sch_gdf, train_gdf, police_centre_gdf: amenity dataframes or prebuilt indexes
+    :param avg_cases_by_npc: to get avg crime cases per year for nearest police centre
+    :param feature_table: optional FeatureTable of precomputed features by postal code
+    :param registry: optional ModelRegistry to predict with, the shared one for path if None
+    :param offline_geocoder, client: used to locate postal codes not in our dataset
+    :return: copy of listings with 'Planning Area', 'Location Confidence', 'Predicted Price', 'Predicted PSF'
+             and 'Model Version' columns; prices are NaN for listings whose postal code could not be located, or
+             that lack a feature the model needs (see model.MissingFeatures)
+    '''
+    with timed('batch_geocode'):
+        locations = resolve_locations(listings['Postal Code'], historical_postal_code_area, area_centroids, offline_geocoder, client)
+    with timed('batch_amenity_search'):
+        features = resolve_features(locations, sch_gdf, train_gdf, police_centre_gdf, avg_cases_by_npc, feature_table)
+    rows = features.index.get_indexer(listings['Postal Code'].apply(normalize_postal_code))
+
+    layout = (registry or default_registry(path)).layout(main_df_col)
+    with timed('batch_feature_build'):
+        matrix = design_matrix(listings, features, layout)
+    located = ~pd.isnull(features['confidence'].values[rows])
+    complete = ~layout.missing(matrix)
+    if (located & ~complete).any():
+        logger.warning('%d of %d located listings lack a model feature and are not valued', int((located & ~complete).sum()), int(located.sum()))
+    predictions = np.full(len(listings), np.nan)
+    version = layout.loaded.version
+    if complete.any():
+        predictions[complete], version = layout.predict(matrix[complete])
+    # Covert prediction in SQM to SQFT
+    psf = predictions / SQFT_PER_SQM
+
+    valued = listings.copy()
+    valued['Planning Area'] = features['planning_area'].values[rows]
+    valued['Location Confidence'] = features['confidence'].values[rows]
+    valued['Predicted Price'] = listings['Floor Area'].values.astype(int) * psf
+    valued['Predicted PSF'] = psf
+    valued['Model Version'] = version
+    return valued